@@ -0,0 +1,221 @@
+"""Throughput and latency benchmark for the mesh file transfer protocol.
+
+Runs a sender and a receiver end to end over a SimulatedChannel on a virtual clock,
+across a matrix of file sizes and loss profiles, and prints the results as JSON so
+runs can be compared for regressions:
+
+    python3 mesh_benchmark.py --sizes 1000,10000 --profiles clean,bursty --repeat 3 -o results.json
+
+Times are simulated seconds of radio time, not how long the benchmark took to run.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from threading import Thread
+
+from mesh_file_transfer_1 import MeshBLEFileTransfer
+from mesh_file_transfer_2 import MeshBLEFileReceiver
+from mesh_protocol import lora_airtime, DATA_PAYLOAD_LEN
+from mesh_transport import SimulatedChannel, VirtualTimeLoop
+
+# Channel settings per loss profile, passed to SimulatedChannel
+LOSS_PROFILES = {
+    'clean': {'loss': 0.0},
+    'light': {'loss': 0.02},
+    'lossy': {'loss': 0.1},
+    'bursty': {'loss': 0.02, 'burst_loss': 0.03, 'burst_length': 4},  # Fades that swallow several packets in a row
+}
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+
+async def cancel_tasks():
+    """Cancel the nodes' workers and timers so a finished run's loop can be closed cleanly"""
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    while tasks:
+        # asyncio.wait_for can swallow a cancellation that races its timeout, so cancel until they are gone
+        for task in tasks:
+            task.cancel()
+        done, tasks = await asyncio.wait(tasks, timeout=1)
+
+
+def make_payload(size, kind, seed):
+    """Random bytes do not compress; text looks like the sensor logs the nodes usually send"""
+    rng = random.Random(seed)
+    if kind == 'text':
+        lines = []
+        while sum(len(line) for line in lines) < size:
+            lines.append(f"{len(lines)},{rng.uniform(15, 30):.2f},{rng.uniform(30, 90):.1f},{rng.randint(900, 1100)}\n")
+        return ''.join(lines).encode('utf-8')[:size]
+    return rng.randbytes(size)
+
+
+def run_case(size, profile, seed, options):
+    """Send one file from a fresh sender to a fresh receiver and measure the transfer"""
+    random.seed(seed)  # Transfer ids
+    loop = VirtualTimeLoop()
+    loop_thread = Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    # Each packet holds the channel for its time on air, preamble and headers included, as the nodes count it
+    channel = SimulatedChannel(loop, latency=options.latency, airtime=lambda size: lora_airtime(size, options.preset),
+                               seed=seed, **LOSS_PROFILES[profile])
+    sender_radio = channel.transport('!bench01')
+    receiver_radio = channel.transport('!bench02')
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)  # The receiver saves under ./received_files
+            sender = MeshBLEFileTransfer(None, 'bench-tx', transport=sender_radio, loop=loop)
+            receiver = MeshBLEFileReceiver(None, 'bench-rx', transport=receiver_radio, loop=loop)
+            for node, radio in ((sender, sender_radio), (receiver, receiver_radio)):
+                node.lora_preset = options.preset
+                node.status_file = None  # Results come from the metrics in memory
+                node.configure_send_budget()
+                radio.open(node.on_receive)
+                node.connected = True
+            if options.window:
+                sender.window_size = options.window
+            if options.max_payload:
+                sender.max_payload = options.max_payload
+
+            data = make_payload(size, options.data, seed)
+            with open('bench.bin', 'wb') as f:
+                f.write(data)
+
+            # Let the sender learn the receiver's capabilities before the transfer starts
+            receiver.announce_presence()
+            deadline = time.time() + options.timeout
+            while 'bench-rx' not in sender.known_nodes and time.time() < deadline:
+                time.sleep(0.01)
+
+            wall_start = time.time()
+            # The receiver's announcement goes out before the transfer; only the transfer's airtime is reported
+            airtime_before = (sender.airtime_used, receiver.airtime_used)
+            transfer = sender.queue_file('bench.bin', 'bench-rx')
+            transfer['finished'].wait(max(deadline - time.time(), 0))
+
+            save_path = os.path.join('received_files', 'received_bench.bin')
+            intact = False
+            if os.path.exists(save_path):
+                with open(save_path, 'rb') as f:
+                    intact = f.read() == data
+    finally:
+        os.chdir(cwd)
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(options.timeout)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+    completed = transfer['finished'].is_set() and transfer['success']
+    # The loop runs on ahead of this thread, so the transfer's own timestamps give its duration
+    elapsed = (transfer['finished_at'] or loop.time()) - transfer['queued_at']
+    packets = sender_radio.sent + receiver_radio.sent
+    retransmissions = sum(max(count - 1, 0) for count in transfer['transmissions'].values())
+    receiver_counters = receiver.metrics.snapshot()['totals']['counters']
+    return {
+        'size': size,
+        'profile': profile,
+        'seed': seed,
+        'completed': completed,
+        'intact': intact,
+        'completion_time': round(elapsed, 3),  # Simulated seconds from queueing to the receiver's verdict
+        'goodput': round(size / elapsed, 2) if completed and elapsed else 0.0,  # File bytes per simulated second
+        # Seconds on air, both directions
+        'airtime': round(sender.airtime_used + receiver.airtime_used - sum(airtime_before), 3),
+        'sender_airtime': round(sender.airtime_used - airtime_before[0], 3),
+        'packets_sent': packets,
+        'packets_per_byte': round(packets / size, 5) if size else 0.0,
+        'control_packets': receiver_radio.sent,  # ACKs, NACKs and replies from the receiver
+        'chunks': transfer['total_chunks'],
+        'chunk_size': transfer['chunk_size'],
+        'retransmissions': retransmissions,
+        'duplicate_chunks': receiver_counters['duplicate_chunks'],
+        'fec_recovered': receiver_counters['fec_recovered'],
+        'codec': transfer['codec'],
+        'channel': dict(channel.stats),
+        'wall_time': round(time.time() - wall_start, 3),
+    }
+
+
+def summarize(results):
+    """Median of each metric per size and profile, over the repeated runs"""
+    groups = {}
+    for result in results:
+        groups.setdefault((result['size'], result['profile']), []).append(result)
+    summary = []
+    for (size, profile), runs in groups.items():
+        done = [run for run in runs if run['completed']]
+        entry = {'size': size, 'profile': profile, 'runs': len(runs), 'completed': len(done)}
+        for metric in ('completion_time', 'goodput', 'airtime', 'packets_per_byte', 'retransmissions'):
+            entry[metric] = round(statistics.median(run[metric] for run in done), 5) if done else None
+        summary.append(entry)
+    return summary
+
+
+def parse_list(text, convert=str):
+    return [convert(item) for item in text.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mesh file transfers over a simulated LoRa channel")
+    parser.add_argument('--sizes', type=lambda text: parse_list(text, int), default=DEFAULT_SIZES,
+                        help="comma separated file sizes in bytes")
+    parser.add_argument('--profiles', type=parse_list, default=list(LOSS_PROFILES),
+                        help=f"comma separated loss profiles: {', '.join(LOSS_PROFILES)}")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per size and profile, each with its own seed")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data', choices=['random', 'text'], default='random', help="file contents")
+    parser.add_argument('--preset', default='LONG_FAST', help="LoRa modem preset the radios use")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds from the end of a packet to its arrival")
+    parser.add_argument('--window', type=int, help="chunks in flight, instead of the sender's default")
+    parser.add_argument('--max-payload', type=int, help=f"largest packet payload, at most {DATA_PAYLOAD_LEN}")
+    parser.add_argument('--timeout', type=float, default=120, help="real seconds to allow each run")
+    parser.add_argument('-o', '--output', help="write the JSON here instead of stdout")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the nodes' own output")
+    options = parser.parse_args()
+
+    unknown = [profile for profile in options.profiles if profile not in LOSS_PROFILES]
+    if unknown:
+        parser.error(f"unknown loss profile: {', '.join(unknown)}")
+
+    results = []
+    for size in options.sizes:
+        for profile in options.profiles:
+            for run in range(options.repeat):
+                seed = options.seed + run
+                if options.verbose:
+                    result = run_case(size, profile, seed, options)
+                else:
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        result = run_case(size, profile, seed, options)
+                results.append(result)
+                print(f"{size:>8} bytes {profile:<8} seed {seed}: "
+                      f"{'ok' if result['completed'] and result['intact'] else 'FAILED'} "
+                      f"in {result['completion_time']:.1f}s, "
+                      f"{result['goodput']:.1f} B/s, {result['retransmissions']} retransmissions", file=sys.stderr)
+
+    report = {
+        'preset': options.preset,
+        'data': options.data,
+        'window': options.window,
+        'max_payload': options.max_payload,
+        'results': results,
+        'summary': summarize(results),
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
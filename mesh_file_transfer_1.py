@@ -1,263 +1,1321 @@
-import meshtastic
-import meshtastic.ble_interface
-from pubsub import pub
+import asyncio
 import time
 from datetime import datetime
 import os
 import base64
 import hashlib
 import json
+import math
+import mmap
+import random
+import tempfile
 import traceback
-from threading import Lock, Event
+from collections import deque
+from threading import Lock, Event, Thread
+from mesh_transport import BLETransport, backoff_delay
+from mesh_metrics import MeshMetrics
+from mesh_protocol import (parse_ack_bitmap, parse_chunk_bitmap, decode_bitmap, ranges_to_chunks, pack_frame,
+                           unpack_frame, is_binary_packet, max_chunk_size, compress_data, compress_stream, fec_encode,
+                           add_chunk_crc, chunk_crc, merkle_leaf, merkle_levels, merkle_node, parse_message,
+                           lora_airtime, lora_bitrate, TokenBucket,
+                           delta_block_size, delta_stream, DELTA_SIGNATURE, DELTA_HEADER, MSG_SIGNATURES,
+                           MSG_OFFER, MSG_HELD, MERKLE_HASH_LEN,
+                           DATA_PAYLOAD_LEN, LEGACY_CHUNK_SIZE, PRIVATE_APP_PORTNUM, REGION_DUTY_CYCLE, MAX_FEC_GROUP,
+                           FRAME_HEADER, MSG_CHUNK, MSG_ACK, MSG_NACK, FLAG_PARITY, FLAG_CRC)
+
+
+def format_duration(seconds):
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def parse_weight(value):
+    """A transfer weight as a positive finite float, or None if value is not one"""
+    try:
+        weight = float(value)
+    except (TypeError, ValueError):
+        return None
+    return weight if math.isfinite(weight) and weight > 0 else None
+
+
+class RttEstimator:
+    """Jacobson/Karels round-trip estimator (RFC 6298) with Karn's rule left to the caller.
+
+    Like QUIC's probe timeout (RFC 9002), the RTO also allows for the time the receiver holds
+    an ACK back to cover a batch of chunks, which the RTT of the newest chunk does not include.
+    """
+
+    def __init__(self, initial_rto=30.0, min_rto=1.0, max_rto=120.0):
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.backoff = 1  # Doubled on every timeout, reset by the next valid sample
+        self.ack_delay = 0.0  # How long the oldest chunk of a batch waits for its ACK beyond the newest
+
+    @property
+    def rto(self):
+        return min((self.base_rto + self.ack_delay) * self.backoff, self.max_rto)
+
+    def sample(self, rtt, ack_delay=0.0):
+        """Feed the RTT of a chunk that was transmitted exactly once, and how long the same ACK held older ones"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.base_rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        # Rises at once and decays slowly, so a batch's oldest chunk is not resent while its ACK is on the way
+        self.ack_delay = max(ack_delay, 0.875 * self.ack_delay + 0.125 * ack_delay)
+        self.backoff = 1
+
+    def timed_out(self):
+        """Back the RTO off after a retransmission timeout"""
+        self.backoff = min(self.backoff * 2, 64)
+
 
 class MeshBLEFileTransfer:
-    def __init__(self, mac_address, node_id="leaf1"):
+    def __init__(self, mac_address, node_id="leaf1", transport=None, loop=None):
         self.mac_address = mac_address
         self.node_id = node_id  # Unique identifier for this node
-        self.interface = None
+        self.transport = transport or BLETransport(mac_address)  # Radio link; a simulated one runs without hardware
         self.connected = False
-        self.chunk_size = 100  # Keeping chunk size at 100 bytes
-        self.batch_size = 1  # Sending just 1 chunk at a time
+        self.max_payload = DATA_PAYLOAD_LEN  # Largest packet payload the radio accepts
+        self.compression = 'zlib'  # Preferred codec (zlib, lzma or zstd), None to always send raw
+        self.compression_trial_size = 4096  # Bytes trial-compressed to decide whether compression pays off
+        self.min_compression_gain = 0.1  # Skip compression unless it saves at least this fraction
+        self.delta_transfers = True  # Send only the changed blocks when the receiver holds an older copy
+        self.delta_block_size = None  # Bytes per signed block up to DELTA_MAX_BLOCK; None picks one from the file size
+        self.offer_chunks = True  # Offer chunk hashes first and skip the chunks the receiver's chunk store holds
+        self.min_offer_chunks = 8  # Smaller transfers are sent without an offer
+        self.window_size = 8  # Chunks allowed in flight per transfer before waiting for ACKs
+        self.fec_group_size = 8  # Data chunks per FEC group
+        self.fec_redundancy = 0.25  # Parity chunks per data chunk, 0 to disable FEC
         self.connection_lock = Lock()
-        self.last_reconnect_time = 0
-        self.reconnect_cooldown = 5
-        self.current_file_path = None
-        self.current_file_data = None
-        self.ack_received = Event()
-        self.last_ack_batch = -1
-        self.transfer_timeout = 30  # Timeout for waiting for batch ACK
-        self.chunk_delay = 2.0  # Delay between chunks
-        self.batch_delay = 3.0  # Delay between batches (reduced since we're only sending 1 chunk)
+        self.last_reconnect_failure = None  # Loop time the last reconnect gave up
+        self.reconnect_cooldown = 5  # Seconds after a reconnect gave up before the next may start
+        self.reconnect_attempts = 6  # Attempts per reconnect; the first is made at once
+        self.reconnect_backoff = 1.0  # Seconds before the second attempt, doubled after each failure
+        self.max_reconnect_backoff = 30.0
+        self.adapter_reset_after = 3  # Failed attempts before the Bluetooth adapter is reset
+        self.keepalive_interval = 5  # Seconds between link probes, 0 to notice a lost link only when a send fails
+        self.link_up = asyncio.Event()  # Cleared while the radio is unreachable; sending and ACK timeouts pause on it
+        self.link_up.set()
+        self.read_block_size = 64 * 1024  # Block size when streaming a file through the compressor
+        self.transfers = {}  # Transfer id -> state of every queued or active transfer
+        self.transfer_queue = []  # Ids of transfers waiting for a free slot, oldest first
+        self.max_active_transfers = 3  # Transfers whose chunks are interleaved at once
+        self.scheduler_wakeup = asyncio.Event()  # Set by ACKs, NACKs and newly queued transfers
+        self.scheduler_task = None
+        self.transfer_timeout = 30  # Initial ACK timeout, until RTT samples are available
+        self.max_retries = 3  # Retransmissions allowed per chunk
+        self.initial_send_gap = 2.0  # Delay between chunks until RTT samples are available
+        self.min_send_gap = 0.1  # Shortest delay between chunks
+        self.max_send_gap = 10.0  # Longest delay between chunks
+        self.resume_timeout = 10  # How long to wait for a receiver's answer to a resume query
+        self.start_timeout = 10  # How long to wait for receivers to confirm the start message before sending it again
+        self.signature_timeout = 15  # How long to wait for each packet of the receiver's block signatures
+        self.verify_timeout = 30  # How long to wait for the receiver's verdict, restarted by each Merkle query
         self.known_nodes = {}  # Dictionary to store discovered nodes
+
+        # JSON control messages are parsed once and routed by type; new message kinds register here
+        self.handlers = {}
+        for msg_type, handler in (('ba', self.handle_ack), ('rs', self.handle_resume_state), ('nk', self.handle_nack),
+                                  ('ds', self.handle_delta_signatures), ('oh', self.handle_held_chunks),
+                                  ('mq', self.handle_merkle_query),
+                                  ('fv', self.handle_verified),
+                                  ('te', self.handle_transfer_error), ('announce', self.handle_announce),
+                                  ('discover', self.handle_discover)):
+            self.register_handler(msg_type, handler)
+
+        # Outbound budget: every packet goes through one send queue whose worker owns the radio
+        self.lora_preset = 'LONG_FAST'  # Modem preset the radio uses, None to skip airtime budgeting
+        self.region = 'US'  # Meshtastic region, sets the duty cycle limit
+        self.byte_rate = None  # Payload bytes per second, None for the preset's bit rate within the duty cycle
+        self.send_burst = 3  # Full size packets the budget lets out back to back
+        self.configure_send_budget()
+        # Airtime budget per transfer and per period, checked against each transfer's estimate before it starts
+        self.transfer_airtime_limit = None  # Seconds of airtime one transfer may use; larger ones are refused
+        # Seconds of airtime our packets may use per budget_period; later transfers wait
+        self.period_airtime_limit = None
+        self.budget_period = 3600  # Rolling period of period_airtime_limit, in seconds
+
+        # Transfers, ACK handling and timers run as tasks on an event loop in its own thread, so the
+        # radio callback thread only hands packets over and the interactive prompt never blocks
+        # A simulation passes one loop, running on a virtual clock, shared by all its nodes
+        self.tasks = set()
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, daemon=True).start()
+        self.loop = loop
+        self.send_queue = asyncio.Queue()
+        self.airtime_used = 0.0  # Seconds of airtime spent by our packets
+        self.airtime_log = deque()  # (loop time, airtime) of our packets within the last budget_period
+        asyncio.run_coroutine_threadsafe(self.run_send_queue(), self.loop)
+
+        # Counters and timings per transfer and per peer, written out for dashboards
+        self.metrics = MeshMetrics(self.node_id, 'sender', clock=self.loop.time)
+        self.status_file = f"mesh_status_{self.node_id}.json"  # JSON status, None to disable
+        self.prometheus_file = None  # Prometheus textfile, e.g. /var/lib/node_exporter/textfile_collector/mesh.prom
+        self.metrics_interval = 30  # Seconds between metrics file updates
+        asyncio.run_coroutine_threadsafe(self.run_metrics_writer(), self.loop)
+        asyncio.run_coroutine_threadsafe(self.run_keepalive(), self.loop)
         print(f"Current working directory: {os.getcwd()}")
         print(f"Node ID: {self.node_id}")
 
-    def reconnect(self):
-        with self.connection_lock:
-            current_time = time.time()
-            if current_time - self.last_reconnect_time < self.reconnect_cooldown:
+    def spawn(self, coroutine):
+        """Start a coroutine as a task on the event loop; only call from the loop thread"""
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)  # The loop only keeps weak references to running tasks
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine on the event loop from another thread and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def reconnect(self):
+        """Reopen the radio link, unless a probe shows it is still up.
+
+        The first attempt is made at once, later ones back off exponentially with jitter,
+        and the Bluetooth adapter is only reset once adapter_reset_after attempts failed.
+        """
+        if not self.connection_lock.acquire(blocking=False):
+            return False  # Another task is already reconnecting
+        try:
+            if self.last_reconnect_failure is not None and \
+                    self.loop.time() - self.last_reconnect_failure < self.reconnect_cooldown:
                 return False
+            started = self.loop.time()
+            # A failed send or a quiet spell is often a blip; tearing down a live link would cost far more
+            if await self.loop.run_in_executor(None, self.transport.probe):
+                self.connected = True
+                self.metrics.count('reconnects_avoided')
+                return True
 
-            self.last_reconnect_time = current_time
-            max_attempts = 3
-            for attempt in range(max_attempts):
+            self.connected = False
+            for attempt in range(self.reconnect_attempts):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt - 1, self.reconnect_backoff, self.max_reconnect_backoff))
+                print(f"\nReconnecting (attempt {attempt + 1}/{self.reconnect_attempts})...")
                 try:
-                    print(f"\nReconnecting (attempt {attempt + 1}/{max_attempts})...")
-                    if self.interface:
+                    try:
+                        await self.loop.run_in_executor(None, self.transport.close)
+                    except Exception:
+                        pass
+                    if attempt >= self.adapter_reset_after:
+                        print("Resetting Bluetooth adapter...")
                         try:
-                            self.interface.close()
-                        except:
-                            pass
-                    time.sleep(3)  # Longer delay before reconnection
-                    self.interface = meshtastic.ble_interface.BLEInterface(self.mac_address)
+                            await self.loop.run_in_executor(None, self.transport.reset)
+                        except Exception as e:
+                            print(f"Adapter reset failed: {e}")
+                    await self.loop.run_in_executor(None, self.transport.open, self.on_receive)
+                    await asyncio.sleep(self.transport.settle_delay)  # Let connection stabilize
                     self.connected = True
-                    print("Reconnected successfully!")
-                    time.sleep(1)  # Let connection stabilize
+                    duration = self.loop.time() - started
+                    print(f"Reconnected in {duration:.1f}s")
+                    self.metrics.count('reconnects')
+                    self.metrics.observe('reconnect_duration', duration)
                     return True
                 except Exception as e:
                     print(f"Reconnection attempt failed: {e}")
-                    time.sleep(3)
+            print(f"All reconnection attempts failed after {self.loop.time() - started:.1f}s")
+            self.last_reconnect_failure = self.loop.time()
+            self.metrics.count('reconnect_failures')
             return False
+        finally:
+            self.connection_lock.release()
 
     def connect(self):
         try:
             print(f"Connecting to T-Beam at {self.mac_address}...")
-            if self.interface:
-                try:
-                    self.interface.close()
-                except:
-                    pass
-            time.sleep(2)  # Longer delay before initial connection
-            self.interface = meshtastic.ble_interface.BLEInterface(self.mac_address)
+            try:
+                self.transport.close()
+            except Exception:
+                pass
+            time.sleep(self.transport.connect_delay)  # Longer delay before initial connection
+            self.transport.open(self.on_receive)
             self.connected = True
             print("Connected to T-Beam successfully!")
-            time.sleep(1)  # Let connection stabilize
+            time.sleep(self.transport.settle_delay)  # Let connection stabilize
             return True
         except Exception as e:
             print(f"Connection error: {e}")
             return False
 
-    def calculate_checksum(self, data):
-        return hashlib.md5(data).hexdigest()
+    async def run_keepalive(self):
+        """Probe the radio every keepalive_interval seconds and restore the link as soon as it is lost.
+
+        Without it a dead link only shows when a send fails.
+        """
+        while True:
+            await asyncio.sleep(self.keepalive_interval or 60)
+            if not self.keepalive_interval or not self.connected or not self.link_up.is_set():
+                continue
+            if not await self.loop.run_in_executor(None, self.transport.probe):
+                self.metrics.count('link_losses')
+                await self.restore_link()
+
+    async def restore_link(self):
+        """Pause transfers until the radio is reachable again, then resume them where they were"""
+        if not self.link_up.is_set():
+            await self.link_up.wait()  # Another task is already restoring it
+            return
+        print("\nRadio link lost, pausing transfers")
+        lost_at = self.loop.time()
+        self.link_up.clear()
+        try:
+            # Never give up here: transfers wait for the radio instead of timing out
+            while not await self.reconnect():
+                await asyncio.sleep(self.reconnect_cooldown)
+        finally:
+            self.resume_transfers(self.loop.time() - lost_at)
+            self.link_up.set()
+            self.scheduler_wakeup.set()
+
+    def resume_transfers(self, paused):
+        """Shift the transfers' timers past an outage, so chunks in flight do not time out and back off"""
+        print(f"Radio link back after {paused:.1f}s, resuming transfers")
+        for transfer in list(self.transfers.values()):
+            transfer['in_flight'] = {cn: sent_time + paused for cn, sent_time in transfer['in_flight'].items()}
+            transfer['last_ack_time'] += paused
+            transfer['last_verify_activity'] += paused
+            if transfer['state'] == 'sending' and transfer['in_flight'] and transfer['target'] and \
+                    self.peer_supports(transfer['target'], 'resume'):
+                self.spawn(self.resync_transfer(transfer))
+
+    async def resync_transfer(self, transfer):
+        """Ask the receiver which chunks in flight arrived, as their ACKs may have been lost with the link.
+
+        The others went out into the dead link; they are resent at once and do not count as retries.
+        """
+        pending = dict(transfer['in_flight'])
+        held = set(await self.query_resume(transfer))
+        # Chunks acknowledged or resent after a timeout while we asked are left as they are
+        pending = [cn for cn, sent_time in pending.items() if transfer['in_flight'].get(cn) == sent_time]
+        arrived = [cn for cn in pending if cn in held]
+        for chunk_number in arrived:
+            transfer['in_flight'].pop(chunk_number)  # No RTT sample: the outage delayed their ACKs
+        lost = [cn for cn in pending if cn not in held]
+        for chunk_number in lost:
+            transfer['transmissions'][chunk_number] -= 1
+        transfer['retransmit_now'].update(lost)
+        if arrived:
+            self.mark_acked(transfer, arrived)
+        self.scheduler_wakeup.set()
+
+    def map_file(self, file):
+        """Memory-map a file read-only so chunks are paged in as they are sent instead of read up front"""
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''  # Empty files cannot be mapped
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_blocks(self, data):
+        for offset in range(0, len(data), self.read_block_size):
+            yield data[offset:offset + self.read_block_size]
+
+    def read_chunk(self, transfer, chunk_number):
+        chunk_start = chunk_number * transfer['chunk_size']
+        return transfer['data'][chunk_start:chunk_start + transfer['chunk_size']]
+
+    def scan_chunks(self, transfer, merkle=False):
+        """Stream through the chunks once for the MD5 checksum and, if wanted, the Merkle leaf hashes"""
+        md5 = hashlib.md5()
+        leaves = bytearray()
+        for chunk_number in range(transfer['total_chunks']):
+            chunk = self.read_chunk(transfer, chunk_number)
+            md5.update(chunk)
+            if merkle:
+                leaves += merkle_leaf(chunk)
+        return md5.hexdigest(), leaves
+
+    def configure_send_budget(self):
+        """Size the send queue's token buckets to the LoRa preset and the region's duty cycle"""
+        duty_cycle = REGION_DUTY_CYCLE.get(self.region, 1.0)
+        byte_rate = self.byte_rate
+        if byte_rate is None and self.lora_preset:
+            byte_rate = lora_bitrate(self.lora_preset) / 8 * duty_cycle
+        self.byte_budget = TokenBucket(byte_rate, self.send_burst * DATA_PAYLOAD_LEN) if byte_rate else None
+        self.airtime_budget = None
+        if self.lora_preset:
+            # Seconds of airtime per second, so the queue never books more than the channel may carry
+            self.airtime_budget = TokenBucket(duty_cycle,
+                                              self.send_burst * lora_airtime(DATA_PAYLOAD_LEN, self.lora_preset))
+
+    def queue_depth(self):
+        """Messages waiting for the radio"""
+        return self.send_queue.qsize()
+
+    def radio_send(self, payload):
+        if isinstance(payload, bytes):
+            self.transport.send_data(payload, PRIVATE_APP_PORTNUM)
+        else:
+            self.transport.send_text(payload)
+
+    async def run_send_queue(self):
+        """Own the radio: send queued packets one at a time, waiting for the byte and airtime budgets"""
+        while True:
+            payload, done, account = await self.send_queue.get()
+            await self.link_up.wait()  # Hold packets while the link is down rather than fail them
+            try:
+                size = len(payload) if isinstance(payload, bytes) else len(payload.encode('utf-8'))
+                airtime = lora_airtime(size, self.lora_preset) if self.lora_preset else 0
+                costs = [(bucket, amount)
+                         for bucket, amount in ((self.byte_budget, size), (self.airtime_budget, airtime)) if bucket]
+                wait = max([bucket.delay(amount, self.loop.time()) for bucket, amount in costs], default=0)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                for bucket, amount in costs:
+                    bucket.take(amount, self.loop.time())
+                await self.loop.run_in_executor(None, self.radio_send, payload)
+                self.airtime_used += airtime
+                self.airtime_log.append((self.loop.time(), airtime))
+                while self.airtime_log[0][0] < self.loop.time() - self.budget_period:
+                    self.airtime_log.popleft()
+                if account in self.transfers:
+                    self.transfers[account]['airtime_spent'] += airtime
+                self.metrics.count('packets_sent', transfer=account)
+                self.metrics.count('bytes_on_air', size, transfer=account)
+                self.metrics.count('airtime_seconds', airtime, transfer=account)
+                if not done.done():
+                    done.set_result(True)
+            except Exception as e:
+                if not done.done():
+                    done.set_exception(e)
 
-    def send_message_safely(self, message, retries=3, delay=2.0):
-        """Send a message with retries and reconnection if needed"""
+    async def send_message_safely(self, message, retries=3, delay=2.0, account=None, on_sent=None):
+        """Send a message with retries and reconnection if needed.
+
+        Dict messages go out as JSON text, bytes are sent as a binary frame on the private app port.
+        The message waits its turn in the send queue; delay then paces this caller's next send.
+        Its bytes and airtime are counted against the transfer id given as account.
+        on_sent is called once the radio has taken the message, before the delay.
+        """
+        # Convert message to a compact string to reduce size
+        payload = message if isinstance(message, bytes) else json.dumps(message, separators=(',', ':'))
         for attempt in range(retries):
             try:
-                # Convert message to a compact string to reduce size
-                message_str = json.dumps(message, separators=(',', ':'))
-                self.interface.sendText(message_str)
-                time.sleep(delay)  # Wait after sending
+                done = self.loop.create_future()
+                self.send_queue.put_nowait((payload, done, account))
+                await done
+                if on_sent:
+                    on_sent()
+                await asyncio.sleep(delay)  # Wait after sending
                 return True
             except Exception as e:
                 print(f"\nError sending message (attempt {attempt + 1}): {e}")
                 if attempt < retries - 1:
-                    print("Waiting before retry...")
-                    time.sleep(3)
-                    if not self.reconnect():
-                        time.sleep(4)
+                    # Pause until the radio is back; reconnecting probes the link first and backs off by itself
+                    await self.restore_link()
         return False
 
-    def wait_for_batch_ack(self, batch_number, timeout=30):
-        """Wait for acknowledgment of a batch"""
-        self.ack_received.clear()
-        
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if self.ack_received.wait(1):  # Wait with timeout of 1 second
-                if self.last_ack_batch >= batch_number:
-                    return True
-                self.ack_received.clear()  # Clear for next wait if not our batch
-            
-        return False
+    def build_chunk_message(self, transfer, chunk_number, chunk, parity=False):
+        """Build the binary frame or JSON message that carries one data or parity chunk"""
+        if transfer['use_binary']:
+            flags = FLAG_PARITY if parity else 0
+            if transfer['use_crc']:
+                chunk = add_chunk_crc(chunk)
+                flags |= FLAG_CRC
+            return pack_frame(MSG_CHUNK, transfer['id'], chunk_number, chunk, flags)
 
-    def send_batch(self, filename, batch_number, chunk_number, total_chunks, target_node=None):
-        """Send a single chunk as a batch"""
-        print(f"\nSending chunk {chunk_number + 1}/{total_chunks}")
-        
-        chunk_start = chunk_number * self.chunk_size
-        chunk_end = min(chunk_start + self.chunk_size, len(self.current_file_data))
-        chunk = self.current_file_data[chunk_start:chunk_end]
-        chunk_b64 = base64.b64encode(chunk).decode('utf-8')
-        
-        # Send the chunk directly (no batch start/end)
         chunk_message = {
             't': 'fc',  # Shortened type
-            'f': filename,
-            'cn': chunk_number,
-            'bn': batch_number,
-            'd': chunk_b64,
+            'pn' if parity else 'cn': chunk_number,
+            'd': base64.b64encode(chunk).decode('utf-8'),
             'from': self.node_id
         }
-        
+        # Receivers with sessions know the transfer by its short id, which is cheaper than the filename
+        if transfer['use_sessions']:
+            chunk_message['id'] = transfer['id']
+        else:
+            chunk_message['f'] = transfer['filename']
+        if transfer['use_crc']:
+            chunk_message['cr'] = f"{chunk_crc(chunk):08x}"  # Fixed width so chunk sizing can account for it
+
         # Add target node if specified
-        if target_node:
-            chunk_message['to'] = target_node
+        if transfer['target']:
+            chunk_message['to'] = transfer['target']
+        return chunk_message
+
+    def choose_chunk_size(self, transfer):
+        """Pick the largest chunk that fits in one packet after framing overhead"""
+        if not self.peer_supports(transfer['target'], 'sz'):
+            return LEGACY_CHUNK_SIZE
+        # The highest chunk number can never exceed the file size, so this bounds its encoded length
+        empty_message = self.build_chunk_message(transfer, max(len(transfer['data']) - 1, 0), b'')
+        if isinstance(empty_message, dict):
+            empty_message = json.dumps(empty_message, separators=(',', ':'))
+        return max_chunk_size(empty_message, self.max_payload)
+
+    def choose_compression(self, data, target_node=None):
+        """Pick a codec the receivers support, or None when a trial compress shows no gain"""
+        if not self.compression or not data or not self.peer_supports(target_node, self.compression):
+            return None
+        trial = data[:self.compression_trial_size]
+        trial_size = len(compress_data(self.compression, trial))
+        if trial_size > len(trial) * (1 - self.min_compression_gain):
+            print(f"Skipping compression: first {len(trial)} bytes only shrink to {trial_size}")
+            return None
+        return self.compression
+
+    def send_gap(self, transfer):
+        """Delay after each chunk: spread one window over a smoothed RTT, stretched by recent loss"""
+        if transfer['rtt'].srtt is None:
+            gap = self.initial_send_gap
+        else:
+            gap = transfer['rtt'].srtt / self.window_size
+        return min(max(gap * transfer['pace_factor'], self.min_send_gap), self.max_send_gap)
+
+    async def send_chunk(self, transfer, chunk_number):
+        """Send a single chunk without waiting for its acknowledgment"""
+        chunk = self.read_chunk(transfer, chunk_number)
+        chunk_message = self.build_chunk_message(transfer, chunk_number, chunk)
+
+        print(f"Sending {transfer['filename']} chunk {chunk_number + 1}/{transfer['total_chunks']} "
+              f"({len(chunk)} bytes)")
+        transfer['in_flight'][chunk_number] = self.loop.time()  # Counts against the window while queued
+        transfer['transmissions'][chunk_number] = transfer['transmissions'].get(chunk_number, 0) + 1
+        self.metrics.count('chunks_sent', transfer=transfer['id'])
+        if transfer['transmissions'][chunk_number] > 1:
+            self.metrics.count('chunks_retried', transfer=transfer['id'])
+
+        def transmitted():
+            # The RTO runs from when the radio took the chunk, not from when it joined the send queue
+            if chunk_number in transfer['in_flight']:
+                transfer['in_flight'][chunk_number] = self.loop.time()
 
-        print(f"Sending chunk {chunk_number + 1}/{total_chunks} ({len(chunk)} bytes)")
-        if not self.send_message_safely(chunk_message, delay=self.chunk_delay):
+        if not await self.send_message_safely(chunk_message, delay=self.send_gap(transfer), account=transfer['id'],
+                                              on_sent=transmitted):
             print(f"Failed to send chunk {chunk_number + 1}")
             return False
-        
-        # Wait for chunk acknowledgment
-        if self.wait_for_batch_ack(batch_number, timeout=self.transfer_timeout):
-            print(f"Chunk {chunk_number + 1} acknowledged")
-            return True
-        else:
-            print(f"No acknowledgment received for chunk {chunk_number + 1}")
+        return True
+
+    async def send_parity(self, transfer, group):
+        """Send the FEC parity chunks for a group of data chunks; they are never acknowledged or retransmitted"""
+        first = group * transfer['fec_group']
+        last = min(first + transfer['fec_group'], transfer['total_chunks'])
+        data_chunks = [self.read_chunk(transfer, chunk_number) for chunk_number in range(first, last)]
+        parity_chunks = fec_encode(data_chunks, transfer['fec_parity'], transfer['chunk_size'])
+
+        print(f"Sending {transfer['fec_parity']} parity chunks for chunks {first + 1}-{last}")
+        for index, parity_chunk in enumerate(parity_chunks):
+            parity_message = self.build_chunk_message(transfer, group * transfer['fec_parity'] + index, parity_chunk,
+                                                      parity=True)
+            self.metrics.count('parity_sent', transfer=transfer['id'])
+            if not await self.send_message_safely(parity_message, delay=self.send_gap(transfer),
+                                                  account=transfer['id']):
+                print(f"Failed to send parity chunk {index + 1} for group {group + 1}")
+                return False
+        return True
+
+    def queue_file(self, filepath, target_node=None, weight=1):
+        """Queue a file for sending and return its transfer state without waiting for it.
+
+        Up to max_active_transfers run at once with their chunks interleaved; a transfer's
+        weight sets its share of the airtime relative to the others.
+        """
+        if not os.path.exists(filepath):
+            print(f"File not found: {filepath}")
+            return None
+        # The scheduler divides by the weight, so zero, negative or infinite weights would break the fair share
+        if parse_weight(weight) is None:
+            print(f"Invalid weight {weight}: it must be a positive number")
+            return None
+
+        transfer = {
+            'id': None,  # Also the short id carried by binary frames, assigned once queued
+            'path': filepath,
+            'filename': os.path.basename(filepath),
+            'target': target_node,
+            'weight': parse_weight(weight),
+            'state': 'queued',  # queued, preparing, sending, completing, done or failed
+            'data': b'',  # Read-only memory map of the file, or of its delta and compressed copy
+            'codec': None,
+            'delta': None,  # How the receiver rebuilds the file when only changed blocks are sent
+            'signatures': {},  # First block -> packed signatures of the receiver's copy, one entry per packet
+            'signature_info': None,  # Block size, copy size and packet count the receiver answered with
+            'signatures_received': asyncio.Event(),
+            'file_size': 0,  # Size before compression
+            'chunk_size': LEGACY_CHUNK_SIZE,
+            'total_chunks': 0,
+            'checksum': None,
+            'use_binary': False,  # Chunks and ACKs travel as binary frames
+            'use_crc': False,  # Chunks carry a CRC32
+            'use_sessions': False,  # JSON chunks name the transfer by its id instead of the filename
+            'fec_group': None,  # Data chunks per FEC group, fixed when prepared; None without FEC
+            'fec_parity': 0,  # Parity chunks per FEC group, 0 without FEC
+            'merkle_levels': None,  # Merkle tree over the chunks, when the receiver verifies it
+            'leaves': None,  # Merkle leaf hash of every chunk, when they are offered to the receiver's chunk store
+            'offers_answered': set(),  # First chunk of each offer packet the receiver answered
+            'offers_sent': 0,
+            'offer_received': asyncio.Event(),
+            'acked_chunks': set(),  # Chunks confirmed by the receiver, or by every multicast receiver
+            'started': set(),  # Receivers that confirmed the start message with an ACK
+            'start_acked': asyncio.Event(),  # Set once the receiver, or every multicast receiver, has confirmed it
+            # Multicast: receiver node id -> {'acked': chunks it confirmed, 'floor': its cumulative ACK}
+            'receivers': {},
+            'dropped_receivers': [],  # Multicast receivers given up on after they stopped confirming chunks
+            'verdicts': {},  # Multicast: receiver node id -> True once it saved the file, False if it rejected it
+            'ack_floor': 0,  # Highest cumulative ACK seen
+            'in_flight': {},  # chunk_number -> time the chunk was last sent
+            'transmissions': {},  # chunk_number -> times the chunk has been sent
+            'retransmit_now': set(),  # Chunks the receiver reported as lost or corrupt
+            'retransmit_queue': [],  # Chunks waiting to be sent again, oldest first
+            'next_chunk': 0,  # Lowest chunk never sent
+            'pending_parity': None,  # FEC group whose parity is due next
+            'rtt': RttEstimator(initial_rto=self.transfer_timeout, max_rto=2 * self.transfer_timeout),
+            'pace_factor': 1.0,  # Grows on loss, shrinks while the link is clean
+            'last_ack_time': 0,
+            'plan': None,  # Estimated airtime and duration, see plan_transfer
+            'airtime_spent': 0.0,  # Seconds of airtime this transfer's packets have used
+            'queued_at': None,  # Loop time the transfer was queued
+            'finished_at': None,  # Loop time it succeeded or failed
+            'virtual_time': 0.0,  # Chunks sent divided by weight, for sharing airtime between transfers
+            'window_done': asyncio.Event(),
+            'window_ok': False,
+            'resume_received': asyncio.Event(),
+            'resume_chunks': [],  # Chunks the receiver reported holding in its resume answer
+            'verify_received': asyncio.Event(),
+            'verify_ok': False,  # Receiver's verdict on the file
+            'last_verify_activity': 0,
+            'finished': Event(),  # Waited on from outside the event loop
+            'success': False
+        }
+        self.run_coroutine(self.enqueue_transfer(transfer))
+        return transfer
+
+    async def enqueue_transfer(self, transfer):
+        transfer_id = random.getrandbits(16)
+        while transfer_id in self.transfers:
+            transfer_id = random.getrandbits(16)
+        transfer['id'] = transfer_id
+        transfer['queued_at'] = self.loop.time()
+        self.transfers[transfer_id] = transfer
+        self.transfer_queue.append(transfer_id)
+        print(f"Queued transfer {transfer_id}: {transfer['filename']} -> {transfer['target'] or 'all nodes'} "
+              f"(weight {transfer['weight']})")
+        if self.scheduler_task is None:
+            self.scheduler_task = self.spawn(self.run_scheduler())
+        self.scheduler_wakeup.set()
+
+    def send_file(self, filepath, target_node=None, weight=1):
+        """Queue a file and wait until its transfer has finished"""
+        transfer = self.queue_file(filepath, target_node, weight)
+        if not transfer:
             return False
+        transfer['finished'].wait()
+        return transfer['success']
 
-    def send_file(self, filepath, target_node=None):
-        try:
-            if not os.path.exists(filepath):
-                print(f"File not found: {filepath}")
+    def admit_transfers(self):
+        """Start queued transfers while there are free slots"""
+        # A transfer deferred for lack of airtime budget gives its slot to the next one
+        active = [t for t in list(self.transfers.values())
+                  if t['state'] not in ('queued', 'deferred', 'done', 'failed')]
+        while self.transfer_queue and len(active) < self.max_active_transfers:
+            transfer = self.transfers[self.transfer_queue.pop(0)]
+            transfer['state'] = 'preparing'
+            active.append(transfer)
+            self.spawn(self.run_transfer(transfer))
+
+    async def run_scheduler(self):
+        """Interleave the chunks of every active transfer on the radio.
+
+        Each pass sends for the ready transfer with the lowest virtual time (chunks sent
+        divided by weight), so transfers share the airtime in proportion to their weights
+        and the time one spends waiting for ACKs is used by the others.
+        """
+        while True:
+            try:
+                # While the link is down nothing is sent and no chunk times out
+                await self.link_up.wait()
+                self.scheduler_wakeup.clear()
+                self.admit_transfers()
+                ready = [t for t in list(self.transfers.values()) if t['state'] == 'sending' and self.poll_transfer(t)]
+                if ready:
+                    await self.send_next(min(ready, key=lambda t: t['virtual_time']))
+                    continue
+                try:
+                    await asyncio.wait_for(self.scheduler_wakeup.wait(), self.scheduler_wait())
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                print(f"\nError in transfer scheduler: {e}")
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    def scheduler_wait(self):
+        """Sleep until an ACK arrives or the oldest chunk in flight is due for retransmission"""
+        wait_time = 1.0
+        for transfer in list(self.transfers.values()):
+            if transfer['state'] == 'sending' and transfer['in_flight']:
+                oldest = min(transfer['in_flight'].values())
+                wait_time = min(wait_time, oldest + transfer['rtt'].rto - self.loop.time())
+        return max(wait_time, 0.1)
+
+    def poll_transfer(self, transfer):
+        """Queue a transfer's timed-out chunks for retransmission and report whether it has anything to send"""
+        if len(transfer['acked_chunks']) >= transfer['total_chunks']:
+            self.finish_window(transfer, True)
+            return False
+        now = self.loop.time()
+        rto = transfer['rtt'].rto
+        queued = set(transfer['retransmit_queue'])
+        timed_out = sorted(cn for cn, sent_time in transfer['in_flight'].items()
+                           if now - sent_time >= rto and cn not in queued)
+        nacked = sorted(transfer['retransmit_now'] - queued - set(timed_out))
+        transfer['retransmit_now'] = set()
+        # No ACK at all since the oldest timed-out chunk went out means the link went quiet
+        silent = bool(timed_out) and transfer['last_ack_time'] < min(transfer['in_flight'][cn] for cn in timed_out)
+        transfer['retransmit_queue'] = [cn for cn in transfer['retransmit_queue'] + timed_out + nacked
+                                        if cn not in transfer['acked_chunks']]
+        # Skip chunks a resumed receiver holds and chunks already in flight
+        while transfer['next_chunk'] < transfer['total_chunks'] and \
+                (transfer['next_chunk'] in transfer['acked_chunks'] or transfer['next_chunk'] in transfer['in_flight']):
+            transfer['next_chunk'] += 1
+        if transfer['retransmit_queue'] and \
+                transfer['transmissions'].get(transfer['retransmit_queue'][0], 1) > self.max_retries and \
+                self.drop_silent_receivers(transfer, transfer['retransmit_queue'][0]):
+            transfer['retransmit_queue'] = [cn for cn in transfer['retransmit_queue']
+                                            if cn not in transfer['acked_chunks']]
+        if transfer['retransmit_queue'] and \
+                transfer['transmissions'].get(transfer['retransmit_queue'][0], 1) > self.max_retries:
+            print(f"Failed to send chunk {transfer['retransmit_queue'][0] + 1} after {self.max_retries} retries")
+            self.finish_window(transfer, False)
+            return False
+        ready = bool(transfer['retransmit_queue']) or transfer['pending_parity'] is not None or \
+            (transfer['next_chunk'] < transfer['total_chunks'] and len(transfer['in_flight']) < self.window_size)
+
+        if timed_out:
+            # Loss: send slower; if the link went quiet, also back off the RTO
+            transfer['pace_factor'] = min(transfer['pace_factor'] * 2, 8.0)
+            if silent:
+                transfer['rtt'].timed_out()
+            print(f"ACK timeout after {rto:.1f}s on {transfer['filename']}, backing off "
+                  f"(next RTO {transfer['rtt'].rto:.1f}s, send gap {self.send_gap(transfer):.2f}s)")
+        return ready
+
+    def drop_silent_receivers(self, transfer, chunk_number):
+        """Give up on the multicast receivers still missing a chunk after every retry, so the rest can finish.
+
+        Returns False when there is nobody left who confirmed the chunk, so the transfer has to fail.
+        """
+        missing = [node_id for node_id, peer in transfer['receivers'].items() if chunk_number not in peer['acked']]
+        if not missing or len(missing) == len(transfer['receivers']):
+            return False
+        for node_id in missing:
+            print(f"Receiver {node_id} stopped confirming {transfer['filename']} at chunk {chunk_number + 1}, "
+                  f"dropping it")
+            del transfer['receivers'][node_id]
+            transfer['dropped_receivers'].append(node_id)
+        # Chunks only the dropped receivers were missing are now complete; no RTT sample, they waited on a retry
+        for cn in range(transfer['total_chunks']):
+            if cn not in transfer['acked_chunks'] and \
+                    all(cn in peer['acked'] for peer in transfer['receivers'].values()):
+                transfer['acked_chunks'].add(cn)
+                transfer['in_flight'].pop(cn, None)
+        return True
+
+    def finish_window(self, transfer, ok):
+        """Hand a transfer whose chunks are all acknowledged, or which failed, back to its own task"""
+        transfer['window_ok'] = ok
+        transfer['state'] = 'completing'
+        transfer['window_done'].set()
+
+    async def send_next(self, transfer):
+        """Send a transfer's next retransmission, parity group or new chunk, in that order"""
+        if transfer['retransmit_queue']:
+            action, number = 'retransmit', transfer['retransmit_queue'].pop(0)
+            retries = transfer['transmissions'].get(number, 1)
+        elif transfer['pending_parity'] is not None:
+            action, number = 'parity', transfer['pending_parity']
+            transfer['pending_parity'] = None
+        else:
+            action, number = 'chunk', transfer['next_chunk']
+
+        if action == 'retransmit':
+            print(f"No acknowledgment for chunk {number + 1}, retransmitting ({retries}/{self.max_retries})...")
+            ok = await self.send_chunk(transfer, number)
+            cost = 1
+        elif action == 'parity':
+            ok = await self.send_parity(transfer, number)
+            cost = transfer['fec_parity']
+        else:
+            ok = await self.send_chunk(transfer, number)
+            cost = 1
+            transfer['next_chunk'] = number + 1
+            while transfer['next_chunk'] < transfer['total_chunks'] and \
+                    transfer['next_chunk'] in transfer['acked_chunks']:
+                transfer['next_chunk'] += 1
+            # Close each FEC group with its parity chunks once we move past it
+            if transfer['fec_parity']:
+                group = number // transfer['fec_group']
+                if transfer['next_chunk'] == transfer['total_chunks'] or \
+                        transfer['next_chunk'] // transfer['fec_group'] != group:
+                    transfer['pending_parity'] = group
+        transfer['virtual_time'] += cost / transfer['weight']
+        if not ok:
+            self.finish_window(transfer, False)
+
+    def prepare_delta(self, transfer):
+        """Replace the mapped file with its delta against the receiver's copy, if that is smaller"""
+        info = transfer['signature_info']
+        signatures = {}
+        size = DELTA_SIGNATURE.size
+        for first_block, packed in transfer['signatures'].items():
+            for index in range(len(packed) // size):
+                signatures[first_block + index] = packed[index * size:(index + 1) * size]
+        if not signatures:
+            return
+        file_size = transfer['file_size']
+        with tempfile.TemporaryFile() as spool:
+            for block in delta_stream(transfer['data'], signatures, info['block_size'], info['basis_size']):
+                spool.write(block)
+            spool.flush()
+            if spool.tell() >= file_size:
+                print("The receiver's copy has too little in common with this file, sending it whole")
+                return
+            print(f"Delta against the receiver's copy: {file_size} -> {spool.tell()} bytes")
+            transfer['delta'] = {
+                'block_size': info['block_size'],
+                'basis_size': info['basis_size'],
+                'length': spool.tell(),  # Bytes of copy and literal instructions
+                'size': file_size,
+                'checksum': hashlib.md5(transfer['data']).hexdigest(),  # Checked on the rebuilt file
+            }
+            transfer['data'].close()
+            transfer['data'] = self.map_file(spool)
+
+    def prepare_transfer(self, transfer):
+        """Map, delta encode and compress the file, then settle the wire format, chunk size, FEC and checksum"""
+        target_node = transfer['target']
+        file_size = os.path.getsize(transfer['path'])
+        transfer['file_size'] = file_size
+        print(f"File size: {file_size} bytes")
+
+        with open(transfer['path'], 'rb') as file:
+            transfer['data'] = self.map_file(file)
+        if transfer['signatures'] and file_size:
+            self.prepare_delta(transfer)
+
+        # Compress before chunking; the checksum and chunk numbers cover the compressed bytes.
+        # The compressed copy is spooled to a temporary file and mapped like the original.
+        codec = self.choose_compression(transfer['data'], target_node)
+        if codec:
+            with tempfile.TemporaryFile() as spool:
+                for block in compress_stream(codec, self.iter_blocks(transfer['data'])):
+                    spool.write(block)
+                spool.flush()
+                if spool.tell() < len(transfer['data']):
+                    print(f"Compressed with {codec}: {len(transfer['data'])} -> {spool.tell()} bytes")
+                    transfer['data'].close()
+                    transfer['data'] = self.map_file(spool)
+                else:
+                    codec = None
+        transfer['codec'] = codec
+
+        # Binary frames only if every receiver we are sending to has announced support for them
+        transfer['use_binary'] = self.peer_supports(target_node, 'bin')
+        transfer['use_crc'] = self.peer_supports(target_node, 'crc')
+        transfer['use_sessions'] = self.peer_supports(target_node, 'sess')
+        transfer['chunk_size'] = self.choose_chunk_size(transfer)
+        transfer['total_chunks'] = (len(transfer['data']) + transfer['chunk_size'] - 1) // transfer['chunk_size']
+        if self.fec_redundancy > 0 and self.peer_supports(target_node, 'fec'):
+            # The group size is announced in the start message, so later config changes leave this transfer alone
+            transfer['fec_group'] = min(self.fec_group_size, MAX_FEC_GROUP)
+            transfer['fec_parity'] = min(math.ceil(transfer['fec_group'] * self.fec_redundancy), MAX_FEC_GROUP)
+        # A receiver that checks a Merkle root can point at corrupt chunks instead of failing the whole file
+        verify = bool(target_node) and self.peer_supports(target_node, 'merkle')
+        # A receiver with a chunk store is offered the hashes of the chunks before they are sent
+        offer = self.offer_chunks and bool(target_node) and self.peer_supports(target_node, 'store') and \
+            transfer['total_chunks'] >= self.min_offer_chunks
+        transfer['checksum'], leaves = self.scan_chunks(transfer, merkle=verify or offer)
+        if verify:
+            transfer['merkle_levels'] = merkle_levels(leaves)
+        if offer:
+            transfer['leaves'] = leaves
+
+        print(f"Wire format: {'binary frames' if transfer['use_binary'] else 'JSON text'}")
+        print(f"Total chunks to send: {transfer['total_chunks']}")
+        print(f"Chunk size: {transfer['chunk_size']} bytes")
+        print(f"File checksum: {transfer['checksum']}")
+        print(f"Sending up to {self.window_size} chunks in flight")
+        if transfer['fec_parity']:
+            print(f"FEC: {transfer['fec_parity']} parity chunks per {transfer['fec_group']} data chunks")
+
+        if target_node:
+            print(f"Targeting specific node: {target_node}")
+        else:
+            print("Broadcasting to all nodes")
+            # Wait for every receiver we know of, so one fast receiver cannot hide the losses of the others;
+            # chunks are still broadcast, so one retransmission repairs every receiver that missed it
+            transfer['receivers'] = {node_id: {'acked': set(), 'floor': 0}
+                                     for node_id, info in list(self.known_nodes.items()) if info['role'] == 'receiver'}
+            if transfer['receivers']:
+                print(f"Multicast: waiting for {', '.join(sorted(transfer['receivers']))} to confirm each chunk")
+
+    def packet_length(self, message):
+        """Bytes a message occupies in a packet payload, as send_message_safely encodes it"""
+        if isinstance(message, bytes):
+            return len(message)
+        return len(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+    def plan_transfer(self, transfer):
+        """Estimate the airtime a transfer will use and how long it takes on a loss-free channel.
+
+        Covers the chunks still to send, their FEC parity, the start and completion messages
+        and the receiver's ACKs, which share the channel. Returns None without a LoRa preset.
+        """
+        if not self.lora_preset:
+            return None
+        chunks = transfer['total_chunks'] - len(transfer['acked_chunks'])
+        parity = 0
+        if chunks and transfer['fec_parity']:
+            parity = math.ceil(chunks / transfer['fec_group']) * transfer['fec_parity']
+        chunk_length = self.packet_length(self.build_chunk_message(
+            transfer, max(transfer['total_chunks'] - 1, 0), bytes(transfer['chunk_size'])))
+        acks = math.ceil(chunks / self.window_size) + 1
+        if transfer['use_binary']:
+            ack_length = FRAME_HEADER.size + 1
+        else:
+            ack_length = self.packet_length({'t': 'ba', 'f': transfer['filename'], 'ca': transfer['total_chunks'],
+                                             'bm': 'AA==', 'from': transfer['target'] or 'receiver', 'to': self.node_id,
+                                             'id': transfer['id']})
+        # Start and completion, at most a full packet each
+        control = 2 * lora_airtime(DATA_PAYLOAD_LEN, self.lora_preset)
+        airtime = (chunks + parity) * lora_airtime(chunk_length, self.lora_preset) + control
+        ack_airtime = acks * lora_airtime(ack_length, self.lora_preset) * max(len(transfer['receivers']), 1)
+
+        # Our own packets are held to the duty cycle and byte budget; the channel carries the ACKs as well
+        duration = airtime + ack_airtime
+        duty_cycle = REGION_DUTY_CYCLE.get(self.region, 1.0)
+        duration = max(duration, airtime / duty_cycle)
+        if self.byte_budget:
+            duration = max(duration, (chunks + parity) * chunk_length / self.byte_budget.rate)
+        plan = {'packets': chunks + parity + 2, 'airtime': airtime, 'ack_airtime': ack_airtime, 'duration': duration}
+        print(f"Estimated airtime for {transfer['filename']}: {plan['packets']} packets, {airtime:.1f}s on air "
+              f"plus {ack_airtime:.1f}s of ACKs on {self.lora_preset}; ETA {format_duration(duration)} without loss")
+        return plan
+
+    def airtime_in_period(self):
+        """Seconds of airtime our packets used within the last budget_period"""
+        start = self.loop.time() - self.budget_period
+        return sum(airtime for sent_at, airtime in list(self.airtime_log) if sent_at >= start)
+
+    def airtime_budget_wait(self, transfer):
+        """Seconds until the transfer's estimated airtime fits the budgets, 0 if it fits now, None if it never will"""
+        plan = transfer['plan']
+        if not plan:
+            return 0
+        if self.transfer_airtime_limit and plan['airtime'] > self.transfer_airtime_limit:
+            return None
+        if not self.period_airtime_limit:
+            return 0
+        if plan['airtime'] > self.period_airtime_limit:
+            return None
+        # Transfers already on the air will still spend what is left of their own estimates
+        reserved = sum(max(t['plan']['airtime'] - t['airtime_spent'], 0) for t in list(self.transfers.values())
+                       if t is not transfer and t['plan'] and t['state'] in ('sending', 'completing'))
+        excess = self.airtime_in_period() + reserved + plan['airtime'] - self.period_airtime_limit
+        if excess <= 0:
+            return 0
+        # Wait for enough of the airtime already spent to age out of the period
+        freed = 0.0
+        start = self.loop.time() - self.budget_period
+        for sent_at, airtime in list(self.airtime_log):
+            if sent_at < start:
+                continue
+            freed += airtime
+            if freed >= excess:
+                return max(sent_at + self.budget_period - self.loop.time(), 1.0)
+        return min(60.0, self.budget_period)  # Held by other transfers' estimates; look again once they progress
+
+    async def wait_for_airtime_budget(self, transfer):
+        """Refuse a transfer that exceeds the airtime limits outright, defer one that only has to wait"""
+        while True:
+            wait = self.airtime_budget_wait(transfer)
+            if wait is None:
+                print(f"Refusing {transfer['filename']}: needs about {transfer['plan']['airtime']:.0f}s of airtime, "
+                      f"more than the limit of {self.transfer_airtime_limit or self.period_airtime_limit:.0f}s")
                 return False
+            if wait == 0:
+                transfer['state'] = 'preparing'
+                return True
+            if transfer['state'] != 'deferred':
+                print(f"Deferring {transfer['filename']}: the airtime budget of {self.period_airtime_limit:.0f}s "
+                      f"per {format_duration(self.budget_period)} is used up, retrying in {format_duration(wait)}")
+                transfer['state'] = 'deferred'
+                self.scheduler_wakeup.set()  # Let the next queued transfer have the slot
+            await asyncio.sleep(wait)
 
-            self.current_file_path = filepath
-            file_size = os.path.getsize(filepath)
-            print(f"File size: {file_size} bytes")
+    async def query_signatures(self, transfer):
+        """Ask the receiver for the block signatures of its copy of the file, for a delta transfer"""
+        file_size = os.path.getsize(transfer['path'])
+        block_size = self.delta_block_size or delta_block_size(file_size)
+        signature_query = {
+            't': 'dq',  # Delta query
+            'f': transfer['filename'],
+            'k': block_size,
+            # Signatures only pay off while they cost well under the file itself
+            'mp': max(file_size // (4 * DATA_PAYLOAD_LEN), 1),
+            'id': transfer['id'],
+            'from': self.node_id,
+            'to': transfer['target']
+        }
+        if self.peer_supports(transfer['target'], 'bin'):
+            signature_query['bf'] = 1  # Answer in binary frames, which fit three times the signatures
+        transfer['signatures_received'].clear()
+        transfer['signatures'] = {}
+        transfer['signature_info'] = None
+        # Ask again while packets are missing; the answers are split the same way, so they merge
+        for attempt in range(self.max_retries):
+            if not await self.send_message_safely(signature_query, delay=self.send_gap(transfer),
+                                                  account=transfer['id']):
+                return
+            held = -1
+            while not transfer['signatures_received'].is_set() and len(transfer['signatures']) > held:
+                held = len(transfer['signatures'])
+                try:
+                    await asyncio.wait_for(transfer['signatures_received'].wait(), self.signature_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if transfer['signatures_received'].is_set():
+                break
+        info = transfer['signature_info']
+        if not info:
+            print("No answer to delta query, sending the whole file")
+        elif not info['parts']:
+            print("Receiver has no usable copy of this file, sending it whole")
+        elif len(transfer['signatures']) < info['parts']:
+            # Blocks whose signatures were lost are simply sent as literals
+            print(f"Received {len(transfer['signatures'])}/{info['parts']} signature packets")
 
-            with open(filepath, 'rb') as file:
-                self.current_file_data = file.read()
+    async def query_resume(self, transfer):
+        """Ask the receiver which chunks of this exact file it already holds"""
+        resume_query = {
+            't': 'rq',  # Resume query
+            'f': transfer['filename'],
+            'cs': transfer['checksum'],
+            'sz': transfer['chunk_size'],
+            'tc': transfer['total_chunks'],
+            'id': transfer['id'],
+            'from': self.node_id,
+            'to': transfer['target']
+        }
+        transfer['resume_received'].clear()
+        transfer['resume_chunks'] = []
+        if not await self.send_message_safely(resume_query, delay=self.send_gap(transfer), account=transfer['id']):
+            return []
+        try:
+            await asyncio.wait_for(transfer['resume_received'].wait(), self.resume_timeout)
+        except asyncio.TimeoutError:
+            print("No answer to resume query, sending the whole file")
+            return []
+        return [cn for cn in transfer['resume_chunks'] if 0 <= cn < transfer['total_chunks']]
 
-            filename = os.path.basename(filepath)
-            total_chunks = (len(self.current_file_data) + self.chunk_size - 1) // self.chunk_size
-            file_checksum = self.calculate_checksum(self.current_file_data)
+    async def offer_held_chunks(self, transfer):
+        """Send the leaf hashes of the chunks still to send, so the receiver can take them from its chunk store.
 
-            print(f"Total chunks to send: {total_chunks}")
-            print(f"Chunk size: {self.chunk_size} bytes")
-            print(f"File checksum: {file_checksum}")
-            print(f"Sending 1 chunk at a time")
-            
-            if target_node:
-                print(f"Targeting specific node: {target_node}")
+        Each packet offers a run of consecutive chunks and is answered with the ones the
+        receiver holds, which then count as acknowledged.
+        """
+        total_chunks = transfer['total_chunks']
+        offer = {
+            't': 'co',  # Chunk offer
+            'f': transfer['filename'],
+            'id': transfer['id'],
+            'cn': total_chunks,  # Widest value the field can take, to size the packets
+            'h': '',
+            'from': self.node_id,
+            'to': transfer['target']
+        }
+        if transfer['use_binary']:
+            per_packet = (self.max_payload - FRAME_HEADER.size) // MERKLE_HASH_LEN
+        else:
+            per_packet = max_chunk_size(json.dumps(offer, separators=(',', ':')), self.max_payload) // MERKLE_HASH_LEN
+        firsts = [first for first in range(0, total_chunks, per_packet)
+                  if any(cn not in transfer['acked_chunks']
+                         for cn in range(first, min(first + per_packet, total_chunks)))]
+        transfer['offers_answered'] = set()
+        transfer['offers_sent'] = len(firsts)
+        transfer['offer_received'].clear()
+        print(f"Offering {total_chunks} chunk hashes in {len(firsts)} packets")
+        for first in firsts:
+            hashes = bytes(transfer['leaves'][first * MERKLE_HASH_LEN:(first + per_packet) * MERKLE_HASH_LEN])
+            if transfer['use_binary']:
+                message = pack_frame(MSG_OFFER, transfer['id'], first, hashes)
             else:
-                print("Broadcasting to all nodes")
-
-            # Send file start message
-            start_message = {
-                't': 'fs',  # Shortened type
-                'f': filename,
-                'tc': total_chunks,
-                'fs': len(self.current_file_data),
-                'cs': file_checksum,
-                'bs': self.batch_size,
-                'from': self.node_id
-            }
-            
-            # Add target node if specified
-            if target_node:
-                start_message['to'] = target_node
-                
-            if not self.send_message_safely(start_message, delay=4.0):
+                message = dict(offer, cn=first, h=base64.b64encode(hashes).decode('utf-8'))
+            if not await self.send_message_safely(message, delay=self.send_gap(transfer), account=transfer['id']):
+                return
+        # Keep waiting while answers come in; offers left unanswered are simply sent as chunks
+        answered = -1
+        while not transfer['offer_received'].is_set() and len(transfer['offers_answered']) > answered:
+            answered = len(transfer['offers_answered'])
+            try:
+                await asyncio.wait_for(transfer['offer_received'].wait(), self.resume_timeout)
+            except asyncio.TimeoutError:
+                pass
+        if len(transfer['offers_answered']) < len(firsts):
+            print(f"Receiver answered {len(transfer['offers_answered'])}/{len(firsts)} offer packets")
+
+    async def send_start(self, transfer):
+        """Announce the file so receivers can prepare for its chunks"""
+        start_message = {
+            't': 'fs',  # Shortened type
+            'f': transfer['filename'],
+            'tc': transfer['total_chunks'],
+            'fs': len(transfer['data']),
+            'cs': transfer['checksum'],
+            'bs': self.window_size,  # Advertise the window size
+            'sz': transfer['chunk_size'],
+            'id': transfer['id'],  # Keys the receiver's session for this transfer
+            'from': self.node_id
+        }
+        if transfer['fec_parity']:
+            start_message['fm'] = transfer['fec_group']  # Data chunks per FEC group
+            start_message['fk'] = transfer['fec_parity']  # Parity chunks per FEC group
+        if transfer['codec']:
+            start_message['cc'] = transfer['codec']  # Compression codec
+            # Uncompressed size
+            start_message['us'] = transfer['delta']['length'] if transfer['delta'] else transfer['file_size']
+        if transfer['delta']:
+            start_message['dk'] = transfer['delta']['block_size']  # Rebuild from the signed copy in blocks this size
+        if transfer['use_binary']:
+            start_message['wf'] = 'b'  # Chunks and ACKs travel as binary frames
+        if transfer['merkle_levels']:
+            start_message['mr'] = transfer['merkle_levels'][-1].hex()  # Merkle root over the chunks
+
+        # Add target node if specified
+        if transfer['target']:
+            start_message['to'] = transfer['target']
+
+        if not self.peer_supports(transfer['target'], 'start'):
+            # Older receivers do not confirm the start message
+            if not await self.send_message_safely(start_message, delay=self.send_gap(transfer), account=transfer['id']):
                 print("Failed to send start message")
                 return False
+            return True
 
-            print(f"\nStarting file transfer: {filename}")
-            time.sleep(5)  # Longer wait for start message to be processed
-
-            # Send chunks one at a time
-            success = True
-            max_retries = 3
-            
-            for chunk_number in range(total_chunks):
-                # Try to send this chunk with retries
-                chunk_success = False
-                for retry in range(max_retries):
-                    if self.send_batch(filename, chunk_number, chunk_number, total_chunks, target_node):
-                        chunk_success = True
-                        break
-                    else:
-                        print(f"Chunk {chunk_number + 1} failed, retrying ({retry + 1}/{max_retries})...")
-                        # Reconnect before retry
-                        if not self.reconnect():
-                            time.sleep(4)
-                        time.sleep(3)  # Wait before retry
-                
-                if not chunk_success:
-                    print(f"Failed to send chunk {chunk_number + 1} after {max_retries} attempts")
-                    success = False
-                    break
-                
-                # Take a short break between chunks
-                time.sleep(self.batch_delay)
-                
-                # Progress update
-                progress = ((chunk_number + 1) / total_chunks) * 100
-                print(f"Overall progress: {progress:.1f}%")
-
-            # Send completion message
-            if success:
-                completion_message = {
-                    't': 'fc',  # Shortened type (file completion)
-                    'f': filename,
-                    'cs': file_checksum,
-                    'tc': total_chunks,
-                    'from': self.node_id
-                }
-                
-                # Add target node if specified
-                if target_node:
-                    completion_message['to'] = target_node
-                    
-                if not self.send_message_safely(completion_message, delay=4.0):
-                    print("Failed to send completion message")
+        # A receiver that missed the start message has no session and would drop every chunk
+        for attempt in range(self.max_retries + 1):
+            if not await self.send_message_safely(start_message, delay=self.send_gap(transfer), account=transfer['id']):
+                print("Failed to send start message")
+                return False
+            try:
+                await asyncio.wait_for(transfer['start_acked'].wait(), self.start_timeout)
+                return True
+            except asyncio.TimeoutError:
+                print("Start message not confirmed, sending it again")
+        if transfer['receivers']:
+            # Multicast receivers that stay silent are dropped once they miss every retry of a chunk
+            missing = [node_id for node_id in transfer['receivers'] if node_id not in transfer['started']]
+            print(f"No start confirmation from {', '.join(missing)}, sending anyway")
+            return True
+        print("Receiver never confirmed the start message")
+        return False
+
+    async def send_completion(self, transfer):
+        completion_message = {
+            't': 'fc',  # Shortened type (file completion)
+            'f': transfer['filename'],
+            'cs': transfer['checksum'],
+            'tc': transfer['total_chunks'],
+            'id': transfer['id'],
+            'from': self.node_id
+        }
+        # The start message has no room left for the rebuilt file's checksum
+        if transfer['delta']:
+            completion_message['dm'] = transfer['delta']['checksum']
+            completion_message['dn'] = transfer['delta']['size']
+
+        # Add target node if specified
+        if transfer['target']:
+            completion_message['to'] = transfer['target']
+
+        if not await self.send_message_safely(completion_message, delay=self.send_gap(transfer),
+                                              account=transfer['id']):
+            print("Failed to send completion message")
+            return False
+        return True
+
+    async def send_window(self, transfer):
+        """Let the scheduler send the transfer's outstanding chunks and wait until all are acknowledged"""
+        transfer['window_done'].clear()
+        transfer['state'] = 'sending'
+        self.scheduler_wakeup.set()
+        await transfer['window_done'].wait()
+        return transfer['window_ok']
+
+    async def await_verification(self, transfer):
+        """Send the completion message and wait for the receiver to check the Merkle root.
+
+        A receiver that finds corrupt chunks NACKs them, which un-acknowledges them here;
+        those chunks are resent and the receiver is asked to verify again.
+        """
+        for attempt in range(self.max_retries + 1):
+            transfer['verify_received'].clear()
+            if not await self.send_completion(transfer):
+                return False
+            transfer['last_verify_activity'] = self.loop.time()
+            repair = False
+            while not repair and self.loop.time() - transfer['last_verify_activity'] < self.verify_timeout:
+                try:
+                    await asyncio.wait_for(transfer['verify_received'].wait(), 0.5)
+                    print("Receiver verified the file" if transfer['verify_ok'] else "Receiver rejected the file")
+                    return transfer['verify_ok']
+                except asyncio.TimeoutError:
+                    pass
+                await self.link_up.wait()  # The verdict cannot arrive while the link is down
+                repair = len(transfer['acked_chunks']) < transfer['total_chunks']
+            if repair:
+                print("Receiver found corrupt chunks, resending them")
+                if not await self.send_window(transfer):
                     return False
+            else:
+                print("No verdict from receiver, resending completion message")
+        print("Receiver never confirmed the file")
+        return False
+
+    async def await_verdicts(self, transfer):
+        """Send the completion message until every multicast receiver has saved or rejected the file.
+
+        One lost completion message would otherwise leave a receiver that holds every chunk
+        without the file. Receivers that reject the file or never answer are dropped; the
+        transfer succeeds if any receiver saved it.
+        """
+        for attempt in range(self.max_retries + 1):
+            transfer['verify_received'].clear()
+            if not await self.send_completion(transfer):
+                return False
+            transfer['last_verify_activity'] = self.loop.time()
+            waiting = [node_id for node_id in transfer['receivers'] if node_id not in transfer['verdicts']]
+            while waiting and self.loop.time() - transfer['last_verify_activity'] < self.verify_timeout:
+                try:
+                    await asyncio.wait_for(transfer['verify_received'].wait(), 0.5)
+                    transfer['verify_received'].clear()
+                except asyncio.TimeoutError:
+                    pass
+                await self.link_up.wait()  # The verdicts cannot arrive while the link is down
+                waiting = [node_id for node_id in transfer['receivers'] if node_id not in transfer['verdicts']]
+            if not waiting:
+                break
+            print(f"No verdict from {', '.join(waiting)}, resending completion message")
+
+        for node_id in list(transfer['receivers']):
+            if not transfer['verdicts'].get(node_id):
+                outcome = 'rejected' if node_id in transfer['verdicts'] else 'never confirmed'
+                print(f"Receiver {node_id} {outcome} {transfer['filename']}, dropping it")
+                del transfer['receivers'][node_id]
+                transfer['dropped_receivers'].append(node_id)
+        return bool(transfer['receivers'])
+
+    async def answer_merkle_query(self, transfer, nodes, requester=None):
+        """Send the Merkle tree hashes a receiver asked for while narrowing down corrupt chunks"""
+        transfer['last_verify_activity'] = self.loop.time()
+        levels = transfer['merkle_levels']
+        answer = {
+            't': 'mh',  # Merkle hashes
+            'f': transfer['filename'],
+            'id': transfer['id'],
+            'n': [[level, index, merkle_node(levels, level, index).hex()] for level, index in nodes
+                  if merkle_node(levels, level, index)],
+            'from': self.node_id
+        }
+        if requester:
+            answer['to'] = requester
+        # Keep the answer within one packet; the receiver asks again for nodes left out
+        while len(answer['n']) > 1 and len(json.dumps(answer, separators=(',', ':'))) > self.max_payload:
+            answer['n'].pop()
+        return await self.send_message_safely(answer, delay=self.send_gap(transfer))
+
+    async def run_transfer(self, transfer):
+        """Carry one transfer from start message to completion; the scheduler sends its chunks"""
+        filename = transfer['filename']
+        try:
+            # Only a single receiver's copy can serve as the basis of a delta
+            if self.delta_transfers and transfer['target'] and self.peer_supports(transfer['target'], 'delta'):
+                await self.query_signatures(transfer)
 
+            # Mapping, compressing and hashing the file would stall the loop, so it runs in a worker thread
+            await self.loop.run_in_executor(None, self.prepare_transfer, transfer)
+            self.metrics.start_transfer(transfer['id'], filename, transfer['target'], transfer['file_size'])
+
+            # A receiver that kept a journal of an earlier attempt only needs the missing chunks
+            if transfer['target'] and self.peer_supports(transfer['target'], 'resume'):
+                held_chunks = await self.query_resume(transfer)
+                if held_chunks:
+                    print(f"Resuming: receiver already holds {len(held_chunks)}/{transfer['total_chunks']} chunks")
+                    transfer['acked_chunks'].update(held_chunks)
+
+            transfer['plan'] = self.plan_transfer(transfer)
+            if not await self.wait_for_airtime_budget(transfer):
+                return
+
+            if not await self.send_start(transfer):
+                return
+
+            if transfer['leaves'] is not None:
+                await self.offer_held_chunks(transfer)
+                if transfer['acked_chunks']:
+                    print(f"Receiver holds {len(transfer['acked_chunks'])}/{transfer['total_chunks']} chunks")
+
+            print(f"\nStarting file transfer: {filename}")
+
+            # Join the others at the current share so a new transfer does not get a burst of catch-up airtime
+            sending = [t['virtual_time'] for t in list(self.transfers.values()) if t['state'] == 'sending']
+            transfer['virtual_time'] = min(sending, default=0.0)
+            success = await self.send_window(transfer)
+
+            # Send completion message, and wait for the verdict if the receiver checks the Merkle root
+            if success and transfer['merkle_levels']:
+                success = await self.await_verification(transfer)
+            elif success and transfer['receivers'] and self.peer_supports(None, 'verdict'):
+                success = await self.await_verdicts(transfer)
+            elif success:
+                success = await self.send_completion(transfer)
+            transfer['success'] = success
+            if success and transfer['dropped_receivers']:
+                print(f"\nReceivers that did not get {filename}: {', '.join(transfer['dropped_receivers'])}")
+            if success:
                 print(f"\nFile transfer completed: {filename}")
-                return True
             else:
                 print(f"\nFile transfer failed: {filename}")
-                return False
 
         except Exception as e:
             print(f"\nError sending file: {e}")
             traceback.print_exc()
-            return False
         finally:
-            # Clear current file data
-            self.current_file_data = None
-            self.current_file_path = None
+            # Release the file mapping and make room for the next queued transfer
+            transfer['state'] = 'done' if transfer['success'] else 'failed'
+            if isinstance(transfer['data'], mmap.mmap):
+                transfer['data'].close()
+            self.transfers.pop(transfer['id'], None)
+            transfer['finished_at'] = self.loop.time()
+            transfer['finished'].set()
+            self.scheduler_wakeup.set()
+            self.metrics.finish_transfer(transfer['id'], transfer['success'])
+            await self.write_metrics()
+
+    def list_transfers(self):
+        """Display queued and active transfers"""
+        if not self.transfers:
+            print("\nNo transfers queued.")
+            return
+
+        print(f"\nTransfers ({self.queue_depth()} messages in the send queue):")
+        for transfer in list(self.transfers.values()):
+            acked = len(transfer['acked_chunks'])
+            progress = f"{acked}/{transfer['total_chunks']} chunks" if transfer['total_chunks'] else "not started"
+            estimate = f", est. {format_duration(transfer['plan']['duration'])}" if transfer['plan'] else ""
+            print(f"  {transfer['id']}: {transfer['filename']} -> {transfer['target'] or 'all nodes'} "
+                  f"({transfer['state']}, {progress}, weight {transfer['weight']}{estimate})")
+            for node_id, peer in list(transfer['receivers'].items()):
+                print(f"      {node_id}: {len(peer['acked'])}/{transfer['total_chunks']} chunks")
 
     def announce_presence(self):
         """Announce this node's presence to the network"""
@@ -267,13 +1325,13 @@ class MeshBLEFileTransfer:
             'role': 'sender',
             'time': int(time.time())
         }
-        if self.send_message_safely(announcement, delay=1.0):
+        if self.run_coroutine(self.send_message_safely(announcement, delay=1.0)):
             print(f"Announced presence as {self.node_id}")
             return True
         else:
             print("Failed to announce presence")
             return False
-            
+
     def discover_nodes(self):
         """Send a discovery request to find other nodes"""
         discovery_request = {
@@ -281,7 +1339,7 @@ class MeshBLEFileTransfer:
             'id': self.node_id,
             'time': int(time.time())
         }
-        if self.send_message_safely(discovery_request, delay=1.0):
+        if self.run_coroutine(self.send_message_safely(discovery_request, delay=1.0)):
             print("Sent discovery request, waiting for responses...")
             time.sleep(5)  # Wait for responses
             return True
@@ -289,74 +1347,345 @@ class MeshBLEFileTransfer:
             print("Failed to send discovery request")
             return False
 
-    def handle_message(self, message_data):
+    def process_ack(self, transfer, cumulative, bitmap, receiver=None):
+        """Mark every chunk below the cumulative ACK and every chunk set in the bitmap as acknowledged"""
+        out_of_order = parse_ack_bitmap(cumulative, bitmap)
+        self.metrics.count('acks_received', transfer=transfer['id'], peer=receiver)
+        # Any ACK shows the receiver has a session, so it got the start message
+        transfer['started'].add(receiver)
+        if not transfer['receivers'] or all(node_id in transfer['started'] for node_id in transfer['receivers']):
+            transfer['start_acked'].set()
+        if transfer['receivers']:
+            peer = transfer['receivers'].get(receiver)
+            if peer is None:
+                return  # Not one of the receivers this multicast waits for
+            acked = list(range(min(peer['floor'], cumulative), cumulative)) + out_of_order
+            peer['floor'] = max(peer['floor'], cumulative)
+            print(f"Received acknowledgment from {receiver} for {transfer['filename']} up to chunk {cumulative} "
+                  f"(+{len(out_of_order)} out of order)")
+            self.mark_acked(transfer, self.confirm_chunks(transfer, receiver, acked))
+            return
+        acked = list(range(min(transfer['ack_floor'], cumulative), cumulative)) + out_of_order
+        transfer['ack_floor'] = max(transfer['ack_floor'], cumulative)
+        print(f"Received acknowledgment for {transfer['filename']} up to chunk {cumulative} "
+              f"(+{len(out_of_order)} out of order)")
+        self.mark_acked(transfer, acked)
+
+    def confirm_chunks(self, transfer, receiver, chunk_numbers):
+        """Record chunks one multicast receiver confirmed and return those every receiver now holds"""
+        transfer['receivers'][receiver]['acked'].update(chunk_numbers)
+        return [cn for cn in chunk_numbers if cn not in transfer['acked_chunks'] and
+                all(cn in peer['acked'] for peer in transfer['receivers'].values())]
+
+    def mark_acked(self, transfer, chunk_numbers):
+        """Record acknowledged chunks and feed the transfer's RTT estimator"""
+        now = self.loop.time()
+        transfer['last_ack_time'] = now
+        sent_times = []
+        for chunk_number in chunk_numbers:
+            transfer['acked_chunks'].add(chunk_number)
+            sent_time = transfer['in_flight'].pop(chunk_number, None)
+            # Karn's rule: a retransmitted chunk's ACK cannot be matched to one transmission
+            if sent_time is not None and transfer['transmissions'].get(chunk_number) == 1:
+                sent_times.append(sent_time)
+        if sent_times:
+            # The newest chunk covered is the one that triggered this ACK; the oldest waited for the rest of the batch
+            newest_sent = max(sent_times)
+            transfer['rtt'].sample(now - newest_sent, newest_sent - min(sent_times))
+            self.metrics.observe('ack_rtt', now - newest_sent, transfer=transfer['id'])
+            transfer['pace_factor'] = max(transfer['pace_factor'] * 0.9, 0.5)
+        if transfer['total_chunks']:
+            progress = (len(transfer['acked_chunks']) / transfer['total_chunks']) * 100
+            print(f"Overall progress of {transfer['filename']}: {progress:.1f}%")
+        self.scheduler_wakeup.set()
+
+    def process_nack(self, transfer, first_chunk, bitmap, receiver=None):
+        """Retransmit at once the chunks the receiver could not recover or found corrupt.
+
+        A corrupt chunk may already have been acknowledged, so it is taken out of the
+        acknowledged set and the cumulative floor until the receiver confirms it again.
+        """
+        lost = parse_chunk_bitmap(first_chunk, bitmap)
+        self.metrics.count('nacks_received', transfer=transfer['id'], peer=receiver)
+        if transfer['receivers']:
+            peer = transfer['receivers'].get(receiver)
+            if peer is None:
+                return
+            peer['acked'].difference_update(lost)
+            if lost:
+                peer['floor'] = min(peer['floor'], min(lost))
+        for chunk_number in lost:
+            if chunk_number in transfer['acked_chunks']:
+                transfer['acked_chunks'].discard(chunk_number)
+                transfer['transmissions'][chunk_number] = 0
+        if lost:
+            transfer['ack_floor'] = min(transfer['ack_floor'], min(lost))
+        transfer['retransmit_now'].update(lost)
+        transfer['pace_factor'] = min(transfer['pace_factor'] * 1.5, 8.0)
+        print(f"Receiver {receiver or ''} is missing chunks {[cn + 1 for cn in lost]} of {transfer['filename']}")
+        self.scheduler_wakeup.set()
+
+    def handle_frame(self, frame, radio_id=None):
+        """Handle a binary frame received on the private app port"""
+        try:
+            msg_type, transfer_id, chunk_number, flags, payload = unpack_frame(frame)
+            transfer = self.transfers.get(transfer_id)
+            if transfer and msg_type == MSG_SIGNATURES:
+                # Answers the delta query, before the wire format of the transfer is settled
+                self.store_signatures(transfer, *DELTA_HEADER.unpack_from(payload), chunk_number,
+                                      payload[DELTA_HEADER.size:])
+                return
+            if not transfer or not transfer['use_binary']:
+                return
+            # Frames carry no sender, so the receiver is told apart by the radio it transmitted from
+            receiver = self.node_for_radio(radio_id)
+            if msg_type == MSG_ACK:
+                self.process_ack(transfer, chunk_number, payload, receiver)
+            elif msg_type == MSG_HELD:
+                self.record_held_chunks(transfer, chunk_number, payload)
+            elif msg_type == MSG_NACK:
+                self.process_nack(transfer, chunk_number, payload, receiver)
+        except Exception as e:
+            print(f"\nError handling frame: {e}")
+
+    def node_for_radio(self, radio_id):
+        """Node id that announced itself from a radio"""
+        for node_id, info in list(self.known_nodes.items()):
+            if radio_id and info.get('radio_id') == radio_id:
+                return node_id
+        return None
+
+    def find_transfer(self, filename, sender_id=None):
+        """Find the active transfer a receiver's JSON message is about"""
+        for transfer in list(self.transfers.values()):
+            if transfer['filename'] != filename or transfer['state'] == 'queued':
+                continue
+            if transfer['target'] and sender_id and transfer['target'] != sender_id:
+                continue
+            return transfer
+        return None
+
+    def peer_supports(self, target_node, capability):
+        """Check whether the target node, or every known receiver for a broadcast, announced a capability"""
+        if target_node:
+            return capability in self.known_nodes.get(target_node, {}).get('caps', [])
+        receivers = [info for info in self.known_nodes.values() if info['role'] == 'receiver']
+        return bool(receivers) and all(capability in info.get('caps', []) for info in receivers)
+
+    def register_handler(self, msg_type, handler):
+        """Route JSON messages of a type to handler(data, radio_id), replacing any earlier handler"""
+        self.handlers[msg_type] = handler
+
+    def message_transfer(self, data):
+        """The active transfer a receiver's message is about, by the transfer id it echoes or else by filename"""
+        if data.get('id') is not None:
+            transfer = self.transfers.get(data['id'])
+            if not transfer or transfer['state'] == 'queued' or \
+                    (transfer['target'] and data.get('from') and transfer['target'] != data['from']):
+                return None
+            return transfer
+        # Receivers from before transfer ids only name the file
+        return self.find_transfer(data['f'], data.get('from')) if data.get('f') else None
+
+    def dispatch(self, data, radio_id=None):
+        """Hand a parsed control message addressed to us to the handler registered for its type"""
+        # A receiver serving several senders at once answers each of them; skip the answers meant for others
+        if data.get('to') and data['to'] != self.node_id:
+            return
+        handler = self.handlers.get(data['t'])
+        if not handler:
+            return
         try:
-            data = json.loads(message_data)
-            msg_type = data.get('t', data.get('type', ''))
-            
-            if msg_type in ['ba', 'batch_ack']:
-                batch_number = data.get('bn', data.get('batch_number'))
-                print(f"Received acknowledgment for chunk {batch_number + 1}")
-                self.last_ack_batch = batch_number
-                self.ack_received.set()
-                
-            elif msg_type in ['te', 'transfer_error']:
-                error_msg = data.get('m', data.get('message', 'Unknown error'))
-                print(f"\nReceived transfer error: {error_msg}")
-            
-            elif msg_type == 'announce':
-                # Handle node announcements
-                node_id = data.get('id')
-                role = data.get('role')
-                if node_id != self.node_id:  # Don't track ourselves
-                    self.known_nodes[node_id] = {
-                        'role': role,
-                        'last_seen': time.time()
-                    }
-                    print(f"Discovered node: {node_id} (role: {role})")
-                
-            elif msg_type == 'discover':
-                # Respond to discovery requests
-                requester_id = data.get('id')
-                if requester_id != self.node_id:  # Don't respond to our own requests
-                    response = {
-                        't': 'announce',
-                        'id': self.node_id,
-                        'role': 'sender',
-                        'time': int(time.time())
-                    }
-                    self.send_message_safely(response, delay=1.0)
-                    print(f"Responded to discovery request from {requester_id}")
-                
+            handler(data, radio_id)
         except Exception as e:
             print(f"\nError handling message: {e}")
             traceback.print_exc()
 
-    def on_receive(self, packet, interface):
+    def handle_ack(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if not transfer:
+            return
+        if 'ca' in data:
+            # Compact ACK: everything below 'ca' plus the chunks set in the bitmap
+            self.process_ack(transfer, data['ca'], decode_bitmap(data.get('bm')), data.get('from'))
+        else:
+            batch_number = data.get('bn')
+            print(f"Received acknowledgment for chunk {batch_number + 1}")
+            if not transfer['receivers']:
+                self.mark_acked(transfer, [batch_number])
+            elif data.get('from') in transfer['receivers']:
+                self.mark_acked(transfer, self.confirm_chunks(transfer, data['from'], [batch_number]))
+
+    def handle_resume_state(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if transfer and data.get('cs') == transfer['checksum']:
+            transfer['resume_chunks'] = ranges_to_chunks(data.get('rg', []))
+            transfer['resume_received'].set()
+
+    def store_signatures(self, transfer, block_size, basis_size, parts, first_block, signatures):
+        """Collect one packet of the receiver's answer to a delta query"""
+        if transfer['state'] != 'preparing':
+            return
+        transfer['signature_info'] = {'block_size': block_size, 'basis_size': basis_size, 'parts': parts}
+        if parts:
+            transfer['signatures'][first_block] = signatures
+        if len(transfer['signatures']) >= parts:
+            transfer['signatures_received'].set()
+
+    def record_held_chunks(self, transfer, first_chunk, bitmap):
+        """Count the offered chunks the receiver holds as acknowledged"""
+        held = [cn for cn in parse_chunk_bitmap(first_chunk, bitmap)
+                if cn < transfer['total_chunks'] and cn not in transfer['acked_chunks']]
+        transfer['acked_chunks'].update(held)
+        for chunk_number in held:
+            transfer['in_flight'].pop(chunk_number, None)
+        if held:
+            self.metrics.count('chunks_from_store', len(held), transfer=transfer['id'])
+        transfer['offers_answered'].add(first_chunk)
+        if len(transfer['offers_answered']) >= transfer['offers_sent']:
+            transfer['offer_received'].set()
+        self.scheduler_wakeup.set()
+
+    def handle_held_chunks(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if transfer and transfer['leaves'] is not None:
+            self.record_held_chunks(transfer, data.get('cn', 0), decode_bitmap(data.get('bm')))
+
+    def handle_delta_signatures(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if transfer:
+            self.store_signatures(transfer, data.get('k'), data.get('bn', 0), data.get('np', 0), data.get('fb'),
+                                  base64.b64decode(data.get('s', '')))
+
+    def handle_nack(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if transfer:
+            self.process_nack(transfer, data['cn'], decode_bitmap(data.get('bm')), data.get('from'))
+
+    def handle_merkle_query(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if transfer and transfer['merkle_levels']:
+            self.spawn(self.answer_merkle_query(transfer, data.get('n', []), data.get('from')))
+
+    def handle_verified(self, data, radio_id=None):
+        transfer = self.message_transfer(data)
+        if not transfer:
+            return
+        if transfer['receivers']:
+            if data.get('from') in transfer['receivers']:
+                transfer['verdicts'][data['from']] = True
+        else:
+            transfer['verify_ok'] = True
+        transfer['verify_received'].set()
+
+    def handle_transfer_error(self, data, radio_id=None):
+        print(f"\nReceived transfer error: {data.get('m', 'Unknown error')}")
+        transfer = self.message_transfer(data)
+        if transfer and transfer['merkle_levels']:
+            transfer['verify_ok'] = False
+            transfer['verify_received'].set()
+        elif transfer and transfer['state'] == 'completing' and data.get('from') in transfer['receivers']:
+            # A multicast receiver whose copy failed its checksum
+            transfer['verdicts'][data['from']] = False
+            transfer['verify_received'].set()
+
+    def handle_announce(self, data, radio_id=None):
+        node_id = data.get('id')
+        role = data.get('role')
+        if node_id != self.node_id:  # Don't track ourselves
+            self.known_nodes[node_id] = {
+                'role': role,
+                'caps': data.get('caps', []),  # Protocol features the node supports
+                'radio_id': radio_id,  # Radio the announcement came from, to attribute binary frames
+                'last_seen': time.time()
+            }
+            print(f"Discovered node: {node_id} (role: {role})")
+
+    def handle_discover(self, data, radio_id=None):
+        requester_id = data.get('id')
+        if requester_id != self.node_id:  # Don't respond to our own requests
+            response = {
+                't': 'announce',
+                'id': self.node_id,
+                'role': 'sender',
+                'time': int(time.time())
+            }
+            self.spawn(self.send_message_safely(response, delay=1.0))
+            print(f"Responded to discovery request from {requester_id}")
+
+    def on_receive(self, packet, interface=None):
+        # Runs on the meshtastic receive thread: hand the packet to the event loop and return at once
+        self.loop.call_soon_threadsafe(self.handle_packet, packet)
+
+    def handle_packet(self, packet):
         try:
             if packet.get('decoded'):
+                if is_binary_packet(packet['decoded']):
+                    self.handle_frame(packet['decoded']['payload'], packet.get('fromId'))
+                    return
                 message = packet['decoded'].get('text', '')
                 sender = packet.get('fromId', 'Unknown')
-                
-                try:
-                    data = json.loads(message)
-                    if 't' in data or 'type' in data:
-                        self.handle_message(message)
-                    else:
-                        print(f"\nReceived from {sender}: {message}")
-                except json.JSONDecodeError:
+
+                data = parse_message(message)
+                if data:
+                    self.dispatch(data, packet.get('fromId'))
+                else:
                     print(f"\nReceived from {sender}: {message}")
         except Exception as e:
             print(f"Error processing message: {e}")
 
+    def show_send_queue(self):
+        """Display the send queue depth and the airtime our packets have used"""
+        print(f"\nSend queue: {self.queue_depth()} messages waiting")
+        if self.lora_preset:
+            duty_cycle = REGION_DUTY_CYCLE.get(self.region, 1.0)
+            print(f"Airtime used: {self.airtime_used:.1f}s on {self.lora_preset}, "
+                  f"budget {duty_cycle * 100:g}% duty cycle ({self.region})")
+        if self.period_airtime_limit:
+            print(f"Airtime budget: {self.airtime_in_period():.1f}s of {self.period_airtime_limit:.0f}s used "
+                  f"in the last {format_duration(self.budget_period)}")
+
+    async def run_metrics_writer(self):
+        """Refresh the metrics files every metrics_interval seconds"""
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            await self.write_metrics()
+
+    async def write_metrics(self):
+        if not self.status_file and not self.prometheus_file:
+            return
+        try:
+            await self.loop.run_in_executor(None, self.metrics.write, self.status_file, self.prometheus_file)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+    def show_metrics(self):
+        """Display the counters per peer and the goodput of recent transfers"""
+        status = self.metrics.snapshot()
+        for name, scope in [('all peers', status['totals'])] + list(status['peers'].items()):
+            counters = scope['counters']
+            rtt = scope['histograms']['ack_rtt']
+            print(f"\n{name}: {counters['chunks_sent']} chunks sent, {counters['chunks_retried']} retried, "
+                  f"{counters['bytes_on_air']} bytes / {counters['airtime_seconds']:.1f}s on air, "
+                  f"ACK RTT {rtt['mean'] if rtt['mean'] is not None else '-'}s")
+        totals = status['totals']
+        latency = totals['histograms']['reconnect_duration']['mean']
+        print(f"Reconnects: {totals['counters']['reconnects']} (mean {latency if latency is not None else '-'}s), "
+              f"{totals['counters']['reconnects_avoided']} avoided, {totals['counters']['reconnect_failures']} failed, "
+              f"{totals['counters']['link_losses']} link losses")
+        for key, transfer in status['transfers'].items():
+            goodput = f"{transfer['goodput']} B/s" if transfer['goodput'] is not None else '-'
+            print(f"  {key} {transfer['filename']} -> {transfer['peer'] or 'all nodes'}: {transfer['state']}, "
+                  f"{transfer['duration']}s, goodput {goodput}")
+
     def list_known_nodes(self):
         """Display list of known nodes"""
         if not self.known_nodes:
             print("\nNo nodes discovered yet. Try running /discover first.")
             return
-            
+
         print("\nKnown nodes:")
-        for node_id, info in self.known_nodes.items():
+        for node_id, info in list(self.known_nodes.items()):
             last_seen = time.time() - info['last_seen']
             print(f"  {node_id} (role: {info['role']}, last seen: {int(last_seen)}s ago)")
 
@@ -368,36 +1697,59 @@ class MeshBLEFileTransfer:
                     time.sleep(5)
                     continue
 
-                pub.subscribe(self.on_receive, "meshtastic.receive")
-                
-                # Announce presence when we start
+                # Announce presence when we start and learn what the receivers support
                 self.announce_presence()
+                self.discover_nodes()
 
                 print("\nFile Transfer Commands:")
-                print("  /send <filepath>              - Send file to all nodes")
-                print("  /sendto <filepath> <node_id>  - Send file to specific node")
-                print("  /discover                     - Discover other nodes")
-                print("  /nodes                        - List known nodes")
-                print("  /announce                     - Announce presence")
-                print("  /quit                         - Exit")
+                print("  /send <filepath>                       - Queue file for all nodes")
+                print("  /sendto <filepath> <node_id> [weight]  - Queue file for specific node")
+                print("  /transfers                             - List queued and active transfers")
+                print("  /queue                                 - Show send queue depth and airtime")
+                print("  /metrics                               - Show transfer metrics per peer")
+                print("  /weight <transfer_id> <weight>         - Change a transfer's share of airtime")
+                print("  /discover                              - Discover other nodes")
+                print("  /nodes                                 - List known nodes")
+                print("  /announce                              - Announce presence")
+                print("  /quit                                  - Exit")
 
                 while True:
                     try:
                         command = input("\nEnter command: ")
-                        
+
                         if command.lower() == '/quit':
                             return
                         elif command.lower().startswith('/send '):
                             filepath = command[6:].strip()
-                            self.send_file(filepath)
+                            self.queue_file(filepath)
                         elif command.lower().startswith('/sendto '):
                             parts = command[8:].strip().split(' ')
-                            if len(parts) >= 2:
+                            weight = parse_weight(parts[2]) if len(parts) >= 3 else 1
+                            if len(parts) >= 2 and weight is not None:
                                 filepath = parts[0]
                                 target_node = parts[1]
-                                self.send_file(filepath, target_node)
+                                self.queue_file(filepath, target_node, weight)
+                            else:
+                                print("Invalid format. Use: /sendto <filepath> <node_id> [weight], "
+                                      "with a positive weight")
+                        elif command.lower() == '/transfers':
+                            self.list_transfers()
+                        elif command.lower() == '/queue':
+                            self.show_send_queue()
+                        elif command.lower() == '/metrics':
+                            self.show_metrics()
+                        elif command.lower().startswith('/weight '):
+                            parts = command[8:].strip().split(' ')
+                            transfer = weight = None
+                            if len(parts) == 2 and parts[0].isdigit():
+                                transfer = self.transfers.get(int(parts[0]))
+                                weight = parse_weight(parts[1])
+                            if transfer and weight is not None:
+                                transfer['weight'] = weight
+                                print(f"Transfer {transfer['id']} weight set to {transfer['weight']}")
                             else:
-                                print("Invalid format. Use: /sendto <filepath> <node_id>")
+                                print("Invalid format or unknown transfer. Use: /weight <transfer_id> <weight>, "
+                                      "with a positive weight")
                         elif command.lower() == '/discover':
                             self.discover_nodes()
                         elif command.lower() == '/nodes':
@@ -406,12 +1758,16 @@ class MeshBLEFileTransfer:
                             self.announce_presence()
                         else:
                             print("Invalid command. Available commands:")
-                            print("  /send <filepath>              - Send file to all nodes")
-                            print("  /sendto <filepath> <node_id>  - Send file to specific node")
-                            print("  /discover                     - Discover other nodes")
-                            print("  /nodes                        - List known nodes")
-                            print("  /announce                     - Announce presence")
-                            print("  /quit                         - Exit")
+                            print("  /send <filepath>                       - Queue file for all nodes")
+                            print("  /sendto <filepath> <node_id> [weight]  - Queue file for specific node")
+                            print("  /transfers                             - List queued and active transfers")
+                            print("  /queue                                 - Show send queue depth and airtime")
+                            print("  /metrics                               - Show transfer metrics per peer")
+                            print("  /weight <transfer_id> <weight>         - Change a transfer's share of airtime")
+                            print("  /discover                              - Discover other nodes")
+                            print("  /nodes                                 - List known nodes")
+                            print("  /announce                              - Announce presence")
+                            print("  /quit                                  - Exit")
                     except Exception as e:
                         print(f"Error processing command: {e}")
 
@@ -420,14 +1776,14 @@ class MeshBLEFileTransfer:
                 break
             except Exception as e:
                 print(f"\nError: {e}")
-                if not self.reconnect():
+                if not self.run_coroutine(self.reconnect()):
                     time.sleep(5)
             finally:
-                if self.interface:
-                    try:
-                        self.interface.close()
-                    except:
-                        pass
+                try:
+                    self.transport.close()
+                except Exception:
+                    pass
+
 
 # Change this MAC address for your first T-Beam
 MAC_ADDRESS = "08:F9:E0:F6:1A:0E"
@@ -435,10 +1791,10 @@ MAC_ADDRESS = "08:F9:E0:F6:1A:0E"
 if __name__ == "__main__":
     import sys
     node_id = "leaf1"  # Default node ID
-    
+
     # Check if node ID was provided as command line argument
     if len(sys.argv) > 1:
         node_id = sys.argv[1]
-        
+
     transfer = MeshBLEFileTransfer(MAC_ADDRESS, node_id)
-    transfer.run()
\ No newline at end of file
+    transfer.run()
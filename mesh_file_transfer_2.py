@@ -1,171 +1,421 @@
-import meshtastic
-import meshtastic.ble_interface
-from pubsub import pub
+import asyncio
 import time
 import os
 import base64
 import hashlib
 import json
+import random
 import traceback
 import signal
 import sys
-import subprocess
-from threading import Lock
+import tempfile
+from threading import Lock, Thread
+from mesh_transport import BLETransport, backoff_delay
+from mesh_metrics import MeshMetrics
+from mesh_store import ChunkStore
+from mesh_protocol import (build_ack_bitmap, build_chunk_bitmap, encode_bitmap, pack_frame, unpack_frame,
+                           is_binary_packet, decompress_stream, fec_decode, chunks_to_ranges, ranges_to_chunks,
+                           check_chunk_crc, chunk_crc, merkle_leaf, merkle_levels, merkle_node, merkle_children,
+                           parse_message, lora_airtime, lora_bitrate, TokenBucket, REGION_DUTY_CYCLE, max_chunk_size,
+                           block_signature, apply_delta,
+                           COMPRESSION_CODECS, DATA_PAYLOAD_LEN, LEGACY_CHUNK_SIZE, PRIVATE_APP_PORTNUM,
+                           MERKLE_HASH_LEN, MAX_ACK_BITMAP_BYTES, DELTA_SIGNATURE, DELTA_HEADER, DELTA_MAX_BLOCK,
+                           FRAME_HEADER, MSG_CHUNK, MSG_ACK, MSG_NACK, MSG_SIGNATURES, MSG_OFFER, MSG_HELD,
+                           FLAG_PARITY, FLAG_CRC)
+
 
 class MeshBLEFileReceiver:
-    def __init__(self, mac_address, node_id="leaf2"):
+    def __init__(self, mac_address, node_id="leaf2", transport=None, loop=None):
         self.mac_address = mac_address
         self.node_id = node_id  # Unique identifier for this node
-        self.interface = None
+        # Radio link; a simulated one runs without hardware
+        self.transport = transport or BLETransport(mac_address, connect_delay=3, settle_delay=2)
         self.connected = False
+        # (sender id, transfer id) -> state of each inbound session, so senders never share one
         self.receiving_files = {}
-        self.last_reconnect_attempt = 0
-        self.reconnect_cooldown = 5
+        self.transfer_ids = {}  # (radio id, transfer id) of binary frames -> session key
+        # Protocol features announced to senders
+        self.capabilities = ['bin', 'sz', 'fec', 'resume', 'crc', 'merkle', 'delta', 'sess', 'start', 'verdict']
+        self.capabilities += COMPRESSION_CODECS
+        self.last_reconnect_failure = None  # Loop time the last reconnect gave up
+        self.reconnect_cooldown = 5  # Seconds after a reconnect gave up before the next may start
+        self.reconnect_attempts = 6  # Attempts per reconnect; the first is made at once
+        self.reconnect_backoff = 1.0  # Seconds before the second attempt, doubled after each failure
+        self.max_reconnect_backoff = 30.0
+        self.adapter_reset_after = 3  # Failed attempts before the Bluetooth adapter is reset
+        self.keepalive_interval = 5  # Seconds between link probes, 0 to notice a lost link only by chunk_timeout
+        self.link_up = asyncio.Event()  # Cleared while the radio is unreachable; sending and timeouts pause on it
+        self.link_up.set()
         self.connection_lock = Lock()
         self.last_chunk_time = time.time()
         self.chunk_timeout = 60  # Increased timeout
-        self.chunk_size = 100  # Keeping chunk size at 100 bytes
+        self.chunk_size = LEGACY_CHUNK_SIZE  # Used when the start message does not carry 'sz'
         self.max_retransmission_attempts = 3
+        self.ack_interval = 1.0  # ACK timer before the chunk arrival rate is known
+        self.max_ack_delay = 10.0  # Longest a received chunk waits for its ACK
+        self.multicast_ack_jitter = 1.0  # Longest random wait before a due ACK for a broadcast file
+        self.ack_send_gap = 0.2  # Pause after our own ACKs; they are rare now and the radio queues them
+        self.state_lock = Lock()
+        # When to fsync partial files: 'always' after every chunk, 'checkpoint' before each journal
+        # save, 'never' leaves it to the OS (a power cut may then lose chunks the journal lists)
+        self.fsync_policy = 'checkpoint'
+        self.checkpoint_every = 10  # Chunks between journal checkpoints
+        self.read_block_size = 64 * 1024  # Verification reads the received file back in blocks of this size
+        self.merkle_batch = 6  # Tree nodes asked for per Merkle query, so the answer fits in one packet
+        self.merkle_query_timeout = 20  # Resend a Merkle query that got no answer after this long
+        # (sender id, filename) -> checksum of files verified against a Merkle root, to answer repeated completions
+        self.completed_files = {}
+        self.signed_copies = {}  # filename -> block size and size of our copy when we sent its signatures for a delta
         self.known_nodes = {}  # Dictionary to store discovered nodes
-        
+
+        # JSON control messages are parsed once and routed by type; new message kinds register here
+        self.handlers = {}
+        for msg_type, handler in (('fs', self.handle_file_start), ('fc', self.handle_chunk_or_completion),
+                                  ('mh', self.handle_merkle_answer), ('rq', self.handle_resume_query),
+                                  ('dq', self.handle_delta_query), ('co', self.handle_chunk_offer),
+                                  ('announce', self.handle_announce), ('discover', self.handle_discover)):
+            self.register_handler(msg_type, handler)
+
         # Set up signal handler for graceful exit
         signal.signal(signal.SIGINT, self.signal_handler)
-        
-        # Create received_files directory
-        os.makedirs('received_files', exist_ok=True)
+
+        # Create received_files directory, with per-transfer journals for resuming
+        self.journal_dir = os.path.join('received_files', '.journal')
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # Chunks of every transfer are kept by hash, so a sender can skip the ones we already hold
+        self.chunk_store_size = 8 * 1024 * 1024  # Bytes of chunks kept, least recently used evicted first; 0 to disable
+        self.chunk_store = None
+        if self.chunk_store_size:
+            self.chunk_store = ChunkStore(os.path.join('received_files', '.chunks'), self.chunk_store_size)
+            self.capabilities.append('store')
+
+        # Outbound budget: every packet goes through one send queue whose worker owns the radio
+        self.lora_preset = 'LONG_FAST'  # Modem preset the radio uses, None to skip airtime budgeting
+        self.region = 'US'  # Meshtastic region, sets the duty cycle limit
+        self.byte_rate = None  # Payload bytes per second, None for the preset's bit rate within the duty cycle
+        self.send_burst = 3  # Full size packets the budget lets out back to back
+        self.configure_send_budget()
+
+        # Packets, ACK timers and verification run on an event loop in its own thread, so the
+        # radio callback thread only hands packets over and never waits on a send
+        # A simulation passes one loop, running on a virtual clock, shared by all its nodes
+        self.tasks = set()
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, daemon=True).start()
+        self.loop = loop
+        self.send_queue = asyncio.Queue()
+        self.airtime_used = 0.0  # Seconds of airtime spent by our packets
+        asyncio.run_coroutine_threadsafe(self.run_send_queue(), self.loop)
+
+        # Counters and timings per transfer and per peer, written out for dashboards
+        self.metrics = MeshMetrics(self.node_id, 'receiver', clock=self.loop.time)
+        self.status_file = f"mesh_status_{self.node_id}.json"  # JSON status, None to disable
+        self.prometheus_file = None  # Prometheus textfile, e.g. /var/lib/node_exporter/textfile_collector/mesh.prom
+        self.metrics_interval = 30  # Seconds between metrics file updates
+        asyncio.run_coroutine_threadsafe(self.run_metrics_writer(), self.loop)
+        asyncio.run_coroutine_threadsafe(self.run_keepalive(), self.loop)
         print(f"Files will be saved in: {os.path.abspath('received_files')}")
         print(f"Node ID: {self.node_id}")
 
+    def spawn(self, coroutine):
+        """Start a coroutine as a task on the event loop; only call from the loop thread"""
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)  # The loop only keeps weak references to running tasks
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine on the event loop from another thread and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
     def signal_handler(self, sig, frame):
         print("\nInterrupt received, saving partial files...")
-        for filename in list(self.receiving_files.keys()):
+        for key, file_info in list(self.receiving_files.items()):
             try:
-                partial_path = self.save_partial_file(filename, self.receiving_files[filename]['data'])
+                partial_path = self.checkpoint_transfer(key)
                 print(f"Saved partial data to {partial_path}")
             except Exception as e:
-                print(f"Error saving partial file {filename}: {e}")
+                print(f"Error saving partial file {file_info['filename']}: {e}")
         print("Exiting...")
         sys.exit(0)
 
-    def reconnect(self):
-        with self.connection_lock:
-            current_time = time.time()
-            if current_time - self.last_reconnect_attempt < self.reconnect_cooldown:
+    async def reconnect(self):
+        """Reopen the radio link, unless a probe shows it is still up.
+
+        The first attempt is made at once, later ones back off exponentially with jitter,
+        and the Bluetooth adapter is only reset once adapter_reset_after attempts failed.
+        """
+        if not self.connection_lock.acquire(blocking=False):
+            return False  # Another task is already reconnecting
+        try:
+            if self.last_reconnect_failure is not None and \
+                    self.loop.time() - self.last_reconnect_failure < self.reconnect_cooldown:
                 return False
+            started = self.loop.time()
+            # A quiet spell is often just a sender that stopped; tearing down a live link would cost far more
+            if await self.loop.run_in_executor(None, self.transport.probe):
+                self.connected = True
+                self.metrics.count('reconnects_avoided')
+                return True
 
-            self.last_reconnect_attempt = current_time
-            max_attempts = 3
-            for attempt in range(max_attempts):
+            self.connected = False
+            for attempt in range(self.reconnect_attempts):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt - 1, self.reconnect_backoff, self.max_reconnect_backoff))
+                print(f"\nReconnecting (attempt {attempt + 1}/{self.reconnect_attempts})...")
                 try:
-                    print(f"\nReconnecting (attempt {attempt + 1}/{max_attempts})...")
-                    # Safely close existing connection
-                    if self.interface:
+                    try:
+                        await self.loop.run_in_executor(None, self.transport.close)
+                    except Exception as e:
+                        print(f"Non-critical error closing interface: {str(e).split('(')[0]}")
+                    if attempt >= self.adapter_reset_after:
+                        print("Resetting Bluetooth adapter...")
                         try:
-                            self.interface.close()
+                            await self.loop.run_in_executor(None, self.transport.reset)
                         except Exception as e:
-                            print(f"Non-critical error closing interface: {str(e).split('(')[0]}")
-                            # Continue despite close error
-                    
-                    # Wait longer before creating new connection
-                    print("Waiting for BLE to stabilize...")
-                    time.sleep(5)  
-                    
-                    # Try to create new connection with longer timeout
-                    print("Establishing new connection...")
-                    self.interface = meshtastic.ble_interface.BLEInterface(self.mac_address)
+                            print(f"Adapter reset failed: {str(e).split('(')[0]}")
+                    await self.loop.run_in_executor(None, self.transport.open, self.on_receive)
+                    await asyncio.sleep(self.transport.settle_delay)  # Let connection stabilize
                     self.connected = True
-                    print("Reconnected successfully!")
-                    time.sleep(3)  # Longer stabilization time
+                    duration = self.loop.time() - started
+                    print(f"Reconnected in {duration:.1f}s")
+                    self.metrics.count('reconnects')
+                    self.metrics.observe('reconnect_duration', duration)
                     return True
                 except Exception as e:
                     print(f"Reconnection attempt failed: {str(e).split('(')[0]}")
-                    # Try resetting Bluetooth before next attempt
-                    try:
-                        print("Attempting to reset Bluetooth adapter...")
-                        subprocess.run(["sudo", "hciconfig", "hci0", "reset"], 
-                                      stderr=subprocess.PIPE, 
-                                      stdout=subprocess.PIPE,
-                                      timeout=5)
-                    except:
-                        pass  # Ignore if this fails
-                    time.sleep(5)  # Longer wait between attempts
-            
+
             print("All reconnection attempts failed. Will try again later.")
+            self.last_reconnect_failure = self.loop.time()
+            self.metrics.count('reconnect_failures')
             return False
+        finally:
+            self.connection_lock.release()
 
     def connect(self):
         with self.connection_lock:
+            print(f"Connecting to T-Beam at {self.mac_address}...")
             try:
-                print(f"Connecting to T-Beam at {self.mac_address}...")
-                if self.interface:
-                    try:
-                        self.interface.close()
-                    except Exception as e:
-                        print(f"Non-critical error closing interface: {str(e).split('(')[0]}")
-                
-                # Try resetting Bluetooth before connecting
+                self.transport.close()
+            except Exception as e:
+                print(f"Non-critical error closing interface: {str(e).split('(')[0]}")
+            # Reset the Bluetooth adapter only if the radio cannot be reached without it
+            for reset in (False, True):
                 try:
-                    subprocess.run(["sudo", "hciconfig", "hci0", "reset"], 
-                                  stderr=subprocess.PIPE, 
-                                  stdout=subprocess.PIPE,
-                                  timeout=5)
-                    print("Reset Bluetooth adapter")
-                except:
-                    pass  # Ignore if this fails
-                
-                time.sleep(3)  # Longer delay before initial connection
-                print("Establishing connection...")
-                self.interface = meshtastic.ble_interface.BLEInterface(self.mac_address)
-                self.connected = True
-                print("Connected to T-Beam successfully!")
-                print("Waiting for files...")
-                time.sleep(2)  # Let connection stabilize
-                return True
+                    if reset:
+                        print("Resetting Bluetooth adapter and trying again...")
+                        self.transport.reset()
+                    time.sleep(self.transport.connect_delay)  # Let BLE settle before connecting
+                    print("Establishing connection...")
+                    self.transport.open(self.on_receive)
+                    self.connected = True
+                    print("Connected to T-Beam successfully!")
+                    print("Waiting for files...")
+                    time.sleep(self.transport.settle_delay)  # Let connection stabilize
+                    return True
+                except Exception as e:
+                    print(f"Connection error: {e}")
+            return False
+
+    async def run_keepalive(self):
+        """Probe the radio every keepalive_interval seconds and restore the link as soon as it is lost.
+
+        Without it a dead link only shows once chunk_timeout passes with no chunk, and never between transfers.
+        """
+        while True:
+            await asyncio.sleep(self.keepalive_interval or 60)
+            if not self.keepalive_interval or not self.connected or not self.link_up.is_set():
+                continue
+            if not await self.loop.run_in_executor(None, self.transport.probe):
+                self.metrics.count('link_losses')
+                await self.restore_link()
+
+    async def restore_link(self):
+        """Pause transfers until the radio is reachable again, then resume them where they were"""
+        if not self.link_up.is_set():
+            await self.link_up.wait()  # Another task is already restoring it
+            return
+        print("\nRadio link lost, pausing transfers")
+        lost_at = self.loop.time()
+        self.link_up.clear()
+        try:
+            # Never give up here: transfers wait for the radio instead of timing out
+            while not await self.reconnect():
+                await asyncio.sleep(self.reconnect_cooldown)
+        finally:
+            print(f"Radio link back after {self.loop.time() - lost_at:.1f}s, resuming transfers")
+            self.link_up.set()
+            self.resume_transfers()
+
+    def resume_transfers(self):
+        """Pick the sessions up after an outage: restart the chunk timeout and repeat what may have been lost"""
+        self.last_chunk_time = time.time()
+        for key, file_info in list(self.receiving_files.items()):
+            file_info['last_arrival'] = None  # The outage says nothing about the sender's pace
+            if file_info['merkle_pending'] and not file_info['merkle_timer']:
+                self.send_merkle_query(key)
+            else:
+                # ACKs handed to the radio as the link went down never made it; tell the sender what we hold
+                self.send_chunk_ack(key, file_info['sender_id'])
+
+    def configure_send_budget(self):
+        """Size the send queue's token buckets to the LoRa preset and the region's duty cycle"""
+        duty_cycle = REGION_DUTY_CYCLE.get(self.region, 1.0)
+        byte_rate = self.byte_rate
+        if byte_rate is None and self.lora_preset:
+            byte_rate = lora_bitrate(self.lora_preset) / 8 * duty_cycle
+        self.byte_budget = TokenBucket(byte_rate, self.send_burst * DATA_PAYLOAD_LEN) if byte_rate else None
+        self.airtime_budget = None
+        if self.lora_preset:
+            # Seconds of airtime per second, so the queue never books more than the channel may carry
+            self.airtime_budget = TokenBucket(duty_cycle,
+                                              self.send_burst * lora_airtime(DATA_PAYLOAD_LEN, self.lora_preset))
+
+    def queue_depth(self):
+        """Messages waiting for the radio"""
+        return self.send_queue.qsize()
+
+    def radio_send(self, payload):
+        if isinstance(payload, bytes):
+            self.transport.send_data(payload, PRIVATE_APP_PORTNUM)
+        else:
+            self.transport.send_text(payload)
+
+    async def run_send_queue(self):
+        """Own the radio: send queued packets one at a time, waiting for the byte and airtime budgets"""
+        while True:
+            payload, done, account = await self.send_queue.get()
+            await self.link_up.wait()  # Hold packets while the link is down rather than fail them
+            try:
+                size = len(payload) if isinstance(payload, bytes) else len(payload.encode('utf-8'))
+                airtime = lora_airtime(size, self.lora_preset) if self.lora_preset else 0
+                costs = [(bucket, amount)
+                         for bucket, amount in ((self.byte_budget, size), (self.airtime_budget, airtime)) if bucket]
+                wait = max([bucket.delay(amount, self.loop.time()) for bucket, amount in costs], default=0)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                for bucket, amount in costs:
+                    bucket.take(amount, self.loop.time())
+                await self.loop.run_in_executor(None, self.radio_send, payload)
+                self.airtime_used += airtime
+                self.metrics.count('packets_sent', transfer=account)
+                self.metrics.count('bytes_on_air', size, transfer=account)
+                self.metrics.count('airtime_seconds', airtime, transfer=account)
+                if not done.done():
+                    done.set_result(True)
             except Exception as e:
-                print(f"Connection error: {e}")
-                return False
+                if not done.done():
+                    done.set_exception(e)
 
-    def calculate_checksum(self, data):
-        return hashlib.md5(data).hexdigest()
+    async def send_message_safely(self, message, retries=3, delay=2.0, account=None):
+        """Send a message with retries and reconnection if needed.
 
-    def send_message_safely(self, message, retries=3, delay=2.0):
-        """Send a message with retries and reconnection if needed"""
+        Dict messages go out as JSON text, bytes are sent as a binary frame on the private app port.
+        The message waits its turn in the send queue; delay then paces this caller's next send.
+        Its bytes and airtime are counted against the session key given as account.
+        """
+        # Convert message to a compact string to reduce size
+        payload = message if isinstance(message, bytes) else json.dumps(message, separators=(',', ':'))
         for attempt in range(retries):
             try:
-                # Convert message to a compact string to reduce size
-                message_str = json.dumps(message, separators=(',', ':'))
-                self.interface.sendText(message_str)
-                time.sleep(delay)  # Wait after sending
+                done = self.loop.create_future()
+                self.send_queue.put_nowait((payload, done, account))
+                await done
+                await asyncio.sleep(delay)  # Wait after sending
                 return True
             except Exception as e:
                 print(f"\nError sending message (attempt {attempt + 1}): {str(e).split('(')[0]}")
                 if attempt < retries - 1:
-                    print("Waiting before retry...")
-                    time.sleep(3)
-                    if not self.reconnect():
-                        time.sleep(4)
+                    # Pause until the radio is back; reconnecting probes the link first and backs off by itself
+                    await self.restore_link()
         return False
 
-    def send_chunk_ack(self, filename, chunk_number, sender_id=None):
-        """Send acknowledgment for received chunk"""
+    def send_chunk_ack(self, key, sender_id=None):
+        """Send one compact ACK covering every chunk received so far"""
         try:
+            with self.state_lock:
+                file_info = self.receiving_files.get(key)
+                if not file_info:
+                    return False
+                if file_info['ack_timer']:
+                    file_info['ack_timer'].cancel()
+                    file_info['ack_timer'] = None
+                file_info['unacked'] = 0
+                cumulative = file_info['cumulative']
+                bitmap = build_ack_bitmap(file_info['received_chunks'], cumulative)
+                last_chunk = file_info['last_chunk']
+
+            print(f"\nSending acknowledgment up to chunk {cumulative} ({len(bitmap)} bitmap bytes)")
+            self.metrics.count('acks_sent', transfer=key)
+            if file_info['binary']:
+                frame = pack_frame(MSG_ACK, file_info['transfer_id'], cumulative, bitmap)
+                return self.spawn(self.send_message_safely(frame, delay=self.ack_send_gap, account=key))
+
             ack_message = {
                 't': 'ba',  # Shortened type (batch ack)
-                'f': filename,
-                'bn': chunk_number,  # Using batch number to match chunk number
+                'f': file_info['filename'],
+                'ca': cumulative,  # Every chunk below this number has been received
                 'from': self.node_id
             }
+            if bitmap:
+                ack_message['bm'] = encode_bitmap(bitmap)  # Chunks received out of order
+            # Stop-and-wait senders only understand a single chunk number
+            if file_info['batch_size'] <= 1:
+                ack_message['bn'] = last_chunk
             # Add sender ID if available to target the response
             if sender_id:
                 ack_message['to'] = sender_id
-                
-            print(f"Sending acknowledgment for chunk {chunk_number + 1}")
-            return self.send_message_safely(ack_message, delay=2.0)
+            if file_info['transfer_id'] is not None:
+                ack_message['id'] = file_info['transfer_id']  # Tells apart two transfers of one file
+
+            return self.spawn(self.send_message_safely(ack_message, delay=self.ack_send_gap, account=key))
         except Exception as e:
             print(f"Error sending chunk acknowledgment: {e}")
             return False
 
-    def send_error(self, filename, message, sender_id=None):
+    def schedule_ack(self, key, sender_id=None):
+        """Send an ACK once a full window is unacknowledged, otherwise start the ACK timer"""
+        with self.state_lock:
+            file_info = self.receiving_files.get(key)
+            if not file_info:
+                return
+            file_info['unacked'] += 1
+            complete = file_info['cumulative'] >= file_info['total_chunks']
+            send_now = complete or file_info['unacked'] >= file_info['batch_size']
+            if not send_now and not file_info['ack_timer']:
+                # Wait about two chunk inter-arrival times: long enough for the rest of the window,
+                # short enough that the sender hears back soon after it stops sending
+                if file_info['arrival_gap'] is None:
+                    ack_delay = self.ack_interval
+                else:
+                    ack_delay = min(max(2 * file_info['arrival_gap'], 0.1), self.max_ack_delay)
+                file_info['ack_timer'] = self.loop.call_later(ack_delay, self.send_chunk_ack, key, sender_id)
+            elif send_now and file_info['broadcast']:
+                # Every receiver of a broadcast answers the same chunks; a random wait keeps the ACKs from colliding
+                ack_at = self.loop.time() + random.uniform(0, self.multicast_ack_jitter)
+                if not file_info['ack_timer'] or file_info['ack_timer'].when() > ack_at:
+                    if file_info['ack_timer']:
+                        file_info['ack_timer'].cancel()
+                    file_info['ack_timer'] = self.loop.call_at(ack_at, self.send_chunk_ack, key, sender_id)
+                send_now = False
+        if send_now:
+            self.send_chunk_ack(key, sender_id)
+
+    def discard_transfer(self, key):
+        """Forget a session and stop its pending ACK timer"""
+        with self.state_lock:
+            file_info = self.receiving_files.pop(key, None)
+            if file_info and file_info['binary']:
+                self.transfer_ids.pop((file_info['radio_id'], file_info['transfer_id']), None)
+        if file_info and file_info['ack_timer']:
+            file_info['ack_timer'].cancel()
+        if file_info and file_info['merkle_timer']:
+            file_info['merkle_timer'].cancel()
+        if file_info:
+            os.close(file_info['fd'])
+
+    def send_error(self, filename, message, sender_id=None, transfer_id=None):
         """Send error message to sender"""
         try:
             error_message = {
@@ -177,256 +427,1044 @@ class MeshBLEFileReceiver:
             # Add sender ID if available to target the response
             if sender_id:
                 error_message['to'] = sender_id
-                
-            return self.send_message_safely(error_message, delay=2.0)
+            if transfer_id is not None:
+                error_message['id'] = transfer_id
+
+            return self.spawn(self.send_message_safely(error_message, delay=2.0))
         except Exception as e:
             print(f"Error sending error message: {e}")
             return False
 
-    def save_partial_file(self, filename, data, is_final=False):
+    def checkpoint_name(self, sender_id, filename):
+        """Name of a session's partial file and journal; two senders of the same filename never share them"""
+        return f"{sender_id}_{filename}" if sender_id else filename
+
+    def partial_path(self, sender_id, filename):
+        return os.path.join('received_files', f"partial_{self.checkpoint_name(sender_id, filename)}")
+
+    def saved_path(self, filename):
+        return os.path.join('received_files', f"received_{filename}")
+
+    def open_partial_file(self, path, file_size, keep=False):
+        """Open the partial file at its full size so every chunk can be written straight to its offset.
+
+        keep holds on to chunks already in the file when resuming a transfer.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | (0 if keep else os.O_TRUNC), 0o644)
+        os.ftruncate(fd, file_size)
+        if file_size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, file_size)  # Reserve the blocks now rather than run out of space mid-transfer
+            except OSError:
+                pass  # Not supported by this filesystem, the file stays sparse
+        return fd
+
+    def write_chunk(self, file_info, chunk_number, chunk_data):
+        os.pwrite(file_info['fd'], chunk_data, chunk_number * file_info['chunk_size'])
+        if self.fsync_policy == 'always':
+            os.fsync(file_info['fd'])
+
+    def read_chunk(self, file_info, chunk_number):
+        return os.pread(file_info['fd'], file_info['chunk_size'], chunk_number * file_info['chunk_size'])
+
+    def read_blocks(self, file_info):
+        """Yield the received file back from disk a block at a time"""
+        for offset in range(0, file_info['file_size'], self.read_block_size):
+            yield os.pread(file_info['fd'], min(self.read_block_size, file_info['file_size'] - offset), offset)
+
+    def journal_path(self, sender_id, filename):
+        return os.path.join(self.journal_dir, f"{self.checkpoint_name(sender_id, filename)}.json")
+
+    def checkpoint_transfer(self, key):
+        """Flush the partial file, then save the journal recording which chunks in it are valid"""
+        file_info = self.receiving_files[key]
+        if self.fsync_policy != 'never':
+            os.fsync(file_info['fd'])
+        self.save_journal(key)
+        return self.partial_path(file_info['sender_id'], file_info['filename'])
+
+    def save_journal(self, key):
+        """Write the session's journal so it can resume after a link drop or service restart"""
+        file_info = self.receiving_files[key]
+        journal_path = self.journal_path(file_info['sender_id'], file_info['filename'])
+        with self.state_lock:
+            journal = {
+                'checksum': file_info['checksum'],
+                'chunk_size': file_info['chunk_size'],
+                'total_chunks': file_info['total_chunks'],
+                'file_size': file_info['file_size'],
+                'received': chunks_to_ranges(file_info['received_chunks'])
+            }
         try:
-            prefix = "received_" if is_final else "partial_"
-            save_path = os.path.join('received_files', f"{prefix}{filename}")
-            with open(save_path, 'wb') as f:
-                f.write(data)
-            if not is_final:
-                print(f"\nSaved partial file: {save_path}")
-            return save_path
+            # Write then rename, so a crash never leaves a half-written journal behind
+            temp_path = journal_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(journal, f)
+            os.replace(temp_path, journal_path)
         except Exception as e:
-            print(f"Error saving file: {e}")
+            print(f"Error saving journal for {file_info['filename']}: {e}")
+
+    def load_journal(self, sender_id, filename):
+        try:
+            with open(self.journal_path(sender_id, filename)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
             return None
 
-    def verify_and_save_file(self, filename, sender_id=None):
+    def remove_checkpoint(self, sender_id, filename):
+        """Delete the journal and partial data of a finished or abandoned transfer"""
+        for path in (self.journal_path(sender_id, filename), self.partial_path(sender_id, filename)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def find_session(self, sender_id, filename):
+        """Key of the session in which a sender is sending a file, if there is one"""
+        for key, file_info in list(self.receiving_files.items()):
+            if file_info['sender_id'] == sender_id and file_info['filename'] == filename:
+                return key
+        return None
+
+    def message_session(self, data):
+        """Key of the session a sender's message is about, by its transfer id or else by filename"""
+        if data.get('id') is not None:
+            key = (data.get('from'), data['id'])
+            return key if key in self.receiving_files else None
+        return self.find_session(data.get('from'), data.get('f'))
+
+    def find_resumable(self, sender_id, filename, checksum, chunk_size, total_chunks):
+        """Return the chunks of this exact file already held from this sender, from memory or from the journal"""
+        file_info = self.receiving_files.get(self.find_session(sender_id, filename))
+        layout = (checksum, chunk_size, total_chunks)
+        if file_info and (file_info['checksum'], file_info['chunk_size'], file_info['total_chunks']) == layout:
+            return set(file_info['received_chunks'])
+        journal = self.load_journal(sender_id, filename)
+        if journal and os.path.exists(self.partial_path(sender_id, filename)) and \
+                (journal['checksum'], journal['chunk_size'], journal['total_chunks']) == layout:
+            return set(ranges_to_chunks(journal['received']))
+        return None
+
+    def send_resume_state(self, filename, data, sender_id=None):
+        """Answer a resume query with the chunk ranges we already hold"""
+        checksum = data.get('cs')
+        held = self.find_resumable(sender_id, filename, checksum, data.get('sz', self.chunk_size), data.get('tc'))
+        response = {
+            't': 'rs',  # Resume state
+            'f': filename,
+            'cs': checksum,
+            'rg': chunks_to_ranges(held or []),  # [start, end) ranges of chunks we hold
+            'from': self.node_id
+        }
+        if sender_id:
+            response['to'] = sender_id
+        if data.get('id') is not None:
+            response['id'] = data['id']
+        # Keep the reply within one packet; ranges left out are simply sent again
+        while response['rg'] and len(json.dumps(response, separators=(',', ':'))) > DATA_PAYLOAD_LEN:
+            response['rg'].pop()
+        print(f"\nResume query for {filename}: holding {len(held or [])} chunks")
+        return self.spawn(self.send_message_safely(response, delay=self.ack_send_gap))
+
+    def read_signatures(self, filename, block_size):
+        """Block signatures of our saved copy of a file and its size, or None if we have no copy"""
+        signatures = bytearray()
         try:
-            if filename in self.receiving_files:
-                file_info = self.receiving_files[filename]
-                received_data = file_info['data']
-                received_checksum = self.calculate_checksum(received_data)
-                
+            with open(self.saved_path(filename), 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    signatures += block_signature(block)
+                return bytes(signatures), f.tell()
+        except OSError:
+            return None
+
+    async def send_delta_signatures(self, filename, data, sender_id=None):
+        """Answer a delta query with the signatures of our copy, split over as many packets as they need.
+
+        A sender that asked for binary frames gets them so, others in JSON text.
+        """
+        block_size = data.get('k')
+        signed = None
+        if isinstance(block_size, int) and 0 < block_size <= DELTA_MAX_BLOCK:
+            # Hashing the whole copy would stall the loop, so it runs in a worker thread
+            signed = await self.loop.run_in_executor(None, self.read_signatures, filename, block_size)
+        signatures, basis_size = signed or (b'', 0)
+        count = len(signatures) // DELTA_SIGNATURE.size
+        transfer_id = data.get('id')
+        answer = {
+            't': 'ds',  # Delta signatures
+            'f': filename,
+            'k': block_size,
+            'bn': basis_size,
+            'np': count,  # Widest values the fields can take, to size the packets
+            'fb': count,
+            's': '',
+            'from': self.node_id
+        }
+        if sender_id:
+            answer['to'] = sender_id
+        if transfer_id is not None:
+            answer['id'] = transfer_id
+        binary = data.get('bf') and transfer_id is not None
+        if binary:
+            per_packet = (DATA_PAYLOAD_LEN - FRAME_HEADER.size - DELTA_HEADER.size) // DELTA_SIGNATURE.size
+        else:
+            per_packet = max_chunk_size(json.dumps(answer, separators=(',', ':'))) // DELTA_SIGNATURE.size
+        parts = (count + per_packet - 1) // per_packet
+        if parts > data.get('mp', parts):
+            print(f"\nDelta query for {filename}: signatures would take {parts} packets, declining")
+            parts = 0
+        elif parts:
+            print(f"\nDelta query for {filename}: sending {count} block signatures in {parts} packets")
+            self.signed_copies[filename] = {'block_size': block_size, 'size': basis_size}
+        else:
+            print(f"\nDelta query for {filename}: no copy to send a delta against")
+
+        for part in range(max(parts, 1)):
+            first = part * per_packet
+            size = DELTA_SIGNATURE.size
+            packed = signatures[first * size:(first + per_packet) * size] if parts else b''
+            if binary:
+                header = DELTA_HEADER.pack(block_size if parts else 0, basis_size, parts)
+                message = pack_frame(MSG_SIGNATURES, transfer_id, first, header + packed)
+            else:
+                message = dict(answer, np=parts, fb=first, s=base64.b64encode(packed).decode('utf-8'))
+            if not await self.send_message_safely(message, delay=self.ack_send_gap):
+                return False
+        return True
+
+    def request_chunks(self, key, chunk_numbers):
+        """Ask the sender to (re)send chunks we lost, could not rebuild or found corrupt"""
+        file_info = self.receiving_files[key]
+        remaining = sorted(chunk_numbers)
+        while remaining:
+            first = remaining[0]
+            batch = [cn for cn in remaining if cn < first + MAX_ACK_BITMAP_BYTES * 8]
+            remaining = remaining[len(batch):]
+            bitmap = build_chunk_bitmap(batch, first)
+            self.metrics.count('nacks_sent', transfer=key)
+            if file_info['binary']:
+                self.spawn(self.send_message_safely(pack_frame(MSG_NACK, file_info['transfer_id'], first, bitmap),
+                                                    delay=self.ack_send_gap, account=key))
+                continue
+            nack_message = {
+                't': 'nk',  # Chunks the receiver needs again
+                'f': file_info['filename'],
+                'cn': first,
+                'bm': encode_bitmap(bitmap),
+                'from': self.node_id
+            }
+            if file_info['sender_id']:
+                nack_message['to'] = file_info['sender_id']
+            if file_info['transfer_id'] is not None:
+                nack_message['id'] = file_info['transfer_id']
+            self.spawn(self.send_message_safely(nack_message, delay=self.ack_send_gap, account=key))
+
+    def repair_chunks(self, key, bad_chunks):
+        """Forget corrupt chunks and ask the sender for them again, keeping the rest of the file"""
+        file_info = self.receiving_files[key]
+        print(f"\nCorrupt chunks: {[cn + 1 for cn in sorted(bad_chunks)]}, requesting them again")
+        with self.state_lock:
+            file_info['received_chunks'].difference_update(bad_chunks)
+            file_info['cumulative'] = min([file_info['cumulative']] + list(bad_chunks))
+            file_info['merkle_pending'] = []
+        self.request_chunks(key, bad_chunks)
+
+    def start_merkle_descent(self, key):
+        """Walk down from the root comparing tree hashes with the sender's to find the corrupt chunks"""
+        file_info = self.receiving_files[key]
+        levels = merkle_levels(file_info['leaves'])
+        file_info['merkle_tree'] = levels
+        file_info['bad_chunks'] = set()
+        file_info['retransmission_attempts'] = 0
+        top = len(levels) - 1
+        if top == 0:
+            self.repair_chunks(key, [0])  # A single chunk file: the root is the leaf
+            return
+        file_info['merkle_pending'] = merkle_children(levels, top, 0)
+        print(f"\nMerkle root mismatch, locating corrupt chunks among {file_info['total_chunks']}")
+        self.send_merkle_query(key)
+
+    def send_merkle_query(self, key):
+        file_info = self.receiving_files.get(key)
+        if not file_info:
+            return
+        if file_info['merkle_timer']:
+            file_info['merkle_timer'].cancel()
+            file_info['merkle_timer'] = None
+        if not file_info['merkle_pending']:
+            if file_info['bad_chunks']:
+                self.repair_chunks(key, file_info['bad_chunks'])
+            else:
+                self.fail_verification(key, "Merkle root mismatch but every chunk hash matches", file_info['sender_id'])
+            return
+        query = {
+            't': 'mq',  # Merkle query
+            'f': file_info['filename'],
+            'n': file_info['merkle_pending'][:self.merkle_batch],  # [level, index] tree nodes
+            'from': self.node_id
+        }
+        if file_info['sender_id']:
+            query['to'] = file_info['sender_id']
+        if file_info['transfer_id'] is not None:
+            query['id'] = file_info['transfer_id']
+        file_info['merkle_timer'] = self.loop.call_later(self.merkle_query_timeout, self.retry_merkle_query, key)
+        self.spawn(self.send_message_safely(query, delay=self.ack_send_gap))
+
+    def retry_merkle_query(self, key):
+        file_info = self.receiving_files.get(key)
+        if not file_info:
+            return
+        file_info['merkle_timer'] = None
+        if not self.link_up.is_set():
+            return  # The answer was lost with the link; resume_transfers asks again without counting a retry
+        file_info['retransmission_attempts'] += 1
+        if file_info['retransmission_attempts'] > self.max_retransmission_attempts:
+            self.fail_verification(key, "Sender stopped answering Merkle queries", file_info['sender_id'])
+            return
+        self.send_merkle_query(key)
+
+    def handle_merkle_hashes(self, key, nodes):
+        """Compare the sender's tree hashes with ours and descend into the subtrees that differ"""
+        file_info = self.receiving_files.get(key)
+        if not file_info or not file_info['merkle_pending']:
+            return
+        levels = file_info['merkle_tree']
+        file_info['retransmission_attempts'] = 0
+        for level, index, hash_hex in nodes:
+            if [level, index] not in file_info['merkle_pending']:
+                continue
+            file_info['merkle_pending'].remove([level, index])
+            if merkle_node(levels, level, index).hex() == hash_hex:
+                continue
+            if level == 0:
+                file_info['bad_chunks'].add(index)
+            else:
+                file_info['merkle_pending'].extend(merkle_children(levels, level, index))
+        self.send_merkle_query(key)
+
+    def find_corrupt_chunks(self, file_info):
+        """Chunks whose data on disk no longer matches the hash taken when they arrived"""
+        leaves = file_info['leaves']
+        size = MERKLE_HASH_LEN
+        return [cn for cn in range(file_info['total_chunks'])
+                if merkle_leaf(self.read_chunk(file_info, cn)) != leaves[cn * size:(cn + 1) * size]]
+
+    def fail_verification(self, key, message, sender_id=None):
+        file_info = self.receiving_files[key]
+        print(f"\n{message} - file transfer failed")
+        self.metrics.finish_transfer(key, False)
+        self.send_error(file_info['filename'], message, sender_id, file_info['transfer_id'])
+        self.discard_transfer(key)
+        self.remove_checkpoint(file_info['sender_id'], file_info['filename'])
+        print("File transfer state cleaned up after error.")
+
+    def file_checksum(self, file_info):
+        """MD5 of the partial file, read back in blocks"""
+        if self.fsync_policy != 'never':
+            os.fsync(file_info['fd'])
+        md5 = hashlib.md5()
+        for block in self.read_blocks(file_info):
+            md5.update(block)
+        return md5.hexdigest()
+
+    def save_file(self, file_info, save_path):
+        """Move the verified partial file into place, decompressing it and applying a delta if needed"""
+        if not file_info['codec'] and not file_info['delta']:
+            os.replace(self.partial_path(file_info['sender_id'], file_info['filename']), save_path)
+            return
+
+        decompressed_size = 0
+
+        def received_blocks():
+            nonlocal decompressed_size
+            blocks = self.read_blocks(file_info)
+            if file_info['codec']:
+                blocks = decompress_stream(file_info['codec'], blocks)
+            for block in blocks:
+                decompressed_size += len(block)
+                yield block
+
+        # Build the file beside the copy a delta reads from, then swap it in; neither is held in memory
+        delta = file_info['delta']
+        basis_fd = os.open(save_path, os.O_RDONLY) if delta else None
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), prefix=f".{os.path.basename(save_path)}.")
+        try:
+            blocks = received_blocks()
+            if delta:
+                blocks = apply_delta(blocks, lambda offset, length: os.pread(basis_fd, length, offset),
+                                     delta['block_size'])
+            md5 = hashlib.md5()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for block in blocks:
+                    f.write(block)
+                    md5.update(block)
+                    size += len(block)
+                f.flush()
+                if self.fsync_policy != 'never':
+                    os.fsync(f.fileno())
+            if file_info['codec']:
+                print(f"Decompressed with {file_info['codec']}: {decompressed_size} bytes")
+                if decompressed_size != file_info['uncompressed_size']:
+                    raise ValueError(f"Decompressed size {decompressed_size} does not match "
+                                     f"{file_info['uncompressed_size']}")
+            if delta:
+                print(f"Rebuilt from our previous copy: {size} bytes")
+                if size != delta['size'] or md5.hexdigest() != delta['checksum']:
+                    raise ValueError(f"File rebuilt from delta does not match checksum {delta['checksum']}")
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, save_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        finally:
+            if basis_fd is not None:
+                os.close(basis_fd)
+
+    async def verify_and_save_file(self, key, sender_id=None):
+        try:
+            if key in self.receiving_files:
+                file_info = self.receiving_files[key]
+                filename = file_info['filename']
+                if file_info['verifying']:
+                    return False  # A repeated completion message while the file is being checked
+                if file_info['merkle_root']:
+                    # Leaves were hashed as chunks arrived, so checking the root needs no pass over the file
+                    root = merkle_levels(file_info['leaves'])[-1].hex()
+                    if root != file_info['merkle_root']:
+                        self.start_merkle_descent(key)
+                        return False
+                # Reading the whole file back would stall the loop, so it runs in a worker thread
+                file_info['verifying'] = True
+                try:
+                    received_checksum = await self.loop.run_in_executor(None, self.file_checksum, file_info)
+                finally:
+                    file_info['verifying'] = False
+
                 print(f"\nVerifying file {filename}")
-                print(f"Received size: {len(received_data)} bytes")
+                print(f"Received size: {os.fstat(file_info['fd']).st_size} bytes")
                 print(f"Received checksum: {received_checksum}")
                 print(f"Expected checksum: {file_info['checksum']}")
-                
+
                 if received_checksum == file_info['checksum']:
-                    save_path = self.save_partial_file(filename, received_data, True)
+                    save_path = self.saved_path(filename)
+                    file_info['verifying'] = True
+                    try:
+                        await self.loop.run_in_executor(None, self.save_file, file_info, save_path)
+                    finally:
+                        file_info['verifying'] = False
                     print(f"File saved successfully: {save_path}")
-                    transfer_time = time.time() - file_info['start_time']
+                    self.signed_copies.pop(filename, None)
+                    transfer_time = self.loop.time() - file_info['start_time']
                     print(f"Transfer time: {transfer_time:.2f} seconds")
-                    
+                    self.metrics.finish_transfer(key, True)
+                    self.spawn(self.write_metrics())
+
                     # Clean up the file transfer state
-                    del self.receiving_files[filename]
+                    self.discard_transfer(key)
+                    self.remove_checkpoint(file_info['sender_id'], filename)
                     print("File transfer completed and cleaned up.")
+                    # A broadcast sender waits for every receiver's verdict, a unicast one for the Merkle check
+                    if file_info['merkle_root'] or file_info['broadcast']:
+                        self.completed_files[(file_info['sender_id'], filename)] = file_info['checksum']
+                        self.send_verified(filename, sender_id, file_info['transfer_id'], file_info['broadcast'])
                     return True
-                else:
-                    print("Checksum mismatch - file transfer failed")
-                    missing_chunks = set(range(file_info['total_chunks'])) - file_info['received_chunks']
-                    print(f"Missing chunks: {sorted(list(missing_chunks))}")
-                    self.send_error(filename, "Checksum verification failed", sender_id)
-                    
-                    # Still clean up even on failure
-                    del self.receiving_files[filename]
-                    print("File transfer state cleaned up after error.")
+
+                corrupt_chunks = []
+                if file_info['merkle_root']:
+                    file_info['verifying'] = True
+                    try:
+                        corrupt_chunks = await self.loop.run_in_executor(None, self.find_corrupt_chunks, file_info)
+                    finally:
+                        file_info['verifying'] = False
+                if corrupt_chunks:
+                    # The chunks matched the Merkle root on arrival, so the damage happened on disk
+                    self.repair_chunks(key, corrupt_chunks)
                     return False
+
+                print("Checksum mismatch - file transfer failed")
+                self.metrics.finish_transfer(key, False)
+                missing_chunks = set(range(file_info['total_chunks'])) - file_info['received_chunks']
+                print(f"Missing chunks: {sorted(list(missing_chunks))}")
+                self.send_error(filename, "Checksum verification failed", sender_id, file_info['transfer_id'])
+
+                # Still clean up even on failure
+                self.discard_transfer(key)
+                self.remove_checkpoint(file_info['sender_id'], filename)
+                print("File transfer state cleaned up after error.")
+                return False
         except Exception as e:
             print(f"Error verifying file: {e}")
+            self.metrics.finish_transfer(key, False)
             # Clean up on exception too
-            if filename in self.receiving_files:
-                del self.receiving_files[filename]
+            if key in self.receiving_files:
+                self.discard_transfer(key)
                 print("File transfer state cleaned up after exception.")
             return False
 
+    def send_verified(self, filename, sender_id=None, transfer_id=None, broadcast=False):
+        """Tell a sender waiting on the Merkle check, or on every receiver of a broadcast, that the file was saved"""
+        if broadcast:
+            # Every receiver of a broadcast answers at once; a random wait keeps the verdicts from colliding
+            return self.loop.call_later(random.uniform(0, self.multicast_ack_jitter),
+                                        self.send_verified, filename, sender_id, transfer_id)
+        verified_message = {
+            't': 'fv',  # File verified
+            'f': filename,
+            'from': self.node_id
+        }
+        if sender_id:
+            verified_message['to'] = sender_id
+        if transfer_id is not None:
+            verified_message['id'] = transfer_id
+        return self.spawn(self.send_message_safely(verified_message, delay=self.ack_send_gap))
+
     def announce_presence(self):
         """Announce this node's presence to the network"""
         announcement = {
             't': 'announce',
             'id': self.node_id,
             'role': 'receiver',
+            'caps': self.capabilities,
             'time': int(time.time())
         }
-        if self.send_message_safely(announcement, delay=1.0):
+        if self.run_coroutine(self.send_message_safely(announcement, delay=1.0)):
             print(f"Announced presence as {self.node_id}")
             return True
         else:
             print("Failed to announce presence")
             return False
 
-    def handle_file_message(self, message_data):
+    def add_chunk(self, file_info, chunk_number, chunk_data, leaf=None):
+        """Write a new chunk at its offset, then record it as received and keep a copy in the chunk store"""
+        self.write_chunk(file_info, chunk_number, chunk_data)
+        leaf = leaf or merkle_leaf(chunk_data)
+        leaf_offset = chunk_number * MERKLE_HASH_LEN
+        file_info['leaves'][leaf_offset:leaf_offset + MERKLE_HASH_LEN] = leaf
+        with self.state_lock:
+            file_info['received_chunks'].add(chunk_number)
+            while file_info['cumulative'] in file_info['received_chunks']:
+                file_info['cumulative'] += 1
+        if self.chunk_store:
+            self.chunk_store.put(leaf, chunk_data)
+
+    def store_chunk(self, key, chunk_number, chunk_data, sender_id=None):
+        """Place a received chunk in the file buffer and schedule its acknowledgment"""
+        file_info = self.receiving_files[key]
+        filename = file_info['filename']
         try:
-            data = json.loads(message_data)
-            msg_type = data.get('t', data.get('type', ''))
-            filename = data.get('f', data.get('filename', ''))
-            sender_id = data.get('from')
-            target_node = data.get('to')
+            now = self.loop.time()
+            # A pause longer than any ACK delay is an outage or a timeout, not the sender's pace
+            if file_info['last_arrival'] is not None:
+                gap = now - file_info['last_arrival']
+                previous = file_info['arrival_gap']
+                file_info['arrival_gap'] = gap if previous is None else 0.8 * previous + 0.2 * gap
+            file_info['last_arrival'] = now
 
-            # Reset the chunk timeout whenever we receive any file-related message
-            self.last_chunk_time = time.time()
+            if chunk_number not in file_info['received_chunks']:
+                self.add_chunk(file_info, chunk_number, chunk_data)
+                file_info['last_chunk'] = chunk_number
+                self.metrics.count('chunks_received', transfer=key)
 
-            # Check if this message is targeted for us or is a broadcast
-            if target_node and target_node != self.node_id:
-                print(f"\nIgnoring file message for {target_node} (we are {self.node_id})")
-                return
+                progress = (len(file_info['received_chunks']) / file_info['total_chunks']) * 100
+                print(f"\rReceiving {filename}: {progress:.1f}% "
+                      f"(Chunk {chunk_number + 1}/{file_info['total_chunks']})", end='')
 
-            # Map shortened message types to full types
-            if msg_type == 'fs':
-                msg_type = 'file_start'
-            elif msg_type == 'fc' and 'cs' in data:  # If has checksum, it's file completion
-                msg_type = 'file_completion'
-            elif msg_type == 'fc':
-                msg_type = 'file_chunk'
-            elif msg_type == 'announce':
-                # Handle node announcements
-                node_id = data.get('id')
-                role = data.get('role')
-                if node_id != self.node_id:  # Don't track ourselves
-                    self.known_nodes[node_id] = {
-                        'role': role,
-                        'last_seen': time.time()
-                    }
-                    print(f"Discovered node: {node_id} (role: {role})")
-                return
-            elif msg_type == 'discover':
-                # Respond to discovery requests
-                requester_id = data.get('id')
-                if requester_id != self.node_id:  # Don't respond to our own requests
-                    response = {
-                        't': 'announce',
-                        'id': self.node_id,
-                        'role': 'receiver',
-                        'time': int(time.time())
-                    }
-                    self.send_message_safely(response, delay=1.0)
-                    print(f"Responded to discovery request from {requester_id}")
-                return
+                # Save partial file and journal periodically
+                if len(file_info['received_chunks']) % self.checkpoint_every == 0:
+                    self.checkpoint_transfer(key)
 
-            if msg_type == 'file_start':
-                print(f"\nStarting to receive file: {filename}")
-                if target_node:
-                    print(f"This file is specifically for us ({self.node_id})")
-                print(f"From sender: {sender_id or 'Unknown'}")
-                print(f"Expected size: {data.get('fs', data.get('file_size'))} bytes")
-                print(f"Expected chunks: {data.get('tc', data.get('total_chunks'))}")
-                print(f"Expected checksum: {data.get('cs', data.get('checksum'))}")
-                batch_size = data.get('bs', data.get('batch_size', 1))  # Default to 1 if not specified
-                print(f"Receiving {batch_size} chunk at a time")
-                
-                self.receiving_files[filename] = {
-                    'data': bytearray(),
-                    'total_chunks': data.get('tc', data.get('total_chunks')),
-                    'received_chunks': set(),
-                    'checksum': data.get('cs', data.get('checksum')),
-                    'file_size': data.get('fs', data.get('file_size')),
-                    'start_time': time.time(),
-                    'retransmission_attempts': 0,
-                    'batch_size': batch_size,
-                    'sender_id': sender_id
-                }
-                self.last_chunk_time = time.time()
+                # Acknowledge once per window, or when the ACK timer fires
+                self.schedule_ack(key, sender_id)
+                if file_info['fec_group']:
+                    self.update_fec_group(key, chunk_number // file_info['fec_group'])
+            else:
+                # A duplicate means our last ACK was probably lost, so make sure another goes out
+                self.metrics.count('duplicate_chunks', transfer=key)
+                file_info['last_chunk'] = chunk_number
+                self.schedule_ack(key, sender_id)
+        except Exception as e:
+            print(f"\nError processing chunk {chunk_number}: {e}")
+            self.send_error(filename, f"Error processing chunk {chunk_number}", sender_id, file_info['transfer_id'])
 
-            elif msg_type == 'file_chunk':
-                self.last_chunk_time = time.time()
-                if filename in self.receiving_files:
-                    try:
-                        chunk_data = base64.b64decode(data.get('d', data.get('data')))
-                        chunk_number = data.get('cn', data.get('chunk_number'))
-                        batch_number = data.get('bn', data.get('batch_number'))
-                        file_info = self.receiving_files[filename]
-                        
-                        # Process the chunk
-                        if chunk_number not in file_info['received_chunks']:
-                            file_info['received_chunks'].add(chunk_number)
-                            insert_pos = chunk_number * self.chunk_size
-                            
-                            # Ensure data buffer is large enough
-                            if insert_pos >= len(file_info['data']):
-                                file_info['data'].extend(b'\0' * (insert_pos - len(file_info['data']) + len(chunk_data)))
-                            
-                            # Insert chunk data
-                            file_info['data'][insert_pos:insert_pos + len(chunk_data)] = chunk_data
-                            
-                            progress = (len(file_info['received_chunks']) / file_info['total_chunks']) * 100
-                            print(f"\rReceiving {filename}: {progress:.1f}% (Chunk {chunk_number + 1}/{file_info['total_chunks']})", end='')
-                            
-                            # Save partial file periodically
-                            if len(file_info['received_chunks']) % 10 == 0:
-                                self.save_partial_file(filename, file_info['data'])
-                            
-                            # Send acknowledgment for this chunk with added delay
-                            time.sleep(2)  # Increased delay before sending ACK
-                            self.send_chunk_ack(filename, chunk_number, sender_id)
-                        else:
-                            # If we already have this chunk, still send ACK
-                            self.send_chunk_ack(filename, chunk_number, sender_id)
-                    except Exception as e:
-                        print(f"\nError processing chunk {chunk_number}: {e}")
-                        self.send_error(filename, f"Error processing chunk {chunk_number}", sender_id)
+    def store_parity(self, key, parity_number, parity_data):
+        """Keep an FEC parity chunk until its group is complete or has been rebuilt"""
+        file_info = self.receiving_files[key]
+        group, index = divmod(parity_number, file_info['fec_parity'])
+        file_info['parity'].setdefault(group, {})[index] = parity_data
+        self.update_fec_group(key, group, last_frame=index == file_info['fec_parity'] - 1)
+
+    def update_fec_group(self, key, group, last_frame=False):
+        """Rebuild missing chunks of an FEC group and ask for the ones that cannot be rebuilt.
+
+        A group has been sent in full once its last parity chunk or a frame of a later
+        group arrives; only then is an unrecoverable group reported with a NACK.
+        """
+        file_info = self.receiving_files.get(key)
+        if not file_info:
+            return
+        finished = list(range(file_info['sent_groups'], group))
+        if last_frame:
+            finished.append(group)
+        file_info['sent_groups'] = max(file_info['sent_groups'], group + 1 if last_frame else group)
 
-            elif msg_type == 'file_completion':
-                if filename in self.receiving_files:
-                    print("\nFile transfer complete, verifying file...")
-                    self.verify_and_save_file(filename, sender_id)
+        for finished_group in [group] + finished:
+            if not self.recover_group(key, finished_group) and finished_group in finished:
+                if finished_group not in file_info['nacked_groups']:
+                    file_info['nacked_groups'].add(finished_group)
+                    self.send_nack(key, finished_group)
+
+    def recover_group(self, key, group):
+        """Rebuild the missing data chunks of a group from its parity; False if too much was lost"""
+        file_info = self.receiving_files.get(key)
+        if not file_info:
+            return True
+        group_size = file_info['fec_group']
+        chunk_size = file_info['chunk_size']
+        first = group * group_size
+        last = min(first + group_size, file_info['total_chunks'])
+        present = {cn - first for cn in range(first, last) if cn in file_info['received_chunks']}
+        if len(present) == last - first:
+            file_info['parity'].pop(group, None)
+            return True
 
+        parity_chunks = file_info['parity'].get(group, {})
+        if len(present) + len(parity_chunks) < last - first:
+            return False
+        data_chunks = {index: self.read_chunk(file_info, first + index) for index in present}
+        recovered = fec_decode(data_chunks, parity_chunks, last - first, chunk_size)
+        if recovered is None:
+            return False
+
+        file_info['parity'].pop(group, None)
+        print(f"\nRebuilt chunks {[first + index + 1 for index in sorted(recovered)]} from parity")
+        self.metrics.count('fec_recovered', len(recovered), transfer=key)
+        for index, chunk_data in sorted(recovered.items()):
+            chunk_number = first + index
+            # The final chunk of the file is shorter than the padded parity blocks
+            chunk_data = chunk_data[:file_info['file_size'] - chunk_number * chunk_size]
+            self.store_chunk(key, chunk_number, chunk_data, file_info['sender_id'])
+        return True
+
+    def send_nack(self, key, group):
+        """Ask the sender to retransmit the chunks of an FEC group that could not be rebuilt"""
+        file_info = self.receiving_files[key]
+        first = group * file_info['fec_group']
+        last = min(first + file_info['fec_group'], file_info['total_chunks'])
+        missing = [cn for cn in range(first, last) if cn not in file_info['received_chunks']]
+        print(f"\nCannot rebuild chunks {[cn + 1 for cn in missing]}, requesting retransmission")
+        self.request_chunks(key, missing)
+
+    def answer_chunk_offer(self, key, first_chunk, hashes):
+        """Fill offered chunks from the chunk store and tell the sender which of them we now hold.
+
+        hashes are the Merkle leaf hashes of consecutive chunks from first_chunk on. Chunks
+        taken from the store are acknowledged by this answer, not by an ACK.
+        """
+        file_info = self.receiving_files[key]
+        filename = file_info['filename']
+        offered = range(first_chunk, min(first_chunk + len(hashes) // MERKLE_HASH_LEN, file_info['total_chunks']))
+        filled = 0
+        for chunk_number in offered:
+            if chunk_number in file_info['received_chunks'] or not self.chunk_store:
+                continue
+            index = chunk_number - first_chunk
+            leaf = hashes[index * MERKLE_HASH_LEN:(index + 1) * MERKLE_HASH_LEN]
+            chunk_data = self.chunk_store.get(leaf)
+            if chunk_data is not None:
+                self.add_chunk(file_info, chunk_number, chunk_data, leaf)
+                filled += 1
+        if filled:
+            self.metrics.count('chunks_from_store', filled, transfer=key)
+            print(f"\nTook {filled} chunks of {filename} from the chunk store")
+        bitmap = build_chunk_bitmap([cn for cn in offered if cn in file_info['received_chunks']], first_chunk)
+        if file_info['binary']:
+            message = pack_frame(MSG_HELD, file_info['transfer_id'], first_chunk, bitmap)
+        else:
+            message = {
+                't': 'oh',  # Offered chunks held
+                'f': filename,
+                'cn': first_chunk,
+                'bm': encode_bitmap(bitmap),
+                'from': self.node_id
+            }
+            if file_info['sender_id']:
+                message['to'] = file_info['sender_id']
+            if file_info['transfer_id'] is not None:
+                message['id'] = file_info['transfer_id']
+        return self.spawn(self.send_message_safely(message, delay=self.ack_send_gap, account=key))
+
+    def reject_corrupt_chunk(self, key, chunk_number, parity=False):
+        """Drop a chunk whose CRC does not match; data chunks are requested again straight away"""
+        print(f"\nCRC mismatch on {'parity ' if parity else ''}chunk {chunk_number + 1}, discarding it")
+        self.metrics.count('corrupt_chunks', transfer=key)
+        if not parity:
+            self.request_chunks(key, [chunk_number])
+
+    def handle_frame(self, frame, radio_id=None):
+        """Handle a binary frame received on the private app port"""
+        try:
+            msg_type, transfer_id, chunk_number, flags, payload = unpack_frame(frame)
+            # Frames carry no sender, so the session is told apart by the radio it came from
+            key = self.transfer_ids.get((radio_id, transfer_id))
+            if key is None or key not in self.receiving_files:
+                return  # Not a transfer addressed to us
+            self.last_chunk_time = time.time()
+            if msg_type == MSG_CHUNK and flags & FLAG_CRC:
+                payload, crc_ok = check_chunk_crc(payload)
+                if not crc_ok:
+                    self.reject_corrupt_chunk(key, chunk_number, parity=bool(flags & FLAG_PARITY))
+                    return
+            if msg_type == MSG_CHUNK and flags & FLAG_PARITY:
+                self.store_parity(key, chunk_number, payload)
+            elif msg_type == MSG_CHUNK:
+                self.store_chunk(key, chunk_number, payload, self.receiving_files[key]['sender_id'])
+            elif msg_type == MSG_OFFER:
+                self.answer_chunk_offer(key, chunk_number, payload)
+        except Exception as e:
+            print(f"\nError handling frame: {e}")
+
+    def register_handler(self, msg_type, handler):
+        """Route JSON messages of a type to handler(data, radio_id), replacing any earlier handler"""
+        self.handlers[msg_type] = handler
+
+    def dispatch(self, data, radio_id=None):
+        """Hand a parsed control message addressed to us to the handler registered for its type"""
+        # Reset the chunk timeout whenever we receive any file-related message
+        self.last_chunk_time = time.time()
+
+        # Check if this message is targeted for us or is a broadcast
+        target_node = data.get('to')
+        if target_node and target_node != self.node_id:
+            print(f"\nIgnoring file message for {target_node} (we are {self.node_id})")
+            return
+
+        handler = self.handlers.get(data['t'])
+        if not handler:
+            return
+        try:
+            handler(data, radio_id)
         except Exception as e:
             print(f"\nError handling file message: {e}")
             traceback.print_exc()
-            if filename:
-                self.send_error(filename, f"General error: {str(e)}", sender_id)
+            if data.get('f'):
+                self.send_error(data['f'], f"General error: {str(e)}", data.get('from'), data.get('id'))
+
+    def handle_announce(self, data, radio_id=None):
+        node_id = data.get('id')
+        role = data.get('role')
+        if node_id != self.node_id:  # Don't track ourselves
+            self.known_nodes[node_id] = {
+                'role': role,
+                'radio_id': radio_id,  # Radio the announcement came from
+                'last_seen': time.time()
+            }
+            print(f"Discovered node: {node_id} (role: {role})")
+
+    def handle_merkle_answer(self, data, radio_id=None):
+        """Sender's answer to a Merkle query"""
+        key = self.message_session(data)
+        if key:
+            self.handle_merkle_hashes(key, data.get('n', []))
+
+    def handle_resume_query(self, data, radio_id=None):
+        """Tell the sender which chunks of this file we already hold"""
+        file_info = self.receiving_files.get(self.message_session(data))
+        if file_info:
+            # Asked mid-transfer, after the sender's link was down; the gap is not its pace
+            file_info['last_arrival'] = None
+        self.send_resume_state(data.get('f'), data, data.get('from'))
+
+    def handle_delta_query(self, data, radio_id=None):
+        """Send the sender the block signatures of our copy, so it only sends what changed"""
+        self.spawn(self.send_delta_signatures(data.get('f'), data, data.get('from')))
+
+    def handle_chunk_offer(self, data, radio_id=None):
+        """Sender's hashes of upcoming chunks, so it can skip those we already hold"""
+        key = self.message_session(data)
+        if key:
+            self.answer_chunk_offer(key, data.get('cn', 0), base64.b64decode(data.get('h', '')))
+
+    def handle_discover(self, data, radio_id=None):
+        requester_id = data.get('id')
+        if requester_id != self.node_id:  # Don't respond to our own requests
+            response = {
+                't': 'announce',
+                'id': self.node_id,
+                'role': 'receiver',
+                'caps': self.capabilities,
+                'time': int(time.time())
+            }
+            self.spawn(self.send_message_safely(response, delay=1.0))
+            print(f"Responded to discovery request from {requester_id}")
+
+    def handle_file_start(self, data, radio_id=None):
+        filename = data.get('f')
+        sender_id = data.get('from')
+        target_node = data.get('to')
+        print(f"\nStarting to receive file: {filename}")
+        if target_node:
+            print(f"This file is specifically for us ({self.node_id})")
+        print(f"From sender: {sender_id or 'Unknown'}")
+        print(f"Expected size: {data.get('fs')} bytes")
+        print(f"Expected chunks: {data.get('tc')}")
+        print(f"Expected checksum: {data.get('cs')}")
+        chunk_size = data.get('sz', self.chunk_size)
+        print(f"Chunk size: {chunk_size} bytes")
+        codec = data.get('cc')
+        if codec:
+            print(f"Compressed with {codec}, {data.get('us')} bytes uncompressed")
+        delta = None
+        if data.get('dk'):
+            # Size and checksum of the rebuilt file follow in the completion message
+            delta = {'block_size': data['dk'], 'size': None, 'checksum': None}
+            print(f"Delta against our copy, in blocks of {delta['block_size']} bytes")
+            # The copy the signatures came from must still be there to copy blocks out of
+            try:
+                copy_size = os.path.getsize(self.saved_path(filename))
+            except OSError:
+                copy_size = None
+            if self.signed_copies.get(filename) != {'block_size': delta['block_size'], 'size': copy_size}:
+                print(f"Our copy of {filename} changed since it was signed, cannot apply the delta")
+                self.send_error(filename, "Copy for the delta changed", sender_id, data.get('id'))
+                return
+        fec_group = data.get('fm')
+        if fec_group:
+            print(f"FEC: {data.get('fk')} parity chunks per {fec_group} data chunks")
+        batch_size = data.get('bs', 1)  # Sender's window size, 1 for stop-and-wait senders
+        print(f"Sender window: {batch_size} chunks in flight")
+        # The sender's short transfer id keys the session and replaces the filename in every binary frame;
+        # senders that give none are keyed by filename, one session per file
+        transfer_id = data.get('id')
+        binary = data.get('wf') == 'b' and transfer_id is not None
+        print(f"Wire format: {'binary frames' if binary else 'JSON text'}")
+        key = (sender_id, transfer_id if transfer_id is not None else filename)
+
+        # Pick up where we left off if we hold part of this exact file, in memory or on disk
+        total_chunks = data.get('tc')
+        checksum = data.get('cs')
+        file_size = data.get('fs')
+        file_info = self.receiving_files.get(key)
+        if file_info and (file_info['checksum'], file_info['total_chunks']) == (checksum, total_chunks):
+            print("Start message repeated, our confirmation was lost")
+            self.confirm_start(key, sender_id)
+            return
+        received_chunks = self.find_resumable(sender_id, filename, checksum, chunk_size, total_chunks)
+        # A new start from the same sender replaces its earlier session for the file
+        for old_key in (self.find_session(sender_id, filename), key):
+            if old_key in self.receiving_files:
+                self.discard_transfer(old_key)
+        if received_chunks:
+            print(f"Resuming: {len(received_chunks)}/{total_chunks} chunks already received")
+        else:
+            received_chunks = set()
+            self.remove_checkpoint(sender_id, filename)
+        cumulative = 0
+        while cumulative in received_chunks:
+            cumulative += 1
+        self.completed_files.pop((sender_id, filename), None)
+
+        partial_path = self.partial_path(sender_id, filename)
+        self.receiving_files[key] = {
+            'filename': filename,
+            # Chunks are written here at their offsets
+            'fd': self.open_partial_file(partial_path, file_size, keep=bool(received_chunks)),
+            'leaves': bytearray(total_chunks * MERKLE_HASH_LEN),  # Merkle leaf hash of each chunk, taken on arrival
+            'merkle_root': data.get('mr'),  # Only sent by senders that wait for our verdict
+            'merkle_tree': None,
+            'merkle_pending': [],  # [level, index] tree nodes still to compare with the sender
+            'merkle_timer': None,
+            'bad_chunks': set(),
+            'verifying': False,  # Set while the file is read back in a worker thread
+            'total_chunks': total_chunks,
+            'received_chunks': received_chunks,
+            'cumulative': cumulative,  # Every chunk below this number has been received
+            'last_chunk': None,
+            'unacked': 0,  # Chunks received since the last ACK was sent
+            'ack_timer': None,
+            'last_arrival': None,
+            'arrival_gap': None,  # Smoothed time between chunk arrivals
+            'checksum': checksum,
+            'file_size': file_size,
+            'chunk_size': chunk_size,
+            'codec': codec,
+            'delta': delta,  # Block size, size and MD5 of the file rebuilt from our copy, None for a whole file
+            'fec_group': fec_group,  # Data chunks per FEC group, None without FEC
+            'fec_parity': data.get('fk', 0),
+            'parity': {},  # FEC group -> {parity index: parity chunk}
+            'sent_groups': 0,  # Groups below this have been sent in full at least once
+            'nacked_groups': set(),
+            'uncompressed_size': data.get('us'),
+            'start_time': self.loop.time(),
+            'retransmission_attempts': 0,
+            'batch_size': batch_size,
+            'sender_id': sender_id,
+            'radio_id': radio_id,  # Radio the sender transmits from, which tells its binary frames apart
+            'broadcast': not target_node,  # Other receivers may be ACKing the same chunks
+            'transfer_id': transfer_id,
+            'binary': binary  # Chunks and ACKs travel as binary frames
+        }
+        if binary:
+            self.transfer_ids[(radio_id, transfer_id)] = key
+        self.metrics.start_transfer(key, filename, sender_id, data.get('us') or file_size)
+        # Chunks kept from an earlier attempt are hashed from disk
+        file_info = self.receiving_files[key]
+        for chunk_number in received_chunks:
+            leaf_offset = chunk_number * MERKLE_HASH_LEN
+            leaf = merkle_leaf(self.read_chunk(file_info, chunk_number))
+            file_info['leaves'][leaf_offset:leaf_offset + MERKLE_HASH_LEN] = leaf
+        self.last_chunk_time = time.time()
+        self.confirm_start(key, sender_id)
+
+    def confirm_start(self, key, sender_id=None):
+        """ACK a start message, so the sender knows the session exists; the ACK lists chunks already held"""
+        with self.state_lock:
+            file_info = self.receiving_files.get(key)
+            if not file_info:
+                return
+            if file_info['broadcast']:
+                # Every receiver answers a broadcast start; a random wait keeps the ACKs from colliding
+                if not file_info['ack_timer']:
+                    file_info['ack_timer'] = self.loop.call_later(random.uniform(0, self.multicast_ack_jitter),
+                                                                  self.send_chunk_ack, key, sender_id)
+                return
+        self.send_chunk_ack(key, sender_id)
+
+    def handle_chunk_or_completion(self, data, radio_id=None):
+        """'fc' carries a chunk, or completes the file when it has a checksum"""
+        if 'cs' in data:
+            self.handle_file_completion(data)
+        else:
+            self.handle_file_chunk(data)
+
+    def handle_file_chunk(self, data):
+        # Senders that know about sessions name the transfer by its short id instead of the filename
+        key = self.message_session(data)
+        sender_id = data.get('from')
+        self.last_chunk_time = time.time()
+        if key:
+            chunk_data = base64.b64decode(data['d'])
+            if 'cr' in data and int(data['cr'], 16) != chunk_crc(chunk_data):
+                self.reject_corrupt_chunk(key, data.get('pn', data.get('cn')), parity='pn' in data)
+            elif 'pn' in data:
+                self.store_parity(key, data['pn'], chunk_data)
+            else:
+                chunk_number = data.get('cn')
+                self.store_chunk(key, chunk_number, chunk_data, sender_id)
+
+    def handle_file_completion(self, data):
+        key = self.message_session(data)
+        filename = data.get('f')
+        sender_id = data.get('from')
+        if key:
+            print("\nFile transfer complete, verifying file...")
+            if self.receiving_files[key]['delta']:
+                self.receiving_files[key]['delta'].update(size=data.get('dn'), checksum=data.get('dm'))
+            self.spawn(self.verify_and_save_file(key, sender_id))
+        elif self.completed_files.get((sender_id, filename)) == data.get('cs'):
+            # Our earlier verdict was lost
+            self.send_verified(filename, sender_id, data.get('id'), broadcast=not data.get('to'))
 
     def check_timeout(self):
         current_time = time.time()
-        
-        # Only check for timeout if we have active transfers
-        if not self.receiving_files:
+
+        # Only check for timeout if we have active transfers and the keepalive is not already reconnecting
+        if not self.receiving_files or not self.link_up.is_set():
             return True
-            
+
         if current_time - self.last_chunk_time > self.chunk_timeout:
             print(f"\nTransfer timeout detected - {int(current_time - self.last_chunk_time)} seconds since last chunk")
             print("Attempting to reconnect...")
-            
+
             # Try reconnection
-            reconnect_success = self.reconnect()
-            
+            reconnect_success = self.run_coroutine(self.reconnect())
+
             # If reconnection fails multiple times, we should save partial files
             if not reconnect_success:
                 print("Reconnection failed repeatedly. Saving partial files...")
                 # Save partial data for all in-progress transfers
-                for filename in list(self.receiving_files.keys()):
+                for key, file_info in list(self.receiving_files.items()):
                     try:
-                        partial_path = self.save_partial_file(filename, self.receiving_files[filename]['data'])
+                        partial_path = self.checkpoint_transfer(key)
                         print(f"Saved partial data to {partial_path}")
                     except Exception as e:
-                        print(f"Error saving partial file {filename}: {e}")
-            
+                        print(f"Error saving partial file {file_info['filename']}: {e}")
+
             return reconnect_success
         return True
 
+    def show_send_queue(self):
+        """Display the send queue depth and the airtime our packets have used"""
+        print(f"\nSend queue: {self.queue_depth()} messages waiting")
+        if self.lora_preset:
+            duty_cycle = REGION_DUTY_CYCLE.get(self.region, 1.0)
+            print(f"Airtime used: {self.airtime_used:.1f}s on {self.lora_preset}, "
+                  f"budget {duty_cycle * 100:g}% duty cycle ({self.region})")
+
+    async def run_metrics_writer(self):
+        """Refresh the metrics files every metrics_interval seconds"""
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            await self.write_metrics()
+
+    async def write_metrics(self):
+        if not self.status_file and not self.prometheus_file:
+            return
+        try:
+            await self.loop.run_in_executor(None, self.metrics.write, self.status_file, self.prometheus_file)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+    def show_metrics(self):
+        """Display the counters per sender and the goodput of recent transfers"""
+        status = self.metrics.snapshot()
+        for name, scope in [('all senders', status['totals'])] + list(status['peers'].items()):
+            counters = scope['counters']
+            print(f"\n{name}: {counters['chunks_received']} chunks received, "
+                  f"{counters['duplicate_chunks']} duplicates, "
+                  f"{counters['corrupt_chunks']} corrupt, {counters['fec_recovered']} rebuilt, "
+                  f"{counters['acks_sent']} ACKs / {counters['nacks_sent']} NACKs sent")
+        totals = status['totals']
+        latency = totals['histograms']['reconnect_duration']['mean']
+        print(f"Reconnects: {totals['counters']['reconnects']} (mean {latency if latency is not None else '-'}s), "
+              f"{totals['counters']['reconnects_avoided']} avoided, {totals['counters']['reconnect_failures']} failed, "
+              f"{totals['counters']['link_losses']} link losses")
+        for key, transfer in status['transfers'].items():
+            goodput = f"{transfer['goodput']} B/s" if transfer['goodput'] is not None else '-'
+            print(f"  {transfer['filename']} from {transfer['peer'] or 'unknown'}: {transfer['state']}, "
+                  f"{transfer['duration']}s, goodput {goodput}")
+
     def list_known_nodes(self):
         """Display list of known nodes"""
         if not self.known_nodes:
             print("\nNo nodes discovered yet.")
             return
-            
+
         print("\nKnown nodes:")
-        for node_id, info in self.known_nodes.items():
+        for node_id, info in list(self.known_nodes.items()):
             last_seen = time.time() - info['last_seen']
             print(f"  {node_id} (role: {info['role']}, last seen: {int(last_seen)}s ago)")
 
-    def on_receive(self, packet, interface):
+    def on_receive(self, packet, interface=None):
+        # Runs on the meshtastic receive thread: hand the packet to the event loop and return at once
+        self.loop.call_soon_threadsafe(self.handle_packet, packet)
+
+    def handle_packet(self, packet):
         try:
             if packet.get('decoded'):
-                message = packet['decoded'].get('text', '')
-                sender = packet.get('fromId', 'Unknown')
-                
                 # Reset the chunk timeout whenever we receive any message
                 self.last_chunk_time = time.time()
-                
-                try:
-                    data = json.loads(message)
-                    if 't' in data or 'type' in data:
-                        self.handle_file_message(message)
-                    else:
-                        print(f"\nReceived from {sender}: {message}")
-                except json.JSONDecodeError:
+
+                if is_binary_packet(packet['decoded']):
+                    self.handle_frame(packet['decoded']['payload'], packet.get('fromId'))
+                    return
+                message = packet['decoded'].get('text', '')
+                sender = packet.get('fromId', 'Unknown')
+
+                data = parse_message(message)
+                if data:
+                    self.dispatch(data, packet.get('fromId'))
+                else:
                     print(f"\nReceived from {sender}: {message}")
         except Exception as e:
             # Don't crash on BLE errors
@@ -435,8 +1473,8 @@ class MeshBLEFileReceiver:
                 print(f"BLE communication error: {error_msg.split('(')[0]}")
                 # Try to reconnect on BLE errors
                 try:
-                    self.reconnect()
-                except:
+                    self.spawn(self.reconnect())
+                except Exception:
                     pass
             else:
                 print(f"Error processing message: {e}")
@@ -449,14 +1487,14 @@ class MeshBLEFileReceiver:
                     time.sleep(5)
                     continue
 
-                pub.subscribe(self.on_receive, "meshtastic.receive")
-                
                 # Announce presence when we start
                 self.announce_presence()
 
                 print("\nReceiver Commands:")
                 print("  /announce  - Announce presence")
                 print("  /nodes     - List known nodes")
+                print("  /queue     - Show send queue depth and airtime")
+                print("  /metrics   - Show transfer metrics per sender")
                 print("  /quit      - Exit")
                 print("\nReceiver is running...")
                 print("Press Ctrl+C to exit")
@@ -467,7 +1505,7 @@ class MeshBLEFileReceiver:
                         import select
                         if select.select([sys.stdin], [], [], 0.0)[0]:
                             command = input().strip()
-                            
+
                             if command.lower() == '/quit':
                                 print("\nExiting...")
                                 self.signal_handler(signal.SIGINT, None)
@@ -476,21 +1514,27 @@ class MeshBLEFileReceiver:
                                 self.announce_presence()
                             elif command.lower() == '/nodes':
                                 self.list_known_nodes()
+                            elif command.lower() == '/queue':
+                                self.show_send_queue()
+                            elif command.lower() == '/metrics':
+                                self.show_metrics()
                             elif command:
                                 print("\nAvailable commands:")
                                 print("  /announce  - Announce presence")
                                 print("  /nodes     - List known nodes")
+                                print("  /queue     - Show send queue depth and airtime")
+                                print("  /metrics   - Show transfer metrics per sender")
                                 print("  /quit      - Exit")
                     except Exception as e:
                         print(f"Error processing command: {e}")
-                    
+
                     # Check for timeouts
                     if not self.check_timeout():
                         break
-                        
+
                     # Sleep to prevent CPU usage
                     time.sleep(1)
-                    
+
             except KeyboardInterrupt:
                 print("\nExiting...")
                 self.signal_handler(signal.SIGINT, None)
@@ -498,21 +1542,21 @@ class MeshBLEFileReceiver:
             except Exception as e:
                 print(f"\nError in main loop: {e}")
                 # Save any partial files on unexpected errors
-                for filename in list(self.receiving_files.keys()):
+                for key in list(self.receiving_files.keys()):
                     try:
-                        partial_path = self.save_partial_file(filename, self.receiving_files[filename]['data'])
+                        partial_path = self.checkpoint_transfer(key)
                         print(f"Saved partial data to {partial_path}")
-                    except:
+                    except Exception:
                         pass
-                        
-                if not self.reconnect():
+
+                if not self.run_coroutine(self.reconnect()):
                     time.sleep(5)
             finally:
-                if self.interface:
-                    try:
-                        self.interface.close()
-                    except:
-                        pass
+                try:
+                    self.transport.close()
+                except Exception:
+                    pass
+
 
 # Change this to your T-Beam's MAC address
 MAC_ADDRESS = "08:F9:E0:F6:31:AE"  # For leaf2
@@ -520,11 +1564,11 @@ MAC_ADDRESS = "08:F9:E0:F6:31:AE"  # For leaf2
 if __name__ == "__main__":
     import sys
     node_id = "leaf2"  # Default node ID
-    
+
     # Check if node ID was provided as command line argument
     if len(sys.argv) > 1:
         node_id = sys.argv[1]
-        
+
     # Use the MAC address from the script (update for each node)
     receiver = MeshBLEFileReceiver(MAC_ADDRESS, node_id)
-    receiver.run()
\ No newline at end of file
+    receiver.run()
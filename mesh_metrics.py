@@ -0,0 +1,224 @@
+"""Per-transfer and per-peer metrics for the mesh file transfer sender and receivers.
+
+Each node keeps one MeshMetrics. Counts and timings recorded against a transfer also
+add to its peer's and the node's totals. write() saves them as a JSON status file and,
+for node_exporter's textfile collector, as Prometheus text.
+
+Copy this file next to mesh_file_transfer_*.py on every node.
+"""
+import json
+import os
+import tempfile
+import time
+from threading import Lock
+
+# Histogram bucket upper bounds, in seconds
+RTT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+RECONNECT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+HISTOGRAM_BUCKETS = {'ack_rtt': RTT_BUCKETS, 'reconnect_duration': RECONNECT_BUCKETS}
+
+# Counter name -> help text for the Prometheus output
+COUNTERS = {
+    'chunks_sent': "Data chunks transmitted, retransmissions included",
+    'chunks_retried': "Data chunks transmitted again after a timeout or NACK",
+    'parity_sent': "FEC parity chunks transmitted",
+    'chunks_received': "Data chunks received or rebuilt for the first time",
+    'duplicate_chunks': "Data chunks received again after they were already held",
+    'corrupt_chunks': "Chunks discarded for a CRC mismatch",
+    'fec_recovered': "Data chunks rebuilt from FEC parity",
+    'chunks_from_store': "Data chunks the receiver took from its chunk store instead of the radio",
+    'acks_sent': "ACKs transmitted",
+    'acks_received': "ACKs received",
+    'nacks_sent': "NACKs transmitted",
+    'nacks_received': "NACKs received",
+    'packets_sent': "Packets handed to the radio",
+    'bytes_on_air': "Payload bytes handed to the radio",
+    'airtime_seconds': "Estimated LoRa time on air of the packets sent",
+    'reconnects': "Successful reconnections to the radio",
+    'reconnect_failures': "Reconnections that gave up",
+    'link_losses': "Radio disconnects noticed by the keepalive probe",
+    'reconnects_avoided': "Reconnects skipped because the link probe found the radio still connected",
+    'transfers_completed': "Transfers that finished successfully",
+    'transfers_failed': "Transfers that failed",
+}
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values, as Prometheus keeps them"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+def new_scope():
+    return {'counters': dict.fromkeys(COUNTERS, 0),
+            'histograms': {name: Histogram(buckets) for name, buckets in HISTOGRAM_BUCKETS.items()}}
+
+
+class MeshMetrics:
+    """Counters and histograms for one node, broken down by transfer and by peer"""
+
+    def __init__(self, node_id, role, clock=time.time, keep_finished=20):
+        self.node_id = node_id
+        self.role = role
+        self.clock = clock  # Transfer durations use the node's event loop clock
+        self.keep_finished = keep_finished  # Finished transfers kept in the reports
+        self.started = time.time()
+        self.node = new_scope()
+        self.peers = {}  # Peer node id -> scope
+        self.transfers = {}  # Transfer key -> scope plus the transfer's details, oldest first
+        self.lock = Lock()
+
+    def scopes(self, transfer=None, peer=None):
+        """The node's scope plus those of the transfer and its peer, or of the peer alone"""
+        scopes = [self.node]
+        record = self.transfers.get(transfer) if transfer is not None else None
+        if record:
+            scopes.append(record)
+            peer = record['peer'] or peer  # A broadcast has no single peer; credit the receiver that answered
+        if peer:
+            scopes.append(self.peers.setdefault(peer, new_scope()))
+        return scopes
+
+    def count(self, name, amount=1, transfer=None, peer=None):
+        with self.lock:
+            for scope in self.scopes(transfer, peer):
+                scope['counters'][name] += amount
+
+    def observe(self, name, value, transfer=None, peer=None):
+        with self.lock:
+            for scope in self.scopes(transfer, peer):
+                scope['histograms'][name].observe(value)
+
+    def start_transfer(self, key, filename, peer, size):
+        """Begin tracking a transfer; peer is the other end, None for a broadcast"""
+        with self.lock:
+            record = new_scope()
+            record.update({'filename': filename, 'peer': peer, 'size': size, 'state': 'active',
+                           'started': self.clock(), 'duration': None, 'goodput': None})
+            self.transfers.pop(key, None)
+            self.transfers[key] = record
+
+    def finish_transfer(self, key, ok):
+        """Record a transfer's outcome and its goodput, file bytes per second from start to finish"""
+        with self.lock:
+            record = self.transfers.get(key)
+            if not record or record['state'] != 'active':
+                return
+            record['state'] = 'completed' if ok else 'failed'
+            record['duration'] = self.clock() - record['started']
+            if ok and record['duration'] > 0:
+                record['goodput'] = record['size'] / record['duration']
+            finished = [k for k, r in self.transfers.items() if r['state'] != 'active']
+            for old_key in finished[:-self.keep_finished]:
+                del self.transfers[old_key]
+        self.count('transfers_completed' if ok else 'transfers_failed', transfer=key)
+
+    def snapshot(self):
+        """Everything recorded so far as plain data for the JSON status file"""
+        def scope_data(scope):
+            return {'counters': dict(scope['counters']),
+                    'histograms': {name: h.snapshot() for name, h in scope['histograms'].items()}}
+
+        with self.lock:
+            transfers = {}
+            for key, record in self.transfers.items():
+                data = scope_data(record)
+                data.update({field: record[field] for field in ('filename', 'peer', 'size', 'state')})
+                duration = record['duration'] if record['duration'] is not None else self.clock() - record['started']
+                data['duration'] = round(duration, 3)
+                data['goodput'] = round(record['goodput'], 2) if record['goodput'] is not None else None
+                transfers[transfer_label(key)] = data
+            return {
+                'node': self.node_id,
+                'role': self.role,
+                'updated': time.time(),
+                'uptime': round(time.time() - self.started, 1),
+                'totals': scope_data(self.node),
+                'peers': {peer: scope_data(scope) for peer, scope in self.peers.items()},
+                'transfers': transfers,
+            }
+
+    def prometheus(self):
+        """Prometheus text exposition of the counters and histograms, and the goodput of finished transfers.
+
+        Node totals are mesh_*, the per-peer breakdown is mesh_peer_* so summing over peers never double counts.
+        """
+        lines = []
+        base = {'node': self.node_id, 'role': self.role}
+        with self.lock:
+            families = [('mesh', [(base, self.node)]),
+                        ('mesh_peer', [(dict(base, peer=peer), scope) for peer, scope in self.peers.items()])]
+            for prefix, scopes in families:
+                for name, help_text in COUNTERS.items():
+                    lines.append(f"# HELP {prefix}_{name}_total {help_text}")
+                    lines.append(f"# TYPE {prefix}_{name}_total counter")
+                    for labels, scope in scopes:
+                        lines.append(f"{prefix}_{name}_total{format_labels(labels)} {scope['counters'][name]:g}")
+                for name, buckets in HISTOGRAM_BUCKETS.items():
+                    metric = f"{prefix}_{name}_seconds"
+                    lines.append(f"# TYPE {metric} histogram")
+                    for labels, scope in scopes:
+                        histogram = scope['histograms'][name]
+                        for bound, count in zip(buckets, histogram.counts):
+                            lines.append(f"{metric}_bucket{format_labels(dict(labels, le=f'{bound:g}'))} {count}")
+                        lines.append(f"{metric}_bucket{format_labels(dict(labels, le='+Inf'))} {histogram.count}")
+                        lines.append(f"{metric}_sum{format_labels(labels)} {histogram.sum:.3f}")
+                        lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+            lines.append("# HELP mesh_transfer_goodput_bytes_per_second File bytes per second of finished transfers")
+            lines.append("# TYPE mesh_transfer_goodput_bytes_per_second gauge")
+            for key, record in self.transfers.items():
+                if record['goodput'] is not None:
+                    labels = dict(base, peer=record['peer'] or 'all', transfer=transfer_label(key),
+                                  file=record['filename'])
+                    lines.append(f"mesh_transfer_goodput_bytes_per_second{format_labels(labels)} "
+                                 f"{record['goodput']:.2f}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, status_file=None, prometheus_file=None):
+        """Write the JSON status file and the Prometheus textfile; either may be None"""
+        if status_file:
+            write_atomically(status_file, json.dumps(self.snapshot(), indent=2))
+        if prometheus_file:
+            write_atomically(prometheus_file, self.prometheus())
+
+
+def transfer_label(key):
+    """Transfer keys are a sender's transfer id, or a receiver's (sender, transfer id) session"""
+    return '/'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+
+def format_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def write_atomically(path, text):
+    """Replace path in one step so a collector never reads a half written file"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(temp_path, 0o644)  # mkstemp creates it private; the collector runs as another user
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,579 @@
+"""Wire-format helpers shared by the mesh file transfer sender and receivers.
+
+Copy this file next to mesh_file_transfer_*.py on every node.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import lzma
+import math
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd compression is only offered when the zstandard package is installed
+
+try:
+    from meshtastic.protobuf import mesh_pb2
+except ImportError:
+    try:
+        from meshtastic import mesh_pb2  # Older meshtastic releases
+    except ImportError:
+        mesh_pb2 = None
+
+# Largest payload the radio accepts in one packet (meshtastic Constants.DATA_PAYLOAD_LEN)
+DATA_PAYLOAD_LEN = mesh_pb2.Constants.DATA_PAYLOAD_LEN if mesh_pb2 else 233
+LEGACY_CHUNK_SIZE = 100  # Chunk size assumed by receivers that do not read 'sz' from the start message
+
+PRIVATE_APP_PORTNUM = 256  # meshtastic PortNum.PRIVATE_APP, carries the binary frames below
+
+# Binary frame header: message type, transfer id, chunk number, flags
+FRAME_HEADER = struct.Struct('!BHIB')
+MSG_CHUNK = 1  # Payload is the raw chunk data
+MSG_ACK = 2  # Chunk number is the cumulative ACK, payload is the ACK bitmap
+MSG_NACK = 3  # Chunk number is the first chunk of the bitmap, payload the chunks the receiver lost or found corrupt
+MSG_SIGNATURES = 4  # Chunk number is the first block signed, payload a DELTA_HEADER and block signatures
+MSG_OFFER = 5  # Chunk number is the first chunk offered, payload the Merkle leaf hashes of consecutive chunks
+MSG_HELD = 6  # Chunk number is the first chunk of the offer answered, payload the bitmap of chunks the receiver holds
+FLAG_PARITY = 0x01  # MSG_CHUNK carries FEC parity; chunk number is group * parity_count + parity index
+FLAG_CRC = 0x02  # MSG_CHUNK payload starts with the CRC32 of the chunk data
+CHUNK_CRC = struct.Struct('!I')
+
+COMPRESSION_CODECS = ['zstd', 'lzma', 'zlib'] if zstandard else ['lzma', 'zlib']
+
+MAX_ACK_BITMAP_BYTES = 32  # Bitmap covers at most 256 chunks past the cumulative ACK
+
+MERKLE_HASH_LEN = 8  # Bytes kept of each SHA-256 tree hash, enough to catch corruption and short enough for JSON
+
+
+def build_chunk_bitmap(chunks, start):
+    """Build a bitmap where bit i (LSB first within each byte) stands for chunk start + i.
+
+    Chunks that do not fit in MAX_ACK_BITMAP_BYTES are left out and will
+    simply be reported again by a later message.
+    """
+    limit = MAX_ACK_BITMAP_BYTES * 8
+    offsets = [cn - start for cn in chunks if start <= cn < start + limit]
+    if not offsets:
+        return b''
+    bitmap = bytearray(max(offsets) // 8 + 1)
+    for offset in offsets:
+        bitmap[offset // 8] |= 1 << (offset % 8)
+    return bytes(bitmap)
+
+
+def parse_chunk_bitmap(start, bitmap):
+    """Return the chunk numbers set in a bitmap built by build_chunk_bitmap"""
+    chunks = []
+    for byte_index, byte in enumerate(bitmap):
+        for bit in range(8):
+            if byte & (1 << bit):
+                chunks.append(start + byte_index * 8 + bit)
+    return chunks
+
+
+def build_ack_bitmap(received_chunks, cumulative):
+    """Build the bitmap of chunks received beyond the cumulative ACK (bit 0 is chunk cumulative + 1)"""
+    return build_chunk_bitmap(received_chunks, cumulative + 1)
+
+
+def parse_ack_bitmap(cumulative, bitmap):
+    """Return the chunk numbers acknowledged beyond the cumulative ACK"""
+    return parse_chunk_bitmap(cumulative + 1, bitmap)
+
+
+def chunks_to_ranges(chunks):
+    """Collapse chunk numbers into sorted [start, end) ranges"""
+    ranges = []
+    for chunk_number in sorted(chunks):
+        if ranges and ranges[-1][1] == chunk_number:
+            ranges[-1][1] = chunk_number + 1
+        else:
+            ranges.append([chunk_number, chunk_number + 1])
+    return ranges
+
+
+def ranges_to_chunks(ranges):
+    """Expand [start, end) ranges back into chunk numbers"""
+    return [cn for start, end in ranges for cn in range(start, end)]
+
+
+def encode_bitmap(bitmap):
+    """Encode an ACK bitmap for a JSON message"""
+    return base64.b64encode(bitmap).decode('utf-8')
+
+
+def decode_bitmap(text):
+    """Decode an ACK bitmap from a JSON message"""
+    return base64.b64decode(text) if text else b''
+
+
+def pack_frame(msg_type, transfer_id, chunk_number, payload=b'', flags=0):
+    """Pack a binary frame for sendData"""
+    return FRAME_HEADER.pack(msg_type, transfer_id, chunk_number, flags) + payload
+
+
+def unpack_frame(frame):
+    """Unpack a binary frame into (msg_type, transfer_id, chunk_number, flags, payload)"""
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError(f"Frame too short: {len(frame)} bytes")
+    msg_type, transfer_id, chunk_number, flags = FRAME_HEADER.unpack_from(frame)
+    return msg_type, transfer_id, chunk_number, flags, bytes(frame[FRAME_HEADER.size:])
+
+
+def chunk_crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def add_chunk_crc(data):
+    """Prefix chunk data with its CRC32 for a FLAG_CRC frame"""
+    return CHUNK_CRC.pack(chunk_crc(data)) + data
+
+
+def check_chunk_crc(payload):
+    """Split a FLAG_CRC payload into (chunk data, whether the CRC matched)"""
+    if len(payload) < CHUNK_CRC.size:
+        return b'', False
+    data = payload[CHUNK_CRC.size:]
+    return data, CHUNK_CRC.unpack_from(payload)[0] == chunk_crc(data)
+
+
+def is_binary_packet(decoded):
+    """Check whether a decoded meshtastic packet carries one of our binary frames"""
+    return decoded.get('portnum') in ('PRIVATE_APP', PRIVATE_APP_PORTNUM) and 'payload' in decoded
+
+
+# Long field and type names of the original message format, folded into the short names used on the wire
+MESSAGE_KEYS = {
+    'type': 't', 'filename': 'f', 'file_size': 'fs', 'total_chunks': 'tc', 'checksum': 'cs', 'chunk_size': 'sz',
+    'batch_size': 'bs', 'chunk_number': 'cn', 'batch_number': 'bn', 'data': 'd', 'message': 'm',
+}
+MESSAGE_TYPES = {
+    'batch_ack': 'ba', 'transfer_error': 'te', 'file_start': 'fs', 'file_chunk': 'fc', 'file_completion': 'fc',
+}
+
+
+def parse_message(text):
+    """Decode a JSON control message once, with long keys and type names folded into the short ones.
+
+    Returns None for text that is not one of our messages, such as a chat line.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or ('t' not in data and 'type' not in data):
+        return None
+    for long_key, short_key in MESSAGE_KEYS.items():
+        if long_key in data and short_key not in data:
+            data[short_key] = data.pop(long_key)
+    data['t'] = MESSAGE_TYPES.get(data['t'], data['t'])
+    return data
+
+
+def max_chunk_size(empty_message, mtu=DATA_PAYLOAD_LEN):
+    """Return the largest chunk that fits in one packet alongside the framing of a chunk message.
+
+    empty_message is a chunk message encoded with no chunk data: frame bytes for the
+    binary path, or JSON text for the fallback path. JSON carries the chunk as base64,
+    so only 3 raw bytes fit in every 4 characters left over.
+    """
+    if isinstance(empty_message, str):
+        room = (mtu - len(empty_message.encode('utf-8'))) // 4 * 3
+    else:
+        room = mtu - len(empty_message)
+    if room <= 0:
+        raise ValueError(f"Chunk framing ({len(empty_message)} bytes) leaves no room in a {mtu} byte packet")
+    return room
+
+
+# LoRa modem presets as (spreading factor, bandwidth in Hz, coding rate denominator 5-8)
+LORA_PRESETS = {
+    'SHORT_TURBO': (7, 500000, 5),
+    'SHORT_FAST': (7, 250000, 5),
+    'SHORT_SLOW': (8, 250000, 5),
+    'MEDIUM_FAST': (9, 250000, 5),
+    'MEDIUM_SLOW': (10, 250000, 5),
+    'LONG_FAST': (11, 250000, 5),
+    'LONG_MODERATE': (11, 125000, 8),
+    'LONG_SLOW': (12, 125000, 8),
+    'VERY_LONG_SLOW': (12, 62500, 8),
+}
+LORA_PREAMBLE_SYMBOLS = 16  # Preamble length meshtastic firmware uses
+LORA_PACKET_OVERHEAD = 22  # Mesh packet header and protobuf framing around our payload; 233 + 22 = 255
+# Fraction of the time a node may transmit in each meshtastic region; regions not listed are unrestricted
+REGION_DUTY_CYCLE = {'EU_433': 0.1, 'EU_868': 0.1, 'UA_433': 0.1, 'UA_868': 0.01}
+
+
+def lora_modem(preset):
+    """(spreading factor, bandwidth, coding rate) of a preset name, or custom settings passed as that tuple"""
+    return LORA_PRESETS[preset] if isinstance(preset, str) else tuple(preset)
+
+
+def lora_airtime(payload_len, preset='LONG_FAST'):
+    """Seconds a packet carrying payload_len bytes of our data occupies the channel (Semtech AN1200.13).
+
+    Counts the preamble, the explicit header, the payload CRC and the mesh packet overhead.
+    """
+    sf, bandwidth, cr = lora_modem(preset)
+    symbol_time = (1 << sf) / bandwidth
+    low_data_rate = 1 if symbol_time > 0.016 else 0  # Low data rate optimisation above 16 ms symbols
+    size = payload_len + LORA_PACKET_OVERHEAD
+    payload_symbols = 8 + max(math.ceil((8 * size - 4 * sf + 28 + 16) / (4 * (sf - 2 * low_data_rate))) * cr, 0)
+    return (LORA_PREAMBLE_SYMBOLS + 4.25 + payload_symbols) * symbol_time
+
+
+def lora_bitrate(preset='LONG_FAST'):
+    """Raw bits per second the preset carries"""
+    sf, bandwidth, cr = lora_modem(preset)
+    return sf * bandwidth / (1 << sf) * 4 / cr
+
+
+class TokenBucket:
+    """Refills at rate units per second up to burst; take() reports how long to wait for the units"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount units are available; amounts above the burst wait for a full bucket"""
+        self.refill(now)
+        return max(min(amount, self.burst) - self.tokens, 0) / self.rate
+
+    def take(self, amount, now):
+        self.refill(now)
+        self.tokens -= amount  # May go negative for packets larger than the burst
+
+
+def compress_data(codec, data):
+    """Compress data with one of COMPRESSION_CODECS"""
+    if codec == 'zlib':
+        return zlib.compress(data, 9)
+    if codec == 'lzma':
+        return lzma.compress(data)
+    if codec == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def compress_stream(codec, blocks):
+    """Compress data one block at a time, yielding the compressed output as it is produced"""
+    if codec == 'zlib':
+        compressor = zlib.compressobj(9)
+    elif codec == 'lzma':
+        compressor = lzma.LZMACompressor()
+    elif codec == 'zstd' and zstandard:
+        compressor = zstandard.ZstdCompressor(level=19).compressobj()
+    else:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    for block in blocks:
+        output = compressor.compress(block)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def decompress_data(codec, data):
+    """Reverse compress_data"""
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def decompress_stream(codec, blocks):
+    """Reverse compress_data one block at a time, yielding the decompressed output as it is produced"""
+    if codec == 'zlib':
+        decompressor = zlib.decompressobj()
+    elif codec == 'lzma':
+        decompressor = lzma.LZMADecompressor()
+    elif codec == 'zstd' and zstandard:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError(f"Unsupported compression codec: {codec}")
+    for block in blocks:
+        output = decompressor.decompress(block)
+        if output:
+            yield output
+    if codec == 'zlib':
+        yield decompressor.flush()
+
+
+def merkle_leaf(chunk):
+    """Hash one chunk as a Merkle tree leaf"""
+    return hashlib.sha256(b'\0' + chunk).digest()[:MERKLE_HASH_LEN]
+
+
+def merkle_levels(leaves):
+    """Build a Merkle tree bottom-up from its concatenated leaf hashes.
+
+    Returns a list of levels, each the concatenated hashes of its nodes, level 0 being the
+    leaves and the last level holding only the root. A node without a sibling is carried up
+    to the next level unchanged.
+    """
+    pair_size = 2 * MERKLE_HASH_LEN
+    levels = [bytes(leaves) or merkle_leaf(b'')]
+    while len(levels[-1]) > MERKLE_HASH_LEN:
+        level = levels[-1]
+        parents = bytearray()
+        for offset in range(0, len(level), pair_size):
+            pair = level[offset:offset + pair_size]
+            parents += hashlib.sha256(b'\1' + pair).digest()[:MERKLE_HASH_LEN] if len(pair) == pair_size else pair
+        levels.append(bytes(parents))
+    return levels
+
+
+def merkle_node(levels, level, index):
+    """Return the hash of one tree node, or b'' if there is no such node"""
+    if not 0 <= level < len(levels) or index < 0:
+        return b''
+    return levels[level][index * MERKLE_HASH_LEN:(index + 1) * MERKLE_HASH_LEN]
+
+
+def merkle_children(levels, level, index):
+    """Return the [level, index] positions of a tree node's children"""
+    return [[level - 1, child] for child in (2 * index, 2 * index + 1) if merkle_node(levels, level - 1, child)]
+
+
+# rsync-style delta against an older copy the receiver holds. The receiver signs each block of its copy;
+# the sender turns every block it finds at any offset of the new file into a copy instruction and sends
+# the bytes in between as literals. The whole-file checksum catches the rare false match.
+DELTA_SIGNATURE = struct.Struct('!I4s')  # Rolling checksum and the first 4 bytes of the block's MD5
+DELTA_HEADER = struct.Struct('!HIH')  # Block size, size of the signed copy, packets in the signature answer
+DELTA_COPY = struct.Struct('!BII')  # Instruction, first block, block count
+DELTA_LITERAL = struct.Struct('!BH')  # Instruction, length; the literal bytes follow
+DELTA_OP_COPY = 1
+DELTA_OP_LITERAL = 2
+DELTA_MAX_LITERAL = 0xffff
+DELTA_MIN_BLOCK = 64
+DELTA_MAX_BLOCK = 4096  # Also keeps the block size within DELTA_HEADER
+
+
+def delta_block_size(file_size):
+    """Block size that balances the signature bytes against the literal bytes of one changed block"""
+    return min(max(math.isqrt(DELTA_SIGNATURE.size * file_size), DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+
+
+def rolling_checksum(block):
+    """rsync's weak checksum as its two 16 bit sums, which roll along one byte at a time"""
+    return sum(block) & 0xffff, sum(itertools.accumulate(block)) & 0xffff
+
+
+def block_signature(block):
+    a, b = rolling_checksum(block)
+    return DELTA_SIGNATURE.pack(a | b << 16, hashlib.md5(block).digest()[:4])
+
+
+def delta_stream(data, signatures, block_size, basis_size):
+    """Yield data as copy and literal instructions against a basis of basis_size bytes.
+
+    signatures maps block numbers of the basis to block_signature(); blocks without one
+    are never copied. The basis's short last block can only match the end of data.
+    """
+    index = {}
+    for block_number, signature in signatures.items():
+        weak, strong = DELTA_SIGNATURE.unpack(signature)
+        index.setdefault(weak, {}).setdefault(strong, block_number)
+    size = len(data)
+    copy = None  # [first block, count] of the copy instruction being extended
+
+    def flush(literal_start, literal_end):
+        nonlocal copy
+        if copy:
+            yield DELTA_COPY.pack(DELTA_OP_COPY, *copy)
+            copy = None
+        for offset in range(literal_start, literal_end, DELTA_MAX_LITERAL):
+            literal = data[offset:min(offset + DELTA_MAX_LITERAL, literal_end)]
+            yield DELTA_LITERAL.pack(DELTA_OP_LITERAL, len(literal)) + literal
+
+    def matched(block_number):
+        nonlocal copy
+        if copy and copy[0] + copy[1] == block_number:
+            copy[1] += 1
+            return []
+        previous = [DELTA_COPY.pack(DELTA_OP_COPY, *copy)] if copy else []
+        copy = [block_number, 1]
+        return previous
+
+    literal_start = position = 0
+    if size >= block_size:
+        a, b = rolling_checksum(data[:block_size])
+    while position + block_size <= size:
+        candidates = index.get(a | b << 16)
+        block_number = None
+        if candidates:
+            block_number = candidates.get(hashlib.md5(data[position:position + block_size]).digest()[:4])
+        if block_number is not None:
+            if literal_start < position:
+                yield from flush(literal_start, position)
+            yield from matched(block_number)
+            position += block_size
+            literal_start = position
+            if position + block_size <= size:
+                a, b = rolling_checksum(data[position:position + block_size])
+            continue
+        if position + block_size == size:
+            break
+        # Slide the window one byte: drop the oldest byte, take in the next
+        out_byte, in_byte = data[position], data[position + block_size]
+        a = (a - out_byte + in_byte) & 0xffff
+        b = (b - block_size * out_byte + a) & 0xffff
+        position += 1
+
+    tail = basis_size % block_size
+    tail_start = size - tail
+    if tail and tail_start >= literal_start and basis_size // block_size in signatures and \
+            block_signature(data[tail_start:]) == signatures[basis_size // block_size]:
+        if literal_start < tail_start:
+            yield from flush(literal_start, tail_start)
+        yield from matched(basis_size // block_size)
+        literal_start = size
+    yield from flush(literal_start, size)
+
+
+def apply_delta(blocks, read_basis, block_size):
+    """Rebuild a file from delta_stream() output arriving in blocks of any size.
+
+    read_basis(offset, length) returns bytes of the basis; the rebuilt file is yielded as it is produced.
+    """
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        position = 0
+        while position < len(buffer):
+            op = buffer[position]
+            if op == DELTA_OP_COPY:
+                if len(buffer) - position < DELTA_COPY.size:
+                    break
+                _, first, count = DELTA_COPY.unpack_from(buffer, position)
+                position += DELTA_COPY.size
+                for start in range(first, first + count, 64):  # Read long copies in pieces
+                    yield read_basis(start * block_size, min(64, first + count - start) * block_size)
+            elif op == DELTA_OP_LITERAL:
+                if len(buffer) - position < DELTA_LITERAL.size:
+                    break
+                _, length = DELTA_LITERAL.unpack_from(buffer, position)
+                end = position + DELTA_LITERAL.size + length
+                if end > len(buffer):
+                    break
+                yield bytes(buffer[position + DELTA_LITERAL.size:end])
+                position = end
+            else:
+                raise ValueError(f"Unknown delta instruction {op}")
+        del buffer[:position]
+    if buffer:
+        raise ValueError("Delta ends in the middle of an instruction")
+
+
+# Reed-Solomon erasure coding over GF(256) (polynomial 0x11d) with a Cauchy generator matrix.
+# Parity j of a group is sum_i d_i / (x_j ^ y_i) with y_i = i and x_j = 255 - j, so any M of the
+# M + K chunks of a group rebuild the M data chunks.
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11d
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+MAX_FEC_GROUP = 128  # Keeps data indices and parity indices apart in the field
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def _scaled(coefficient, data):
+    """Multiply every byte of data by a field element"""
+    return data.translate(bytes(gf_mul(coefficient, b) for b in range(256)))
+
+
+def _xor_into(target, data):
+    """XOR data into the bytearray target"""
+    value = int.from_bytes(target, 'little') ^ int.from_bytes(data, 'little')
+    target[:] = value.to_bytes(len(target), 'little')
+
+
+def _cauchy(parity_index, data_index):
+    return gf_inv((255 - parity_index) ^ data_index)
+
+
+def fec_encode(data_chunks, parity_count, chunk_size):
+    """Return parity_count parity chunks for a group of data chunks, each padded to chunk_size"""
+    parity = []
+    for j in range(parity_count):
+        block = bytearray(chunk_size)
+        for i, chunk in enumerate(data_chunks):
+            _xor_into(block, _scaled(_cauchy(j, i), chunk.ljust(chunk_size, b'\0')))
+        parity.append(bytes(block))
+    return parity
+
+
+def fec_decode(data_chunks, parity_chunks, group_size, chunk_size):
+    """Rebuild the missing data chunks of a group.
+
+    data_chunks maps data index (0..group_size-1) to chunk bytes and parity_chunks maps
+    parity index to parity bytes. Returns {data index: padded chunk} for the chunks that
+    were missing, or None when too few chunks arrived to recover the group.
+    """
+    missing = [i for i in range(group_size) if i not in data_chunks]
+    if not missing:
+        return {}
+    if len(parity_chunks) < len(missing):
+        return None
+    rows = sorted(parity_chunks)[:len(missing)]
+
+    # Remove the contribution of the data chunks we have from each parity chunk
+    syndromes = []
+    for j in rows:
+        block = bytearray(parity_chunks[j].ljust(chunk_size, b'\0'))
+        for i, chunk in data_chunks.items():
+            _xor_into(block, _scaled(_cauchy(j, i), chunk.ljust(chunk_size, b'\0')))
+        syndromes.append(block)
+
+    # Invert the Cauchy submatrix for the missing chunks by Gauss-Jordan elimination
+    size = len(missing)
+    matrix = [[_cauchy(j, i) for i in missing] + [1 if r == c else 0 for c in range(size)]
+              for r, j in enumerate(rows)]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if matrix[r][col])
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        scale = gf_inv(matrix[col][col])
+        matrix[col] = [gf_mul(scale, v) for v in matrix[col]]
+        for r in range(size):
+            if r != col and matrix[r][col]:
+                factor = matrix[r][col]
+                matrix[r] = [v ^ gf_mul(factor, p) for v, p in zip(matrix[r], matrix[col])]
+
+    recovered = {}
+    for r, i in enumerate(missing):
+        block = bytearray(chunk_size)
+        for c in range(size):
+            coefficient = matrix[r][size + c]
+            if coefficient:
+                _xor_into(block, _scaled(coefficient, syndromes[c]))
+        recovered[i] = bytes(block)
+    return recovered
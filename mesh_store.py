@@ -0,0 +1,95 @@
+"""Content-addressed chunk store for the mesh file transfer receivers.
+
+Receivers keep every chunk they receive under its Merkle leaf hash, so a sender
+offering the hashes of a new transfer can skip the chunks already held.
+
+Copy this file next to mesh_file_transfer_*.py on every node.
+"""
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from mesh_protocol import merkle_leaf, MERKLE_HASH_LEN
+
+
+class ChunkStore:
+    """Chunks of earlier transfers on disk, one file each named by its Merkle leaf hash.
+
+    Least recently used chunks are evicted once the store grows past max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = OrderedDict()  # Leaf hash -> chunk size, least recently used first
+        self.size = 0
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(directory):
+            try:
+                key = bytes.fromhex(entry.name)
+                stat = entry.stat()
+            except (ValueError, OSError):
+                continue
+            if len(key) == MERKLE_HASH_LEN:
+                found.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key.hex())
+
+    def get(self, key):
+        """The chunk stored under a leaf hash, or None; a chunk that no longer matches its hash is dropped"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self.path(key), 'rb') as f:
+                chunk = f.read()
+            if merkle_leaf(chunk) == key:
+                os.utime(self.path(key))  # Keeps the order of use across restarts
+                return chunk
+        except OSError:
+            pass
+        self.remove(key)
+        return None
+
+    def put(self, key, chunk):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = len(chunk)
+            self.size += len(chunk)
+        try:
+            with open(self.path(key), 'wb') as f:
+                f.write(chunk)
+        except OSError as e:
+            print(f"Error adding chunk to the store: {e}")
+            self.remove(key)
+            return
+        self.evict()
+
+    def remove(self, key):
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is None:
+                return
+            self.size -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries:
+                    return
+                key = next(iter(self.entries))
+            self.remove(key)
@@ -0,0 +1,252 @@
+"""Radio transports for the mesh file transfer sender and receivers.
+
+BLETransport talks to a T-Beam over Bluetooth through the meshtastic library.
+SimulatedChannel connects any number of nodes inside one process over a lossy
+LoRa-like channel, and VirtualTimeLoop runs them faster than real time, so a
+whole transfer can be exercised without radios.
+
+Copy this file next to mesh_file_transfer_*.py on every node.
+"""
+import asyncio
+import random
+import selectors
+import subprocess
+
+try:
+    import meshtastic.ble_interface
+    from pubsub import pub
+except ImportError:
+    meshtastic = None  # Only the simulated transport is available without the meshtastic package
+
+from mesh_protocol import DATA_PAYLOAD_LEN, PRIVATE_APP_PORTNUM
+
+
+def backoff_delay(attempt, base, cap, rng=random):
+    """Seconds to wait before retry number attempt + 1: base doubled per attempt up to cap, with jitter.
+
+    The jitter keeps nodes that lost the link together from retrying in lockstep.
+    """
+    delay = min(base * 2 ** attempt, cap)
+    return rng.uniform(delay / 2, delay)
+
+
+class BLETransport:
+    """A T-Beam reached over Bluetooth; packets arrive through the meshtastic pubsub bus"""
+
+    def __init__(self, mac_address, connect_delay=2, settle_delay=1):
+        self.mac_address = mac_address
+        self.connect_delay = connect_delay  # Seconds to let BLE settle before connecting
+        self.settle_delay = settle_delay  # Seconds to let a new connection stabilize
+        self.interface = None
+        self.on_packet = None
+
+    def open(self, on_packet):
+        """Connect to the radio and deliver every packet it receives to on_packet(packet)"""
+        self.on_packet = on_packet
+        self.interface = meshtastic.ble_interface.BLEInterface(self.mac_address)
+        pub.subscribe(self.on_receive, "meshtastic.receive")  # Subscribing again is a no-op
+
+    def on_receive(self, packet, interface):
+        if interface is self.interface and self.on_packet:
+            self.on_packet(packet)
+
+    def probe(self):
+        """Check that the radio still answers over Bluetooth.
+
+        The heartbeat goes to the radio only and is never transmitted over LoRa.
+        """
+        if not self.interface:
+            return False
+        if not hasattr(self.interface, 'sendHeartbeat'):
+            return self.interface.isConnected.is_set()  # Older meshtastic releases
+        try:
+            self.interface.sendHeartbeat()
+            return True
+        except Exception:
+            return False
+
+    def send_data(self, payload, port_num=PRIVATE_APP_PORTNUM):
+        self.interface.sendData(payload, portNum=port_num)
+
+    def send_text(self, text):
+        self.interface.sendText(text)
+
+    def close(self):
+        if self.interface:
+            interface, self.interface = self.interface, None
+            interface.close()
+
+    def reset(self):
+        """Reset the Bluetooth adapter, the last resort when connecting keeps failing"""
+        subprocess.run(["sudo", "hciconfig", "hci0", "reset"],
+                       stderr=subprocess.PIPE,
+                       stdout=subprocess.PIPE,
+                       timeout=5)
+
+
+class SimulatedTransport:
+    """One node's radio on a SimulatedChannel"""
+
+    connect_delay = 0
+    settle_delay = 0
+
+    def __init__(self, channel, radio_id):
+        self.channel = channel
+        self.radio_id = radio_id  # Reported as the packet's fromId, like a meshtastic node id
+        self.on_packet = None
+        self.sent = 0
+        self.down_until = 0.0  # Loop time before which the simulated link cannot be reopened
+
+    def open(self, on_packet):
+        if self.channel.loop.time() < self.down_until:
+            raise ConnectionError(f"Radio {self.radio_id} not reachable")
+        self.on_packet = on_packet
+        self.channel.attach(self)
+
+    def probe(self):
+        return self in self.channel.transports
+
+    def drop_link(self, duration=0.0):
+        """Cut this node off the radio, as a BLE disconnect does, for at least duration seconds"""
+        self.down_until = self.channel.loop.time() + duration
+        self.channel.detach(self)
+
+    def send_data(self, payload, port_num=PRIVATE_APP_PORTNUM):
+        self.channel.transmit(self, {'payload': bytes(payload), 'portnum': port_num})
+
+    def send_text(self, text):
+        self.channel.transmit(self, {'text': text, 'payload': text.encode('utf-8'), 'portnum': 'TEXT_MESSAGE_APP'})
+
+    def close(self):
+        self.channel.detach(self)
+
+    def reset(self):
+        pass
+
+
+class SimulatedChannel:
+    """In-process broadcast channel with random and burst loss, latency, airtime and a payload limit.
+
+    Burst loss follows the Gilbert-Elliott model: each link enters a fade with probability
+    burst_loss per packet and stays in it for burst_length packets on average, losing everything.
+    Outside a fade, packets are lost with probability loss. Transmissions share the channel
+    one at a time, each holding the air for airtime(payload length) seconds, or else for its
+    payload at bandwidth bytes per second, then arrive latency seconds later.
+    """
+
+    def __init__(self, loop, loss=0.0, burst_loss=0.0, burst_length=4, latency=0.05, bandwidth=None,
+                 airtime=None, payload_limit=DATA_PAYLOAD_LEN, seed=None):
+        self.loop = loop
+        self.loss = loss
+        self.burst_loss = burst_loss
+        self.burst_length = burst_length
+        self.latency = latency
+        self.bandwidth = bandwidth  # Bytes per second, None for an unlimited channel
+        self.airtime = airtime  # Payload length -> seconds on air with every header counted; overrides bandwidth
+        self.payload_limit = payload_limit
+        self.random = random.Random(seed)
+        self.transports = []
+        self.fading = set()  # (sender, receiver) links currently in a fade
+        self.busy_until = 0.0
+        self.stats = {'sent': 0, 'delivered': 0, 'lost': 0, 'bytes': 0}
+
+    def transport(self, radio_id):
+        return SimulatedTransport(self, radio_id)
+
+    def attach(self, transport):
+        if transport not in self.transports:
+            self.transports.append(transport)
+
+    def detach(self, transport):
+        if transport in self.transports:
+            self.transports.remove(transport)
+
+    def transmit(self, sender, decoded):
+        """Put a packet on the air; safe to call from any thread"""
+        if sender not in self.transports:
+            raise ConnectionError(f"Radio {sender.radio_id} not connected")
+        if len(decoded['payload']) > self.payload_limit:
+            raise ValueError(f"Data payload too big: {len(decoded['payload'])} > {self.payload_limit} bytes")
+        sender.sent += 1
+        self.loop.call_soon_threadsafe(self.schedule, sender, decoded)
+
+    def schedule(self, sender, decoded):
+        size = len(decoded['payload'])
+        self.stats['sent'] += 1
+        self.stats['bytes'] += size
+        start = max(self.loop.time(), self.busy_until)
+        self.busy_until = start + self.time_on_air(size)
+        packet = {'decoded': decoded, 'fromId': sender.radio_id, 'toId': '^all'}
+        for receiver in list(self.transports):
+            if receiver is sender:
+                continue
+            if self.lost(sender, receiver):
+                self.stats['lost'] += 1
+                continue
+            self.loop.call_at(self.busy_until + self.latency, self.deliver, receiver, packet)
+
+    def time_on_air(self, size):
+        if self.airtime:
+            return self.airtime(size)
+        return size / self.bandwidth if self.bandwidth else 0
+
+    def lost(self, sender, receiver):
+        link = (sender.radio_id, receiver.radio_id)
+        if link in self.fading:
+            if self.random.random() < 1 / self.burst_length:
+                self.fading.discard(link)
+            return True
+        if self.burst_loss and self.random.random() < self.burst_loss:
+            self.fading.add(link)
+            return True
+        return self.random.random() < self.loss
+
+    def deliver(self, receiver, packet):
+        if receiver in self.transports and receiver.on_packet:
+            self.stats['delivered'] += 1
+            receiver.on_packet(packet)
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    """Selector that advances its loop's clock instead of sleeping when nothing else can happen"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0 or self.loop is None:
+            return events
+        if timeout is None or self.loop.executor_jobs:
+            # Wait for real: only another thread or a worker finishing can wake us
+            return super().select(timeout)
+        self.loop.virtual_time += timeout
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop on a simulated clock: sleeps, timeouts and timers take no real time.
+
+    The clock only stands still while work handed to the executor is running, so file
+    hashing and compression do not look like radio time to the transfers.
+    """
+
+    def __init__(self):
+        selector = VirtualTimeSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.virtual_time = 0.0
+        self.executor_jobs = 0
+
+    def time(self):
+        return self.virtual_time
+
+    def run_in_executor(self, executor, func, *args):
+        self.executor_jobs += 1
+        future = super().run_in_executor(executor, func, *args)
+        future.add_done_callback(self.executor_job_done)
+        return future
+
+    def executor_job_done(self, future):
+        self.executor_jobs -= 1
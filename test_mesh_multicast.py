@@ -0,0 +1,86 @@
+"""A broadcast to several receivers over a lossy simulated LoRa channel"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from mesh_benchmark import cancel_tasks
+from mesh_file_transfer_1 import MeshBLEFileTransfer
+from mesh_file_transfer_2 import MeshBLEFileReceiver
+from mesh_protocol import lora_airtime
+from mesh_transport import SimulatedChannel, VirtualTimeLoop
+
+RECEIVERS = 3
+LOSS = 0.15
+SEED = 2  # Loses a completion message on its way to one of the receivers
+
+
+class MulticastTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        random.seed(SEED)  # Transfer ids and ACK jitter
+        self.loop = VirtualTimeLoop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result(30)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.tmp.cleanup()
+
+    def receiver(self, channel, number):
+        """A receiver that keeps its files in a directory of its own"""
+        directory = os.path.join(self.tmp.name, f'rx{number}')
+        os.makedirs(directory)
+        os.chdir(directory)  # The receiver creates ./received_files on startup
+        receiver = MeshBLEFileReceiver(None, f'rx{number}', transport=channel.transport(f'!rx{number}'), loop=self.loop)
+        received = os.path.join(directory, 'received_files')
+        receiver.journal_dir = os.path.join(received, '.journal')
+        receiver.chunk_store = None
+        receiver.partial_path = lambda sender_id, filename: os.path.join(
+            received, f"partial_{receiver.checkpoint_name(sender_id, filename)}")
+        receiver.saved_path = lambda filename: os.path.join(received, f"received_{filename}")
+        return receiver
+
+    def test_every_receiver_saves_the_file(self):
+        channel = SimulatedChannel(self.loop, latency=0.05, airtime=lambda size: lora_airtime(size, 'LONG_FAST'),
+                                   seed=SEED)
+        receivers = [self.receiver(channel, number) for number in range(RECEIVERS)]
+        os.chdir(self.tmp.name)
+        sender = MeshBLEFileTransfer(None, 'tx', transport=channel.transport('!tx'), loop=self.loop)
+        for node in [sender] + receivers:
+            node.lora_preset = 'LONG_FAST'
+            node.status_file = None
+            node.configure_send_budget()
+            node.transport.open(node.on_receive)
+            node.connected = True
+
+        data = random.Random(SEED).randbytes(4000)
+        with open('multicast.bin', 'wb') as f:
+            f.write(data)
+        for receiver in receivers:
+            receiver.announce_presence()
+        deadline = time.time() + 30
+        while len(sender.known_nodes) < RECEIVERS and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(sender.known_nodes), RECEIVERS)
+        channel.loss = LOSS  # Lose packets of the transfer only
+
+        transfer = sender.queue_file('multicast.bin')
+        self.assertTrue(transfer['finished'].wait(300))
+        self.assertTrue(transfer['success'])
+        self.assertEqual(transfer['dropped_receivers'], [])
+        for receiver in receivers:
+            with open(receiver.saved_path('multicast.bin'), 'rb') as f:
+                self.assertEqual(f.read(), data, receiver.node_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
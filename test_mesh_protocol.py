@@ -0,0 +1,146 @@
+"""Round-trip tests for the wire format and coding helpers in mesh_protocol.py"""
+import json
+import random
+import unittest
+
+from mesh_protocol import (
+    FLAG_PARITY, MERKLE_HASH_LEN, MESSAGE_KEYS, MSG_ACK, MSG_CHUNK, apply_delta, block_signature, build_ack_bitmap,
+    chunks_to_ranges, decode_bitmap, delta_stream, encode_bitmap, fec_decode, fec_encode, merkle_children,
+    merkle_leaf, merkle_levels, merkle_node, pack_frame, parse_ack_bitmap, parse_message, ranges_to_chunks,
+    unpack_frame,
+)
+
+
+class FecTest(unittest.TestCase):
+    def test_recovers_any_lost_chunks_up_to_the_parity_count(self):
+        rng = random.Random(1)
+        chunk_size = 50
+        chunks = [rng.randbytes(chunk_size) for _ in range(8)] + [rng.randbytes(17)]  # Short last chunk
+        parity = fec_encode(chunks, 3, chunk_size)
+        self.assertEqual([len(p) for p in parity], [chunk_size] * 3)
+        for lost in ([0], [8], [2, 5], [0, 4, 8]):
+            data = {i: c for i, c in enumerate(chunks) if i not in lost}
+            # Any parity chunks will do, as long as there are enough of them
+            parity_chunks = {j: parity[j] for j in range(3)[-len(lost):]}
+            recovered = fec_decode(data, parity_chunks, len(chunks), chunk_size)
+            self.assertEqual(sorted(recovered), lost)
+            for i in lost:
+                self.assertEqual(recovered[i], chunks[i].ljust(chunk_size, b'\0'))
+
+    def test_too_few_parity_chunks(self):
+        chunks = [bytes([i]) * 10 for i in range(4)]
+        parity = fec_encode(chunks, 1, 10)
+        self.assertIsNone(fec_decode({0: chunks[0], 1: chunks[1]}, {0: parity[0]}, 4, 10))
+        self.assertEqual(fec_decode(dict(enumerate(chunks)), {}, 4, 10), {})
+
+
+class DeltaTest(unittest.TestCase):
+    def rebuild(self, old, new, block_size):
+        signatures = {n: block_signature(old[offset:offset + block_size])
+                      for n, offset in enumerate(range(0, len(old), block_size))}
+        delta = b''.join(delta_stream(new, signatures, block_size, len(old)))
+        # Feed the instructions back in pieces that split them at arbitrary points
+        pieces = [delta[offset:offset + 7] for offset in range(0, len(delta), 7)]
+        rebuilt = b''.join(apply_delta(pieces, lambda offset, length: old[offset:offset + length], block_size))
+        return rebuilt, delta
+
+    def test_round_trip(self):
+        rng = random.Random(2)
+        old = rng.randbytes(5000)
+        edits = [
+            old,
+            old[:1000] + b'inserted' + old[1000:],
+            old[:2000] + old[2300:],
+            rng.randbytes(100) + old + rng.randbytes(30),
+            old[:4990],
+            b'',
+        ]
+        for new in edits:
+            rebuilt, delta = self.rebuild(old, new, 128)
+            self.assertEqual(rebuilt, new)
+        # An unchanged file is all copy instructions
+        self.assertLess(len(self.rebuild(old, old, 128)[1]), 100)
+
+    def test_truncated_delta(self):
+        old = bytes(range(256)) * 4
+        delta = b''.join(delta_stream(b'new' + old, {0: block_signature(old[:64])}, 64, len(old)))
+        with self.assertRaises(ValueError):
+            list(apply_delta([delta[:-1]], lambda offset, length: old[offset:offset + length], 64))
+
+
+class MerkleTest(unittest.TestCase):
+    def test_tree_shape(self):
+        for count in (1, 2, 3, 5, 8, 13):
+            leaves = b''.join(merkle_leaf(bytes([i])) for i in range(count))
+            levels = merkle_levels(leaves)
+            self.assertEqual(len(levels[-1]), MERKLE_HASH_LEN)
+            self.assertEqual(levels[0], leaves)
+            for level in range(1, len(levels)):
+                for index in range(len(levels[level]) // MERKLE_HASH_LEN):
+                    children = merkle_children(levels, level, index)
+                    self.assertIn(len(children), (1, 2))
+                    if len(children) == 1:
+                        # A node without a sibling is carried up unchanged
+                        self.assertEqual(merkle_node(levels, level, index), merkle_node(levels, *children[0]))
+
+    def test_changed_chunk_changes_only_its_path(self):
+        chunks = [bytes([i]) * 20 for i in range(6)]
+        levels = merkle_levels(b''.join(merkle_leaf(c) for c in chunks))
+        chunks[4] = b'corrupt'
+        changed = merkle_levels(b''.join(merkle_leaf(c) for c in chunks))
+        self.assertNotEqual(levels[-1], changed[-1])
+        # Walking down from the root only the differing children lead to the damaged leaf
+        level, index = len(levels) - 1, 0
+        while level:
+            level, index = [child for child in merkle_children(levels, level, index)
+                            if merkle_node(levels, *child) != merkle_node(changed, *child)][0]
+        self.assertEqual(index, 4)
+
+    def test_missing_nodes(self):
+        levels = merkle_levels(merkle_leaf(b'a') + merkle_leaf(b'b'))
+        self.assertEqual(merkle_node(levels, 0, 2), b'')
+        self.assertEqual(merkle_node(levels, 5, 0), b'')
+        self.assertEqual(merkle_node(levels, -1, 0), b'')
+        self.assertEqual(merkle_children(levels, 0, 0), [])
+
+
+class FrameTest(unittest.TestCase):
+    def test_frame_round_trip(self):
+        frame = pack_frame(MSG_CHUNK, 0xbeef, 70000, b'payload', FLAG_PARITY)
+        self.assertEqual(unpack_frame(frame), (MSG_CHUNK, 0xbeef, 70000, FLAG_PARITY, b'payload'))
+        self.assertEqual(unpack_frame(pack_frame(MSG_ACK, 1, 2))[4], b'')
+
+    def test_ack_bitmap_round_trip(self):
+        received = {0, 1, 2, 4, 7, 30, 200}
+        bitmap = build_ack_bitmap(received, 3)
+        self.assertEqual(set(parse_ack_bitmap(3, decode_bitmap(encode_bitmap(bitmap)))), received - {0, 1, 2})
+
+    def test_ranges_round_trip(self):
+        chunks = [9, 1, 2, 3, 7, 8, 12]
+        self.assertEqual(chunks_to_ranges(chunks), [[1, 4], [7, 10], [12, 13]])
+        self.assertEqual(ranges_to_chunks(chunks_to_ranges(chunks)), sorted(chunks))
+
+
+class ParseMessageTest(unittest.TestCase):
+    def test_long_keys_and_types_fold_into_short_ones(self):
+        message = {long_key: index for index, long_key in enumerate(MESSAGE_KEYS)}
+        message['type'] = 'batch_ack'
+        data = parse_message(json.dumps(message))
+        self.assertEqual(data['t'], 'ba')
+        for index, (long_key, short_key) in enumerate(MESSAGE_KEYS.items()):
+            if long_key != 'type':
+                self.assertEqual(data[short_key], index)
+            self.assertNotIn(long_key, data)
+
+    def test_short_keys_pass_through(self):
+        data = parse_message(json.dumps({'t': 'fc', 'f': 'a.txt', 'cs': 'x', 'id': 5}))
+        self.assertEqual(data, {'t': 'fc', 'f': 'a.txt', 'cs': 'x', 'id': 5})
+        self.assertEqual(parse_message(json.dumps({'type': 'file_completion'}))['t'], 'fc')
+
+    def test_rejects_text_that_is_not_a_message(self):
+        for text in ('hello', '[1, 2]', '{"f": "a.txt"}', '"t"', ''):
+            self.assertIsNone(parse_message(text))
+
+
+if __name__ == '__main__':
+    unittest.main()
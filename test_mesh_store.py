@@ -0,0 +1,67 @@
+"""Tests for the receivers' content-addressed chunk store"""
+import os
+import tempfile
+import time
+import unittest
+
+from mesh_protocol import merkle_leaf
+from mesh_store import ChunkStore
+
+
+def chunk(i, size=100):
+    return bytes([i]) * size
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, '.chunks')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        store = ChunkStore(self.directory, 1000)
+        store.put(merkle_leaf(chunk(1)), chunk(1))
+        self.assertEqual(store.get(merkle_leaf(chunk(1))), chunk(1))
+        self.assertIsNone(store.get(merkle_leaf(chunk(2))))
+        store.put(merkle_leaf(chunk(1)), chunk(1))  # Storing a chunk twice counts it once
+        self.assertEqual(store.size, 100)
+
+    def test_evicts_least_recently_used(self):
+        store = ChunkStore(self.directory, 300)
+        for i in range(3):
+            store.put(merkle_leaf(chunk(i)), chunk(i))
+        store.get(merkle_leaf(chunk(0)))  # Chunk 1 is now the least recently used
+        store.put(merkle_leaf(chunk(3)), chunk(3))
+        self.assertIsNone(store.get(merkle_leaf(chunk(1))))
+        for i in (0, 2, 3):
+            self.assertEqual(store.get(merkle_leaf(chunk(i))), chunk(i))
+        self.assertEqual(store.size, 300)
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_drops_corrupted_chunks(self):
+        store = ChunkStore(self.directory, 1000)
+        key = merkle_leaf(chunk(1))
+        store.put(key, chunk(1))
+        with open(store.path(key), 'wb') as f:
+            f.write(b'bit rot')
+        self.assertIsNone(store.get(key))
+        self.assertEqual(store.size, 0)
+        self.assertFalse(os.path.exists(store.path(key)))
+
+    def test_reopened_store_keeps_order_and_limit(self):
+        store = ChunkStore(self.directory, 1000)
+        for i in range(4):
+            store.put(merkle_leaf(chunk(i)), chunk(i))
+            # Modification times order the chunks after a restart
+            os.utime(store.path(merkle_leaf(chunk(i))), (time.time() + i, time.time() + i))
+        with open(os.path.join(self.directory, 'not-a-chunk'), 'wb') as f:
+            f.write(b'ignored')
+        reopened = ChunkStore(self.directory, 250)
+        self.assertEqual(list(reopened.entries), [merkle_leaf(chunk(2)), merkle_leaf(chunk(3))])
+        self.assertEqual(reopened.size, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()